@@ -2,46 +2,138 @@ import os
 import time
 import json
 import random
-import requests
+import shutil
+import atexit
+import socket
 import argparse
+import tempfile
+import importlib.util
 from tqdm import tqdm
 from termcolor import colored
+import asyncio
 import multiprocessing as mp
-from base_agent import BaseAgent
+from functools import partial
+from base_agent import BaseAgent, AsyncBaseAgent
+from llm_broker import BrokerAgent, start_broker
+from tool_client import ToolClient, AsyncToolClient
+from llm_cache import LLMCache, sample_scope
+from tool_cache import ToolCache
+from results_store import ResultsStore
+from checkpoint import QueryCheckpoint
+from work_queue import WorkQueue
+from tool_index import ToolIndex, build_tool_index
+from tool_registry import ToolRegistry, openai_function_spec
+from rate_limiter import RateLimiter
+from run_log import RunLog, LoggedAgent, logged_tool_caller
+from tool_health import ToolHealth, CIRCUIT_OPEN_STATUS, circuit_open_observation
+from sampling import CandidateSampler
+from memory import Memory, trajectory_lessons, step_lessons
+from metrics import Metrics, metrics_scope, record_metric, timed_metric, summarize_metrics, print_metrics_summary, write_prometheus
 from server import get_rapidapi_response
 from prompt import (
-    PLAN_AGENT_SYSTEM_PROMPT, PLAN_AGENT_USER_PROMPT,
-    TOOL_AGENT_SYSTEM_PROMPT, TOOL_AGENT_USER_PROMPT,
-    ANSWER_AGENT_SYSTEM_PROMPT, ANSWER_AGENT_USER_PROMPT,
-    LONG_MEMORY_REFLECTION_TEMPLATE, SHORT_MEMORY_REFLECTION_TEMPLATE
+    PLAN_AGENT_SYSTEM_PROMPT, TOOL_AGENT_SYSTEM_PROMPT, ANSWER_AGENT_SYSTEM_PROMPT,
+    LONG_MEMORY_REFLECTION_TEMPLATE, SHORT_MEMORY_REFLECTION_TEMPLATE,
+    build_user_prompt
 )
 from utils import (
     change_name, standardize, get_white_list,
-    generate_task_list, fetch_api_json, api_json_to_openai_json
+    generate_task_refs, load_task, fetch_api_json
 )
 
-def parse_arg():
+def parse_arg(argv=None):
     parser = argparse.ArgumentParser()
+    parser.add_argument('--llm_broker', action="store_true", help="send the llm requests of all pool workers through one broker process enforcing global budgets and priorities; pool runner only")
+    parser.add_argument('--llm_broker_address', type=str, default=None, required=False, help='host:port of an already running broker (see llm_broker.py) to use instead of starting one')
+    parser.add_argument('--llm_broker_authkey', type=str, default=os.environ.get("MIRROR_BROKER_AUTHKEY"), required=False, help='shared secret of the broker connections, required with --llm_broker_address; a random one is generated for the broker started by --llm_broker')
+    parser.add_argument('--llm_broker_max_inflight', type=int, default=64, required=False, help='maximum number of llm requests the broker keeps in flight')
+    parser.add_argument('--llm_broker_coalesce', type=str, default="deterministic", choices=["deterministic", "always", "never"], required=False, help='which identical concurrent requests the broker sends once, deterministic ones (temperature 0) by default')
+    parser.add_argument('--llm_rpm', type=float, default=None, required=False, help='llm requests per minute allowed to all the workers together, requires the broker')
+    parser.add_argument('--llm_tpm', type=float, default=None, required=False, help='llm tokens per minute allowed to all the workers together, requires the broker')
     parser.add_argument('--test_query_id_dir', type=str, default="./solvable_queries/test_query_ids", required=False, help='test query ids for different test sets')
     parser.add_argument('--query_dir', type=str, default="./solvable_queries/test_instruction", required=False, help='the directory that contains test sets')
     parser.add_argument('--answer_dir', type=str, default="./data/answer_gpt35", required=False, help='the directory that contains test sets')
+    parser.add_argument('--results_db', type=str, default=None, required=False, help='sqlite file to store the answers in instead of one json file per query, export them with results_store.py; not with --work_queue, SQLite in WAL mode does not work on a network filesystem')
     parser.add_argument('--method', type=str, default="mirror", required=False, help='method')
     parser.add_argument('--model_name', type=str, default="gpt-4o-2024-05-13", required=False, help='the model name for the vllm model')
+    parser.add_argument('--base_url', type=str, default=None, required=False, help='base url of an OpenAI-compatible server (vLLM, TGI, llama.cpp server) serving --model_name, Azure OpenAI is used if not set')
+    parser.add_argument('--llm_api_key', type=str, default=None, required=False, help='api key of the llm endpoint, read from the environment if not set')
+    parser.add_argument('--llm_batch_window_ms', type=float, default=0, required=False, help='collect the llm requests issued within this window and send them together, identical ones as one request with n choices; 0 disables batching')
+    parser.add_argument('--llm_max_batch_size', type=int, default=32, required=False, help='send a batch as soon as it holds this many llm requests')
+    parser.add_argument('--llm_max_concurrency', type=int, default=None, required=False, help='maximum number of llm requests in flight per worker, unlimited by default')
     parser.add_argument('--tool_root_dir', type=str, default="./server/tools", required=False, help='tool environment for the toolbench')
+    parser.add_argument('--tool_index', type=str, default=None, required=False, help='compiled index of tool_root_dir, built on first use if missing (see tool_index.py)')
     parser.add_argument('--toolbench_key', type=str, default="",required=False, help='your toolbench key to request rapidapi service')
     parser.add_argument('--rapidapi_key', type=str, default="",required=False, help='your rapidapi key to request rapidapi service')
     parser.add_argument('--use_rapidapi_key', action="store_true", help="To use customized rapidapi service or not.")
     parser.add_argument('--api_customization', action="store_true", help="To use customized api or not.")
+    parser.add_argument('--function_format', type=str, default="repr", choices=["repr", "json", "signature"], required=False, help='how the function specs are written in the planner and executor prompts, see function_format.py')
+    parser.add_argument('--prompt_layout', type=str, default="default", choices=["default", "prefix_stable"], required=False, help='order of the user prompt parts, prefix_stable puts the function catalog first so repeated calls hit the prompt prefix cache')
+    parser.add_argument('--prune_optional_descriptions', nargs='*', default=[], choices=["planner", "executor"], help='prompts whose function specs leave out the descriptions of optional parameters')
     parser.add_argument('--max_observation_length', type=int, default=1024, required=False, help='maximum observation length')
     parser.add_argument('--observ_compress_method', type=str, default="truncate", choices=["truncate", "filter", "random"], required=False, help='observation compress method')
     parser.add_argument('--num_process', type=int, default=5, required=False, help='number of processes')
+    parser.add_argument('--runner', type=str, default="pool", choices=["pool", "async"], required=False, help='run queries in a process pool or concurrently in a single asyncio event loop; the async runner does not support --work_queue and the llm broker')
+    parser.add_argument('--checkpoint_dir', type=str, default=None, required=False, help='directory to save the state of every query to after each stage, an interrupted query resumes from its last finished stage; not with --record')
+    parser.add_argument('--work_queue', type=str, default=None, required=False, help='lease directory on a shared filesystem; the pool runners of every host pointing at it pull queries from it, with --answer_dir on the same filesystem; pool runner only')
+    parser.add_argument('--lease_seconds', type=float, default=600, required=False, help='seconds without heartbeat after which a query leased by a dead worker is requeued')
+    parser.add_argument('--async_concurrency', type=int, default=100, required=False, help='maximum number of concurrent queries for the async runner')
     parser.add_argument('--max_round', type=int, default=5, required=False, help='number of round')
     parser.add_argument('--max_step', type=int, default=3, required=False, help='number of step')
+    parser.add_argument('--long_memory_budget', type=int, default=None, required=False, help='token budget of the planner memory of failed rounds, unlimited by default')
+    parser.add_argument('--short_memory_budget', type=int, default=None, required=False, help='token budget of the executor memory of failed steps, unlimited by default')
+    parser.add_argument('--memory_keep_recent', type=int, default=2, required=False, help='number of the most recent memories kept verbatim when a memory exceeds its budget, older ones are condensed into lessons')
+    parser.add_argument('--num_candidates', type=int, default=1, required=False, help='number of planner, executor and answer responses sampled at a time, the first one scoring at least 9 cancels the others; only --runner async stops their requests, the pool runner still sends and pays for them')
+    parser.add_argument('--candidate_sampling', type=str, default="concurrent", choices=["concurrent", "n"], required=False, help='sample the candidates with concurrent requests or with the n parameter of one request')
+    parser.add_argument('--max_parallel_subtasks', type=int, default=4, required=False, help='maximum number of independent plan subtasks executed concurrently')
     parser.add_argument('--service_url', type=str, default="http://localhost:8080/virtual", required=False, help='local stabletoolbench service url')
+    parser.add_argument('--tool_pool_size', type=int, default=10, required=False, help='maximum number of keep-alive connections to the tool service per worker')
+    parser.add_argument('--tool_connect_timeout', type=float, default=5, required=False, help='connect timeout of tool service requests in seconds')
+    parser.add_argument('--tool_read_timeout', type=float, default=None, required=False, help='read timeout of tool service requests in seconds, 120 for the virtual service and 15 otherwise by default')
+    parser.add_argument('--tool_http2', action="store_true", help="multiplex concurrent tool requests over HTTP/2 if the service supports it, requires the h2 package")
+    parser.add_argument('--rate_limit_per_minute', type=float, default=30, required=False, help='tool service calls per minute allowed for the toolbench key, shared by all processes of the run; with --work_queue every host has its own bucket for the shared key, so divide the limit by the number of hosts')
+    parser.add_argument('--rate_limit_burst', type=float, default=1, required=False, help='number of tool service calls allowed in a burst for the toolbench key')
+    parser.add_argument('--tool_rate_limit_per_minute', type=float, default=None, required=False, help='calls per minute allowed for each tool, unlimited by default')
+    parser.add_argument('--tool_rate_limit_burst', type=float, default=1, required=False, help='number of calls allowed in a burst for each tool')
+    parser.add_argument('--tool_rate_limits', nargs='*', default=None, help='per-tool limits overriding the default, as tool_name=per_minute[:burst]')
+    parser.add_argument('--rate_limit_db', type=str, default=None, required=False, help='sqlite file holding the rate limit buckets, shared by the processes of this run by default; give the same file to runs that share a toolbench key')
+    parser.add_argument('--circuit_failure_threshold', type=int, default=3, required=False, help='consecutive failures after which calls to a tool are rejected, 0 disables the circuit breaker but not the rate-limit backoff')
+    parser.add_argument('--circuit_cooldown', type=float, default=60, required=False, help='seconds before a tool with an open circuit is probed again')
+    parser.add_argument('--tool_health_db', type=str, default=None, required=False, help='sqlite file holding the tool health states, shared by the processes of this run by default')
     parser.add_argument('--service_type', type=str, default="stabletoolbench", required=False, help='')
     parser.add_argument('--test_set', nargs='+', default=['G2_category'], help='test set name')
+    parser.add_argument('--tool_cache', type=str, default=None, required=False, help='sqlite file of the persistent tool response cache, disabled if not set')
+    parser.add_argument('--tool_cache_ttl_hours', type=float, default=None, required=False, help='tool responses older than this are fetched again')
+    parser.add_argument('--tool_cache_max_entries', type=int, default=None, required=False, help='evict least recently used tool responses above this number')
+    parser.add_argument('--record', type=str, default=None, required=False, help='directory to write a log of the llm and tool I/O of every query to')
+    parser.add_argument('--replay', type=str, default=None, required=False, help='directory of logs written by --record to re-run the queries from, without any llm or tool call')
+    parser.add_argument('--llm_cache', type=str, default=None, required=False, help='sqlite file of the persistent LLM response cache, disabled if not set')
+    parser.add_argument('--llm_cache_max_size_mb', type=float, default=None, required=False, help='evict least recently used LLM cache entries above this size')
+    parser.add_argument('--llm_cache_max_age_days', type=float, default=None, required=False, help='evict LLM cache entries older than this')
+    parser.add_argument('--metrics_file', type=str, default=None, required=False, help='jsonl file the per query, round and stage metric events are appended to, disabled if not set; the summary covers the events of this run only')
+    parser.add_argument('--metrics_prom', type=str, default=None, required=False, help='file to write the metrics summary to in the prometheus text format, requires --metrics_file')
+    parser.add_argument('--llm_cache_sample_policy', type=str, default="nth", choices=["nth", "first"], required=False, help='replay the Nth sample for the Nth repeated call, or always the first sample, of temperature>0 requests; with "first" the self-reflection retries get back the response they retry')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    # tags the metric events of this run, which may share the metrics file with other runs and hosts
+    args.run_id = f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}"
+    if args.record and args.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    if args.runner == "async":
+        # the async runner has no pool workers to share a broker or a work queue between
+        for flag in ("work_queue", "llm_broker", "llm_broker_address", "llm_rpm", "llm_tpm"):
+            if getattr(args, flag):
+                parser.error(f"--{flag} requires --runner pool")
+    if args.tool_http2 and importlib.util.find_spec("h2") is None:
+        # httpx imports it only when the first worker opens its client
+        parser.error("--tool_http2 requires the h2 package, install it with: pip install 'httpx[http2]'")
+    if args.work_queue and args.results_db:
+        # the hosts would share it on the network filesystem, where the WAL locking of SQLite is not reliable
+        parser.error("--work_queue and --results_db are mutually exclusive, the answers of a work queue run go to --answer_dir")
+    if args.llm_broker_address and not args.llm_broker_authkey:
+        parser.error("--llm_broker_address requires --llm_broker_authkey or MIRROR_BROKER_AUTHKEY")
+    if args.record and args.checkpoint_dir:
+        # a resumed query would record only its last stages, its log could not be replayed
+        parser.error("--record and --checkpoint_dir are mutually exclusive")
     return args
 
 
@@ -51,71 +143,307 @@ def parse_json_response(response_str, error_msg):
         return response
     except json.JSONDecodeError:
         print(f"{error_msg} - JSON error")
+        record_metric("json_parse_failure", error="json")
     except Exception as e:
         print(f"{error_msg} - Unknown error: {str(e)}")
+        record_metric("json_parse_failure", error=str(e))
     return None
 
-def call_rapidapi(action_name, action_input, functions, api_name_reflect, cate_names, tool_names, args):
-    backoff = 1  # Initial backoff time
-    for k, function in enumerate(functions):
-        if function["name"].endswith(action_name):
-            pure_api_name = api_name_reflect[function["name"]]
-            payload = {
-                "category": cate_names[k],
-                "tool_name": tool_names[k],
-                "api_name": pure_api_name,
-                "tool_input": action_input,
-                "strip": args.observ_compress_method,
-                "toolbench_key": args.toolbench_key
-            }
-            print(colored(f"query to {cate_names[k]}-->{tool_names[k]}-->{action_name}", color="yellow"))
-            if args.use_rapidapi_key or args.api_customization:
-                payload["rapidapi_key"] = args.rapidapi_key
-                response = get_rapidapi_response(payload, api_customization=args.api_customization)
-            else:
-                time.sleep(3)  # rate limit: 30 per minute
-                headers = {"toolbench_key": args.toolbench_key}
-                timeout = None if args.service_url.endswith("virtual") else 15
-                try:
-                    response = requests.post(args.service_url, json=payload, headers=headers, timeout=timeout)
-                except requests.exceptions.Timeout:
-                    return json.dumps({"error": f"Timeout error...", "response": ""}), 5
-                if response.status_code != 200:
-                    return json.dumps({"error": f"request invalid, data error. status_code={response.status_code}", "response": ""}), 12
-                try:
-                    response = response.json()
-                except json.JSONDecodeError:
-                    return json.dumps({"error": "JSON decoding error from the response."}), 12
-                except Exception as e:
-                    return json.dumps({"error": f"Unexpected error: {str(e)}"}), 12
-
-            if response["error"] == "API not working error...":
-                status_code = 6
-            elif response["error"] == "Unauthorized error...":
-                status_code = 7
-            elif response["error"] == "Unsubscribed error...":
-                status_code = 8
-            elif response["error"] == "Too many requests error...":
-                status_code = 9
-            elif response["error"] == "Rate limit per minute error...":
-                print(f"Rate limit reached, sleeping for {backoff} seconds.")
-                time.sleep(backoff)
-                backoff *= 2  # Exponentially increase backoff time
-                if backoff > 64:  # Cap backoff time
-                    break
-                status_code = 10
-            elif response["error"] == "Message error...":
-                status_code = 11
+run_metrics = None
+results_store = None
+tool_cache = None
+tool_client = None
+tool_catalog = None
+rate_limiter = None
+tool_health = None
+
+def find_rapidapi_payload(action_name, action_input, registry, args):
+    entry = registry.resolve(action_name)
+    if entry is None:
+        return None
+    print(colored(f"query to {entry.category}-->{entry.tool_name}-->{action_name}", color="yellow"))
+    return registry.payload(entry, action_input, args.observ_compress_method, args.toolbench_key)
+
+def rapidapi_status_code(response):
+    if response["error"] == "API not working error...":
+        return 6
+    elif response["error"] == "Unauthorized error...":
+        return 7
+    elif response["error"] == "Unsubscribed error...":
+        return 8
+    elif response["error"] == "Too many requests error...":
+        return 9
+    elif response["error"] in ("Rate limit error...", "Rate limit per minute error..."):
+        return 10
+    elif response["error"] == "Message error...":
+        return 11
+    return 0
+
+def rapidapi_result(payload, response):
+    """Cache a cacheable response and turn it into the (observation, status_code) pair of `call_rapidapi`."""
+    if tool_cache is not None:
+        tool_cache.put(payload, response)
+    response.pop("save_cache", None)
+    return json.dumps(response), rapidapi_status_code(response)
+
+def check_tool_health(payload):
+    """Return (rejection, wait): the result to return without calling the tool if its circuit is open, and the backoff before calling it."""
+    if tool_health is None:
+        return None, 0
+    tool = f"{payload['category']}/{payload['tool_name']}"
+    allowed, wait = tool_health.before_call(tool)
+    if not allowed:
+        print(colored(f"circuit of {tool} is open, skipping the call", color="yellow"))
+        return (circuit_open_observation(tool), CIRCUIT_OPEN_STATUS), 0
+    if wait > 0:
+        print(f"Rate limit reached, backing off {tool} for {wait:.1f} seconds.")
+    return None, wait
+
+def record_tool_health(payload, status_code):
+    if tool_health is not None:
+        tool_health.record(f"{payload['category']}/{payload['tool_name']}", status_code)
+
+def call_rapidapi(action_name, action_input, registry, args, client):
+    payload = find_rapidapi_payload(action_name, action_input, registry, args)
+    if payload is None:
+        return json.dumps({"error": f"No such function name: {action_name}", "response": ""}), 1
+    if tool_cache is not None:
+        response = tool_cache.get(payload)
+        if response is not None:
+            return json.dumps(response), rapidapi_status_code(response)
+
+    rejection, wait = check_tool_health(payload)
+    if rejection is not None:
+        return rejection
+    time.sleep(wait)
+
+    if args.use_rapidapi_key or args.api_customization:
+        payload["rapidapi_key"] = args.rapidapi_key
+        response, error = get_rapidapi_response(payload, api_customization=args.api_customization), None
+    else:
+        rate_limiter.acquire(args.toolbench_key, payload["tool_name"])
+        response, error = client.post(payload)
+
+    observation, status_code = error if error is not None else rapidapi_result(payload, response)
+    record_tool_health(payload, status_code)
+    return observation, status_code
+
+async def call_rapidapi_async(action_name, action_input, registry, args, client):
+    payload = find_rapidapi_payload(action_name, action_input, registry, args)
+    if payload is None:
+        return json.dumps({"error": f"No such function name: {action_name}", "response": ""}), 1
+    if tool_cache is not None:
+        response = tool_cache.get(payload)
+        if response is not None:
+            return json.dumps(response), rapidapi_status_code(response)
+
+    rejection, wait = check_tool_health(payload)
+    if rejection is not None:
+        return rejection
+    await asyncio.sleep(wait)
+
+    if args.use_rapidapi_key or args.api_customization:
+        payload["rapidapi_key"] = args.rapidapi_key
+        response, error = await asyncio.to_thread(get_rapidapi_response, payload, api_customization=args.api_customization), None
+    else:
+        await rate_limiter.aacquire(args.toolbench_key, payload["tool_name"])
+        response, error = await client.post(payload)
+
+    observation, status_code = error if error is not None else rapidapi_result(payload, response)
+    record_tool_health(payload, status_code)
+    return observation, status_code
+
+def plan_dependencies(nodes):
+    """
+    Return, for every plan node, the indices of the nodes it directly depends on.
+
+    Nodes without a "dependencies" field depend on every preceding node, which keeps
+    the sequential behaviour for plans in the original format. Unknown ids and
+    self references are ignored, as are ids that are not strings or numbers; a cyclic
+    plan falls back to sequential order.
+    """
+    id_to_idx = {}
+    for idx, node in enumerate(nodes):
+        node_id = node.get("id") if isinstance(node, dict) else None
+        if isinstance(node_id, (str, int)):
+            id_to_idx.setdefault(node_id, idx)
+
+    deps = []
+    for idx, node in enumerate(nodes):
+        node_deps = node.get("dependencies") if isinstance(node, dict) else None
+        if not isinstance(node_deps, list):
+            deps.append(list(range(idx)))
+            continue
+        resolved = set()
+        for dep in node_deps:
+            if isinstance(dep, (str, int)) and dep in id_to_idx and id_to_idx[dep] != idx:
+                resolved.add(id_to_idx[dep])
+        deps.append(sorted(resolved))
+
+    # Kahn's algorithm, only to make sure the graph is acyclic
+    indegree = [len(d) for d in deps]
+    children = [[] for _ in nodes]
+    for idx, node_deps in enumerate(deps):
+        for dep in node_deps:
+            children[dep].append(idx)
+    ready = [idx for idx, degree in enumerate(indegree) if degree == 0]
+    visited = 0
+    while ready:
+        idx = ready.pop()
+        visited += 1
+        for child in children[idx]:
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                ready.append(child)
+    if visited != len(nodes):
+        print(colored(f"[{os.getpid()}] cyclic plan dependencies, running subtasks sequentially", color="yellow"))
+        return [list(range(idx)) for idx in range(len(nodes))]
+    return deps
+
+def valid_plan_nodes(nodes):
+    """Whether `nodes` is a list of plan nodes, each an object with a subtask."""
+    return isinstance(nodes, list) and all(isinstance(node, dict) and "subtask" in node for node in nodes)
+
+
+async def run_subtasks(nodes, run_subtask, max_workers=1):
+    """
+    Run the plan nodes as a DAG, starting each node as soon as all of its upstream
+    nodes have finished. `run_subtask(idx, related_outputs)` is a coroutine returning a tuple
+    whose last element is the trajectory record of the node (or None if it produced
+    no output). related_outputs only contains records of upstream nodes, in plan
+    order. The results are returned in plan order, independent of completion order.
+    """
+    deps = plan_dependencies(nodes)
+    ancestors = {}
+
+    def upstream_of(idx):
+        if idx not in ancestors:
+            ancestors[idx] = set(deps[idx])
+            for dep in deps[idx]:
+                ancestors[idx] |= upstream_of(dep)
+        return ancestors[idx]
+
+    results = {}
+    done_events = [asyncio.Event() for _ in nodes]
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def run_node(idx):
+        for dep in deps[idx]:
+            await done_events[dep].wait()
+        related_outputs = [
+            {"subtask": results[up][-1]["subtask"], "observation": results[up][-1]["observation"]}
+            for up in sorted(upstream_of(idx)) if results[up][-1] is not None
+        ]
+        async with semaphore:
+            results[idx] = await run_subtask(idx, related_outputs)
+        done_events[idx].set()
+
+    await asyncio.gather(*[run_node(idx) for idx in range(len(nodes))])
+    return [results[idx] for idx in range(len(nodes))]
+
+async def execute_subtask(agent, call_tool, subtask, node, registry, related_outputs, args):
+    steps = 0
+    scores = []
+    short_memory = Memory(
+        SHORT_MEMORY_REFLECTION_TEMPLATE, step_lessons,
+        separator="\n\n", budget=args.short_memory_budget, keep_recent=args.memory_keep_recent
+    )
+    exe_current_score = -1
+    exe_max_score = -1
+    exe_best = None
+    sampler = CandidateSampler(agent, args.num_candidates, args.candidate_sampling, max_calls=args.max_step)
+    for tool_step in range(args.max_step):
+        executor_agent_system_prompt = TOOL_AGENT_SYSTEM_PROMPT
+        executor_agent_user_prompt = build_user_prompt(
+            "executor", args.prompt_layout,
+            subtask=subtask,
+            functions=registry.render(args.function_format, "executor" in args.prune_optional_descriptions),
+            related_outputs=related_outputs,
+            short_memory=short_memory.render()
+        )
+        execution_response = await sampler.next(
+            system_prompt=executor_agent_system_prompt,
+            user_prompt=executor_agent_user_prompt,
+            json_mode=True
+        )
+        steps += 1
+        execution = parse_json_response(execution_response, "EXECUTOR---ERROR")
+        if execution and "self_reflection" in execution and "score" in execution["self_reflection"] and "function" in execution and "parameters" in execution:
+            exe_current_score = execution["self_reflection"]["score"]
+            print(f"TOOL AGENT: {execution}")
+            scores.append(exe_current_score)
+            record_metric("score", score=exe_current_score)
+
+            if exe_current_score > exe_max_score:
+                exe_max_score = exe_current_score
+                exe_best = execution
+            
+        if exe_max_score >= 9:
+            # the other candidates were sampled without the outcome of this call
+            sampler.discard()
+            execution = exe_best
+            action = execution["function"]
+            action_input = execution["parameters"]
+            if action is None or type(action)== list:
+                continue
+            print(colored(f"[{os.getpid()}] action --> {action} --> {action_input}", color="light_cyan"))
+            start = time.perf_counter()
+            observation_str, exe_status = await call_tool(
+                action_name=action,
+                action_input=action_input,
+                registry=registry,
+                args=args
+            )
+            record_metric("tool_call", tool=action, status=exe_status, seconds=time.perf_counter() - start)
+
+            observation_json = json.loads(observation_str)
+            observation = observation_json.get("response", "")
+            observation = observation if isinstance(observation, str) else json.dumps(observation)
+            print(colored(f"[{os.getpid()}] observation --> {observation}", color="cyan"))
+
+            observation = observation[:1000] if len(observation) >= 1000 else observation
+
+            # an open circuit will not close within this subtask, so there is no point in retrying it
+            if exe_status == 0 or exe_status == CIRCUIT_OPEN_STATUS or tool_step >= args.max_step - 1:
+                node["status"] = 1 if exe_status == 0 else 0
+                return steps, scores, {
+                    "subtask": subtask,
+                    "status": node["status"],
+                    "action": action,
+                    "action_input": action_input,
+                    "observation": observation
+                }
             else:
-                status_code = 0
-            return json.dumps(response), status_code
+                short_memory.add(
+                    step=tool_step+1,
+                    subtask=subtask,
+                    action=action,
+                    action_input=action_input,
+                    observation=observation,
+                    reflection=""
+                )
+        else:
+            execution = exe_best
+            reflection = execution["self_reflection"] if execution and "self_reflection" in execution else ""
+            action = execution["function"] if execution and "function" in execution else ""
+            action_input = execution["parameters"] if execution and "parameters" in execution else ""
+            short_memory.add(
+                step=tool_step+1,
+                subtask=subtask,
+                action=action,
+                action_input=action_input,
+                observation="",
+                reflection=reflection
+            )
+    return steps, scores, None
 
-    return json.dumps({"error": f"No such function name: {action_name}", "response": ""}), 1
+async def solve_task(task, args, agent, call_tool):
+    """
+    Solve one query with the planner/executor/answer agents and write its answer file.
+    `agent` provides `aquery_openai` and `call_tool` is a coroutine function with the
+    signature of `call_rapidapi`.
+    """
 
-def process_task(task_with_args):    
-    global base_agent 
-    task, args = task_with_args
-    
     query_id = task[2]
     output_dir_path = task[-2]
     os.makedirs(output_dir_path, exist_ok=True)
@@ -125,26 +453,41 @@ def process_task(task_with_args):
     query = data_dict["query"]
     print(colored(f"[{os.getpid()}] query --> {query}", color="red"))
 
-    tool_names = []
-    cate_names = []
-    functions = []
-    api_name_reflect = {}
+    run_log = None
+    if args.record or args.replay:
+        run_log = RunLog(os.path.join(args.record or args.replay, f"{query_id}.jsonl"), "replay" if args.replay else "record")
+        agent = LoggedAgent(agent, run_log)
+        call_tool = logged_tool_caller(call_tool, run_log)
+    try:
+        # the repeated requests of a query are counted per query, see LLMCache.sample_index
+        with metrics_scope(run_metrics, query_id=query_id), sample_scope():
+            return await solve_query(query_id, query, data_dict, tool_descriptions, output_file_path, args, agent, call_tool)
+    finally:
+        if run_log is not None:
+            run_log.close()
 
-    data_dict = fetch_api_json(data_dict, tool_root_dir=args.tool_root_dir)
+async def solve_query(query_id, query, data_dict, tool_descriptions, output_file_path, args, agent, call_tool):
+    start = time.perf_counter()
+    if tool_catalog is not None:
+        data_dict = tool_catalog.fetch_api_json(data_dict)
+    else:
+        data_dict = await asyncio.to_thread(fetch_api_json, data_dict, tool_root_dir=args.tool_root_dir)
     if not data_dict["api_list"]:
         print("No available api")
         return
 
-    for idx_tool, api_json in enumerate(data_dict["api_list"]):
-        standard_tool_name = tool_descriptions[idx_tool][0]
-        openai_function_json, cate_name, pure_api_name = api_json_to_openai_json(api_json, standard_tool_name)
-        functions.append(openai_function_json)
-        api_name_reflect[openai_function_json["name"]] = pure_api_name
-        tool_names.append(standard_tool_name)
-        cate_names.append(cate_name)
+    registry = ToolRegistry.from_api_list(
+        data_dict["api_list"],
+        tool_descriptions,
+        spec_fn=tool_catalog.openai_function if tool_catalog is not None else openai_function_spec
+    )
+    functions = registry.functions
 
     round_index = 0
-    long_memory = ""
+    long_memory = Memory(
+        LONG_MEMORY_REFLECTION_TEMPLATE, trajectory_lessons,
+        budget=args.long_memory_budget, keep_recent=args.memory_keep_recent
+    )
     total_steps = 0
     best_answer = ""
     best_plan = {}
@@ -154,183 +497,172 @@ def process_task(task_with_args):
     task_completed = False 
     
     plan_scores, tool_scores, answer_scores = [], [], []
+
+    checkpoint = QueryCheckpoint.from_args(args, output_file_path)
+    state = await asyncio.to_thread(checkpoint.load) if checkpoint is not None else None
+    # the last finished stage of the current round: None, "planner" or "executor"
+    resume_stage = None
+    if state is not None:
+        round_index, resume_stage = state["round_index"], state["stage"]
+        plan, trajectory = state["plan"], state["trajectory"]
+        long_memory.restore(state["long_memory"])
+        total_steps, max_score = state["total_steps"], state["max_score"]
+        best_answer, best_plan, best_reflection, best_trajectory = state["best_answer"], state["best_plan"], state["best_reflection"], state["best_trajectory"]
+        plan_scores, tool_scores, answer_scores = state["plan_scores"], state["tool_scores"], state["answer_scores"]
+        print(colored(f"[{os.getpid()}] query {query_id} resumed at round {round_index} after stage {resume_stage}", color="yellow"))
+
+    async def save_checkpoint(stage):
+        if checkpoint is None:
+            return
+        # the write and fsync run in a thread, so the other queries of the event loop are not blocked
+        await asyncio.to_thread(checkpoint.save, {
+            "round_index": round_index,
+            "stage": stage,
+            "plan": plan if stage else None,
+            "trajectory": trajectory if stage else None,
+            "long_memory": long_memory.entries,
+            "total_steps": total_steps,
+            "max_score": max_score,
+            "best_answer": best_answer,
+            "best_plan": best_plan,
+            "best_reflection": best_reflection,
+            "best_trajectory": best_trajectory,
+            "plan_scores": plan_scores,
+            "tool_scores": tool_scores,
+            "answer_scores": answer_scores
+        })
+
     while round_index < args.max_round and not task_completed:
-        trajectory = []
-        plan = None
-        plan_current_score = -1
-        plan_max_score = -1
-        plan_best = None
-        for plan_step in range(args.max_step):
-            planner_agent_system_prompt = PLAN_AGENT_SYSTEM_PROMPT
-            planner_agent_user_prompt = PLAN_AGENT_USER_PROMPT.format(
-                task_description=query,
-                functions=functions,
-                long_memory=long_memory
-            )
-            plan_response = base_agent.query_openai(
-                system_prompt=planner_agent_system_prompt,
-                user_prompt=planner_agent_user_prompt,
-                json_mode=True
-            )
-            total_steps += 1
-            plan = parse_json_response(plan_response, "PLANNER---ERROR")
-            if plan and "nodes" in plan and "score" in plan["self_reflection"]:
-                print(f'PLANNER AGENT: {plan}')
-                plan_current_score = plan["self_reflection"]["score"]
-
-                plan_scores.append(plan_current_score)
-
-                if plan_current_score > plan_max_score:
-                    plan_max_score = plan_current_score
-                    plan_best = plan
-            if plan_current_score >= 9:
-                break
-        plan = plan_best
-        if plan_best is None:
-            round_index += 1
-            continue
+        if resume_stage is None:
+            trajectory = []
+            plan = None
+            plan_current_score = -1
+            plan_max_score = -1
+            plan_best = None
+            with metrics_scope(stage="planner", round=round_index), timed_metric("stage"):
+                sampler = CandidateSampler(agent, args.num_candidates, args.candidate_sampling, max_calls=args.max_step)
+                for plan_step in range(args.max_step):
+                    planner_agent_system_prompt = PLAN_AGENT_SYSTEM_PROMPT
+                    planner_agent_user_prompt = build_user_prompt(
+                        "planner", args.prompt_layout,
+                        task_description=query,
+                        functions=registry.render(args.function_format, "planner" in args.prune_optional_descriptions),
+                        long_memory=long_memory.render()
+                    )
+                    plan_response = await sampler.next(
+                        system_prompt=planner_agent_system_prompt,
+                        user_prompt=planner_agent_user_prompt,
+                        json_mode=True
+                    )
+                    total_steps += 1
+                    plan = parse_json_response(plan_response, "PLANNER---ERROR")
+                    # a plan whose nodes are not objects with a subtask cannot be executed, like a plan without score
+                    if plan and valid_plan_nodes(plan.get("nodes")) and "score" in plan["self_reflection"]:
+                        print(f'PLANNER AGENT: {plan}')
+                        plan_current_score = plan["self_reflection"]["score"]
+
+                        plan_scores.append(plan_current_score)
+                        record_metric("score", score=plan_current_score)
+
+                        if plan_current_score > plan_max_score:
+                            plan_max_score = plan_current_score
+                            plan_best = plan
+                    if plan_current_score >= 9:
+                        break
+                sampler.cancel()
+            plan = plan_best
+            if plan_best is None:
+                round_index += 1
+                await save_checkpoint(None)
+                continue
+            await save_checkpoint("planner")
 
         print(colored(f"[{os.getpid()}] plan --> {plan}", color="light_yellow"))
         subtasks = [t["subtask"] for t in plan["nodes"]]
         print(colored(f"[{os.getpid()}] subtasks --> {subtasks}", color="light_red"))
 
-        outputs = {}
-        related_outputs = []
-        
-        for idx, subtask in enumerate(subtasks):
-            short_memory = ""
-            exe_current_score = -1
-            exe_max_score = -1
-            exe_best = None
-            for tool_step in range(args.max_step):
-                executor_agent_system_prompt = TOOL_AGENT_SYSTEM_PROMPT
-                executor_agent_user_prompt = TOOL_AGENT_USER_PROMPT.format(
-                    subtask=subtask,
-                    functions=functions,
+        async def run_subtask(idx, related_outputs):
+            with metrics_scope(stage="executor", round=round_index, node=idx), timed_metric("stage"):
+                return await execute_subtask(
+                    agent=agent,
+                    call_tool=call_tool,
+                    subtask=subtasks[idx],
+                    node=plan["nodes"][idx],
+                    registry=registry,
                     related_outputs=related_outputs,
-                    short_memory=short_memory
+                    args=args
+                )
+
+        if resume_stage != "executor":
+            for steps, scores, record in await run_subtasks(plan["nodes"], run_subtask, args.max_parallel_subtasks):
+                total_steps += steps
+                tool_scores.extend(scores)
+                if record is not None:
+                    trajectory.append(record)
+            await save_checkpoint("executor")
+        resume_stage = None
+        
+        answer_step = 0
+        with metrics_scope(stage="answer", round=round_index), timed_metric("stage"):
+            sampler = CandidateSampler(agent, args.num_candidates, args.candidate_sampling, max_calls=args.max_step)
+            for _ in range(args.max_step):
+                answer_agent_system_prompt = ANSWER_AGENT_SYSTEM_PROMPT
+                answer_agent_user_prompt = build_user_prompt(
+                    "answer", args.prompt_layout,
+                    task_description=query,
+                    trajectory=trajectory
                 )
-                execution_response = base_agent.query_openai(
-                    system_prompt=executor_agent_system_prompt,
-                    user_prompt=executor_agent_user_prompt,
+                answer_response = await sampler.next(
+                    system_prompt=answer_agent_system_prompt,
+                    user_prompt=answer_agent_user_prompt,
                     json_mode=True
                 )
                 total_steps += 1
-                execution = parse_json_response(execution_response, "EXECUTOR---ERROR")
-                if execution and "self_reflection" in execution and "score" in execution["self_reflection"] and "function" in execution and "parameters" in execution:
-                    exe_current_score = execution["self_reflection"]["score"]
-                    print(f"TOOL AGENT: {execution}")
-                    tool_scores.append(exe_current_score)
-
-                    if exe_current_score > exe_max_score:
-                        exe_max_score = exe_current_score
-                        exe_best = execution
-                    
-                if exe_max_score >= 9:
-                    execution = exe_best
-                    action = execution["function"]
-                    action_input = execution["parameters"]
-                    if action is None or type(action)== list:
-                        continue
-                    print(colored(f"[{os.getpid()}] action --> {action} --> {action_input}", color="light_cyan"))
-                    observation_str, exe_status = call_rapidapi(
-                        action_name=action,
-                        action_input=action_input,
-                        functions=functions,
-                        api_name_reflect=api_name_reflect,
-                        cate_names=cate_names,
-                        tool_names=tool_names,
-                        args=args
-                    )
+                answer = parse_json_response(answer_response, "ANSWER_AGENT---ERROR")
 
-                    observation_json = json.loads(observation_str)
-                    observation = observation_json.get("response", "")
-                    observation = observation if isinstance(observation, str) else json.dumps(observation)
-                    print(colored(f"[{os.getpid()}] observation --> {observation}", color="cyan"))
-
-                    observation = observation[:1000] if len(observation) >= 1000 else observation
-
-                    if exe_status == 0 or tool_step >= args.max_step - 1:
-                        plan["nodes"][idx]["status"] = 1 if exe_status == 0 else 0
-                        outputs[plan["nodes"][idx]["id"]] = observation
-                        trajectory.append({
-                            "subtask": subtask,
-                            "status": plan["nodes"][idx]["status"],
-                            "action": action,
-                            "action_input": action_input,
-                            "observation": observation
-                        })
-                        related_outputs.append({
-                            "subtask": subtask,
-                            "observation": observation
-                        })
+                if answer and "self_reflection" in answer and "score" in answer["self_reflection"]:
+                    print(colored(f"[step {answer_step}] current answer --> {answer}", color="light_magenta"))
+                    answer_step += 1
+                    print(f"ANSWER AGENT: {answer}")
+                    current_score = answer["self_reflection"]["score"]
+                    answer_scores.append(current_score)
+                    record_metric("score", score=current_score)
+                    if current_score > max_score:
+                        max_score = current_score
+                        best_answer = answer["answer"]
+                        best_trajectory = trajectory
+                        best_plan = plan
+                        best_reflection = answer["self_reflection"]
+                    
+                    if current_score >= 9:
+                        task_completed = True
                         break
-                    else:
-                        short_memory += SHORT_MEMORY_REFLECTION_TEMPLATE.format(
-                            step=tool_step+1,
-                            subtask=subtask,
-                            action=action,
-                            action_input=action_input,
-                            observation=observation,
-                            reflection=""
-                        ) + "\n\n"
                 else:
-                    execution = exe_best
-                    reflection = execution["self_reflection"] if execution and "self_reflection" in execution else ""
-                    action = execution["function"] if execution and "function" in execution else ""
-                    action_input = execution["parameters"] if execution and "parameters" in execution else ""
-                    short_memory += SHORT_MEMORY_REFLECTION_TEMPLATE.format(
-                        step=tool_step+1,
-                        subtask=subtask,
-                        action=action,
-                        action_input=action_input,
-                        observation="",
-                        reflection=reflection
-                    ) + "\n\n"
-        
-        answer_step = 0
-        for _ in range(args.max_step):
-            answer_agent_system_prompt = ANSWER_AGENT_SYSTEM_PROMPT
-            answer_agent_user_prompt = ANSWER_AGENT_USER_PROMPT.format(
-                task_description=query,
-                trajectory=trajectory
-            )
-            answer_response = base_agent.query_openai(
-                system_prompt=answer_agent_system_prompt,
-                user_prompt=answer_agent_user_prompt,
-                json_mode=True
-            )
-            total_steps += 1
-            answer = parse_json_response(answer_response, "ANSWER_AGENT---ERROR")
-
-            if answer and "self_reflection" in answer and "score" in answer["self_reflection"]:
-                print(colored(f"[step {answer_step}] current answer --> {answer}", color="light_magenta"))
-                answer_step += 1
-                print(f"ANSWER AGENT: {answer}")
-                current_score = answer["self_reflection"]["score"]
-                answer_scores.append(current_score)
-                if current_score > max_score:
-                    max_score = current_score
-                    best_answer = answer["answer"]
-                    best_trajectory = trajectory
-                    best_plan = plan
-                    best_reflection = answer["self_reflection"]
-                    
-                if current_score >= 9:
-                    task_completed = True
-                    break
-            else:
-                print("JSON format error")
+                    print("JSON format error")
+            sampler.cancel()
         
         if task_completed:
             break
         else:
             round_index += 1
-            long_memory += LONG_MEMORY_REFLECTION_TEMPLATE.format(
+            long_memory.add(
                 round_index=round_index,
                 trajectory=best_trajectory,
                 reflection=best_reflection
-            ) + "\n"
+            )
+            await save_checkpoint(None)
+
+    record_metric(
+        "query",
+        seconds=time.perf_counter() - start,
+        rounds=round_index + 1 if task_completed else round_index,
+        completed=task_completed,
+        total_steps=total_steps,
+        max_score=max_score,
+        plan_scores=plan_scores,
+        tool_scores=tool_scores,
+        answer_scores=answer_scores
+    )
 
     out_line = {
         "query_id": query_id,
@@ -344,42 +676,233 @@ def process_task(task_with_args):
         }   
     }
 
-    with open(output_file_path, 'w', encoding='utf-8') as fp:
-        json.dump(out_line, fp, ensure_ascii=False, indent=2)
+    if results_store is not None:
+        group = os.path.basename(os.path.dirname(output_file_path))
+        results_store.put(group, args.method, args.model_name, out_line)
+    else:
+        with open(output_file_path, 'w', encoding='utf-8') as fp:
+            json.dump(out_line, fp, ensure_ascii=False, indent=2)
+    if checkpoint is not None:
+        checkpoint.clear()
     
     return out_line
 
-def init_process(args):
+def process_task(task_ref):
+    """Answer one query; return whether an answer was written, not the answer, which the parent does not need."""
     global base_agent
-    base_agent = BaseAgent(model=args.model_name)
+    task = load_task(task_ref, worker_args.method, worker_args.model_name)
+    return asyncio.run(solve_task(task, worker_args, base_agent, partial(asyncio.to_thread, call_rapidapi, client=tool_client))) is not None
+
+def process_queue(_):
+    """Answer the queries of the work queue until it is empty; return how many this worker answered."""
+    queue = WorkQueue.from_args(worker_args)
+    answered = 0
+    for name, task_ref in queue.leases():
+        try:
+            process_task(task_ref)
+        except Exception as e:
+            print(colored(f"query {task_ref.query_id} failed: {e}", color="red"))
+            queue.finish(name, state="failed")
+            continue
+        queue.finish(name)
+        answered += 1
+    return answered
+
+def build_llm_cache(args):
+    if not args.llm_cache:
+        return None
+    return LLMCache(
+        args.llm_cache,
+        max_size_mb=args.llm_cache_max_size_mb,
+        max_age_days=args.llm_cache_max_age_days,
+        sample_policy=args.llm_cache_sample_policy
+    )
+
+def build_tool_cache(args):
+    global tool_cache
+    if args.tool_cache:
+        tool_cache = ToolCache(args.tool_cache, ttl_hours=args.tool_cache_ttl_hours, max_entries=args.tool_cache_max_entries)
+
+def load_tool_catalog(args):
+    global tool_catalog
+    if args.tool_index:
+        tool_catalog = ToolIndex(args.tool_index)
+
+def init_process(args):
+    global worker_args, base_agent, tool_client, rate_limiter, tool_health, run_metrics, results_store
+    # the arguments are sent once per worker, the tasks only carry a TaskRef
+    worker_args = args
+    load_tool_catalog(args)
+    run_metrics = Metrics.from_args(args)
+    results_store = ResultsStore.from_args(args)
+    if args.replay:
+        # everything is served from the run logs
+        base_agent = None
+        return
+    tool_client = ToolClient.from_args(args)
+    rate_limiter = RateLimiter.from_args(args)
+    tool_health = ToolHealth.from_args(args)
+    if args.llm_broker_address:
+        base_agent = BrokerAgent.from_args(args, cache=build_llm_cache(args))
+    else:
+        base_agent = BaseAgent.from_args(args, cache=build_llm_cache(args))
+    build_tool_cache(args)
+
+async def run_async(task_refs, args):
+    """
+    Run all tasks in a single event loop, with at most `args.async_concurrency`
+    queries in flight at the same time; return how many were processed.
+    """
+    global rate_limiter, tool_health, run_metrics, results_store
+    load_tool_catalog(args)
+    run_metrics = Metrics.from_args(args)
+    results_store = ResultsStore.from_args(args)
+    if args.replay:
+        # everything is served from the run logs
+        agent, client, call_tool = None, None, None
+    else:
+        agent = AsyncBaseAgent.from_args(args, cache=build_llm_cache(args))
+        build_tool_cache(args)
+        client = AsyncToolClient.from_args(args)
+        rate_limiter = RateLimiter.from_args(args)
+        tool_health = ToolHealth.from_args(args)
+        call_tool = partial(call_rapidapi_async, client=client)
+    progress = tqdm(total=len(task_refs))
+    pending = pending_tasks(task_refs, args, on_skip=progress.update)
+    processed = 0
+
+    async def worker():
+        # the workers share the iterator, a task is only checked and loaded once a worker is free
+        nonlocal processed
+        for task_ref in pending:
+            try:
+                await solve_task(load_task(task_ref, args.method, args.model_name), args, agent, call_tool)
+            except Exception as e:
+                print(colored(f"query {task_ref.query_id} failed: {e}", color="red"))
+            processed += 1
+            progress.update()
+
+    try:
+        await asyncio.gather(*[worker() for _ in range(args.async_concurrency)])
+    finally:
+        progress.close()
+        if client is not None:
+            await client.close()
+        if agent is not None and agent.cache is not None:
+            # the counters are printed from the database by main
+            agent.cache.flush()
+    return processed
+
+def collect_tasks(args):
+    """
+    TaskRefs of all the test sets of `args`, each test set shuffled, including the ones
+    already answered; see `pending_tasks`.
+    """
+    if args.tool_index:
+        if not os.path.exists(args.tool_index):
+            print(f"Building tool index {args.tool_index}")
+            build_tool_index(args.tool_root_dir, args.tool_index)
+        white_list = ToolIndex(args.tool_index).white_list()
+    else:
+        white_list = get_white_list(args.tool_root_dir)
 
-def main(num_processes):
-    args = parse_arg()
-        
     all_tasks = []
     for group in args.test_set:
         query_path = f'{args.query_dir}/{group}.json'
         answer_path = f"{args.answer_dir}/{group}"
-        task_list = generate_task_list(query_path, answer_path, args.tool_root_dir, args.method, args.model_name)
-        random.seed(42)
-        random.shuffle(task_list)
-        new_task_list = [task for task in task_list if not os.path.exists(os.path.join(task[-2], f"{task[2]}_{args.method}.json"))]
-        all_tasks.extend(new_task_list)
+        task_refs = generate_task_refs(query_path, answer_path, white_list)
+        # same order as random.seed(42); random.shuffle(task_list), without touching the global generator
+        order = list(range(len(task_refs)))
+        random.Random(42).shuffle(order)
+        all_tasks.extend(task_refs[idx] for idx in order)
+    return all_tasks
 
-    print(f"Total tasks: {len(all_tasks)}")
+def answered_check(args):
+    """A predicate telling whether a TaskRef is already answered, in the results database or as an answer file."""
+    store = ResultsStore.from_args(args)
+    done = {}
 
-    tasks_with_args = [(task, args) for task in all_tasks]
+    def answered(task_ref):
+        if store is None:
+            return os.path.exists(os.path.join(task_ref.answer_dir, f"{task_ref.query_id}_{args.method}.json"))
+        group = os.path.basename(task_ref.answer_dir)
+        if group not in done:
+            done[group] = store.done(group, args.method, args.model_name)
+        return str(task_ref.query_id) in done[group]
 
-    pool = mp.Pool(num_processes, initializer=init_process, initargs=(args,))
+    return answered
 
-    results = []
-    for result in tqdm(pool.imap_unordered(process_task, tasks_with_args), total=len(tasks_with_args)):
-        results.append(result)
-    
-    pool.close()
-    pool.join()
+def pending_tasks(task_refs, args, on_skip=None):
+    """
+    Yield the TaskRefs not answered yet. The check is made as the tasks are consumed, so
+    the first ones start without waiting for the whole test set to be checked.
+
+    :param on_skip: Called for every task skipped as already answered.
+    """
+    answered = answered_check(args)
+    for task_ref in task_refs:
+        if answered(task_ref):
+            if on_skip is not None:
+                on_skip()
+            continue
+        yield task_ref
+
+def main(num_processes):
+    args = parse_arg()
+    if not args.rate_limit_db or not args.tool_health_db:
+        # private to this run and user, so circuits opened by another run or against another service do not leak in;
+        # removed when the run exits, the pool workers are children of this process
+        state_dir = tempfile.mkdtemp(prefix="mirror_state_")
+        atexit.register(shutil.rmtree, state_dir, ignore_errors=True)
+        args.rate_limit_db = args.rate_limit_db or os.path.join(state_dir, "rate_limit.db")
+        args.tool_health_db = args.tool_health_db or os.path.join(state_dir, "tool_health.db")
+    all_tasks = collect_tasks(args)
+
+    print(f"Total tasks: {len(all_tasks)}, the ones already answered are skipped")
+
+    broker_manager = None
+    if args.runner == "async":
+        processed = asyncio.run(run_async(all_tasks, args))
+    else:
+        if args.num_candidates > 1 and args.candidate_sampling == "concurrent":
+            print(colored("The pool workers call the LLM from threads, cancelled candidates still complete and are billed; use --runner async to stop them", color="yellow"))
+        if args.llm_broker and not args.llm_broker_address and not args.replay:
+            # the broker unpickles what it receives, only the workers of this run may know the key
+            args.llm_broker_authkey = args.llm_broker_authkey or os.urandom(32).hex()
+            broker_manager = start_broker(args)
+            host, port = broker_manager.address
+            args.llm_broker_address = f"{host}:{port}"
+            print(f"LLM broker started on {args.llm_broker_address}")
+        pool = mp.Pool(num_processes, initializer=init_process, initargs=(args,))
+
+        if args.work_queue:
+            queue = WorkQueue.from_args(args)
+            print(f"Queued {queue.populate(all_tasks, skip=answered_check(args))} tasks in {queue.root}")
+            # every worker leases its own queries, so a worker that dies only loses its current lease
+            processed = sum(pool.imap_unordered(process_queue, range(num_processes)))
+            print(f"Work queue: {queue.stats()}")
+        else:
+            processed = 0
+            progress = tqdm(total=len(all_tasks))
+            for _ in pool.imap_unordered(process_task, pending_tasks(all_tasks, args, on_skip=progress.update)):
+                processed += 1
+                progress.update()
+            progress.close()
+        
+        pool.close()
+        pool.join()
 
-    print(f"Already processed {len(results)} task")
+    print(f"Already processed {processed} task")
+    if broker_manager is not None:
+        print(f"LLM broker: {broker_manager.broker().stats()}")
+        broker_manager.shutdown()
+    if args.llm_cache:
+        print(f"LLM cache: {build_llm_cache(args).stats()}")
+    if args.metrics_file and os.path.exists(args.metrics_file):
+        summary = summarize_metrics(args.metrics_file, run_id=args.run_id)
+        print_metrics_summary(summary)
+        if args.metrics_prom:
+            write_prometheus(summary, args.metrics_prom)
 
 if __name__ == '__main__':
     args = parse_arg()
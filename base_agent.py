@@ -1,7 +1,11 @@
+import os
 import time
+import asyncio
 from functools import wraps
-from openai import OpenAI, AzureOpenAI
+from openai import OpenAI, AsyncOpenAI, AzureOpenAI, AsyncAzureOpenAI
 from tenacity import retry
+from metrics import record_metric
+from llm_batcher import MicroBatcher
 
 def retry(max_attempts=3, delay=5):
     """
@@ -20,55 +24,183 @@ def retry(max_attempts=3, delay=5):
                 except Exception as e:
                     attempts += 1
                     print(f"Attempt {attempts}/{max_attempts} failed: {e}")
+                    record_metric("llm_retry", attempt=attempts, error=str(e))
                     time.sleep(delay)
             return None
         return wrapper
     return decorator
 
-class BaseAgent:
-    def __init__(self, model, azure_endpoint, api_key, api_version):
+def async_retry(max_attempts=3, delay=5):
+    """
+    The asyncio counterpart of `retry`, for decorating coroutine functions.
+
+    :param max_attempts: The maximum number of attempts. Default is 3.
+    :param delay: The delay (in seconds) between attempts. Default is 5.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            attempts = 0
+            while attempts < max_attempts:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    attempts += 1
+                    print(f"Attempt {attempts}/{max_attempts} failed: {e}")
+                    record_metric("llm_retry", attempt=attempts, error=str(e))
+                    await asyncio.sleep(delay)
+            return None
+        return wrapper
+    return decorator
+
+def build_chat_request(model, system_prompt="", user_prompt="", functions=None, function_call=None, temp=0.7, top_p=0.9, n=1):
+    if functions == None:
+        request = dict(
+            model=model, # gpt-3.5-turbo, gpt-3.5-turbo-0613, gpt-4-0613, gpt-4-1106-preview, gpt-3.5-turbo-1106, gpt-4-turbo-2024-04-09, gpt-4o-2024-05-13
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=temp,
+            top_p=top_p,
+            functions=functions,
+            function_call=function_call
+            )
+        if n > 1:
+            # only sent when sampling several candidates, so the requests (and cache keys) are otherwise unchanged
+            request["n"] = n
+        return request
+    return dict(
+        model=model, # gpt-3.5-turbo, gpt-3.5-turbo-0613, gpt-4-0613, gpt-4-1106-preview, gpt-3.5-turbo-1106, gpt-4-turbo-2024-04-09, gpt-4o-2024-05-13
+        messages=[
+            {"role": "user", "content": user_prompt}
+        ],
+        temperature=temp,
+        top_p=top_p,
+        functions=functions,
+        function_call="auto"
+        )
+
+def parse_chat_completion(completion, functions=None):
+    if functions == None:
+        if len(completion.choices) > 1:
+            return [choice.message.content for choice in completion.choices]
+        return completion.choices[0].message.content
+    return completion.choices[0].message
+
+class ChatAgent:
+    """
+    What the synchronous and the asyncio agents share: the client setup, the response
+    cache and the usage metrics. Subclasses provide `client_class` and `acomplete`.
+    """
+    def __init__(self, model, azure_endpoint=None, api_key=None, api_version=None, cache=None, base_url=None, batcher=None):
+        # unset endpoint settings are read from AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY and OPENAI_API_VERSION
         self.model = model
-        if "gpt" in model:
-            self.client = AzureOpenAI(
+        self.cache = cache
+        self.batcher = batcher
+        if base_url:
+            # any OpenAI-compatible server, e.g. vLLM, TGI or the llama.cpp server
+            self.client = self.client_class(openai=True)(
+                base_url=base_url,
+                api_key=api_key or os.environ.get("OPENAI_API_KEY", "EMPTY")
+                )
+        elif "gpt" in model:
+            self.client = self.client_class(openai=False)(
                 azure_endpoint=azure_endpoint,
                 api_key=api_key,
                 api_version=api_version
                 )
         else:
             print("MODEL_NAME_ERROR!!!")
-        
 
+    @classmethod
+    def from_args(cls, args, cache=None):
+        return cls(
+            model=args.model_name,
+            api_key=args.llm_api_key,
+            base_url=args.base_url,
+            cache=cache,
+            batcher=MicroBatcher.from_args(args)
+        )
 
-    @retry(max_attempts=3, delay=5)
-    def query_openai(self, system_prompt="", user_prompt="", json_mode=False, functions=None, function_call=None, temp=0.7, top_p=0.9):
-        if functions == None:
-            completion = self.client.chat.completions.create(
-                model=self.model, # gpt-3.5-turbo, gpt-3.5-turbo-0613, gpt-4-0613, gpt-4-1106-preview, gpt-3.5-turbo-1106, gpt-4-turbo-2024-04-09, gpt-4o-2024-05-13
-                response_format={"type": "json_object"},
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7,
-                top_p=0.9,
-                functions=functions,
-                function_call=function_call
-                )
+    def log_usage(self, completion):
+        """Record the token usage of a completion, including the prompt tokens served from the provider's prefix cache."""
+        usage = getattr(completion, "usage", None)
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        record_metric(
+            "llm_usage",
+            model=self.model,
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            cached_tokens=getattr(details, "cached_tokens", None) or 0
+        )
+
+    def cache_lookup(self, request, json_mode, functions, temp):
+        """Return (cache_key, sample, cached_response); cache_key is None if the call is not cacheable."""
+        if self.cache is None or functions is not None or request.get("n", 1) > 1:
+            return None, 0, None
+        cache_key = self.cache.make_key(request, json_mode)
+        sample = self.cache.sample_index(cache_key, temp)
+        return cache_key, sample, self.cache.get(cache_key, sample)
+
+    async def aquery_openai(self, system_prompt="", user_prompt="", json_mode=False, functions=None, function_call=None, temp=0.7, top_p=0.9, n=1):
+        request = build_chat_request(self.model, system_prompt, user_prompt, functions, function_call, temp, top_p, n)
+        cache_key, sample, response = self.cache_lookup(request, json_mode, functions, temp)
+        if response is not None:
+            record_metric("llm_cache_hit")
+            return response
+        start = time.perf_counter()
+        if self.batcher is not None:
+            response = await self.batcher.submit(self.acomplete, request, functions)
         else:
-            completion = self.client.chat.completions.create(
-                model=self.model, # gpt-3.5-turbo, gpt-3.5-turbo-0613, gpt-4-0613, gpt-4-1106-preview, gpt-3.5-turbo-1106, gpt-4-turbo-2024-04-09, gpt-4o-2024-05-13
-                messages=[
-                    {"role": "user", "content": user_prompt}
-                ],
-                temperature=0.7,
-                top_p=0.9,
-                functions=functions,
-                function_call="auto"
-                )
+            response = await self.acomplete(request, functions)
+        record_metric("llm_call", seconds=time.perf_counter() - start, ok=response is not None)
+        if cache_key is not None and response is not None:
+            self.cache.put(cache_key, response, sample)
+        return response
+
+
+class BaseAgent(ChatAgent):
+    def client_class(self, openai):
+        return OpenAI if openai else AzureOpenAI
+
+    def query_openai(self, system_prompt="", user_prompt="", json_mode=False, functions=None, function_call=None, temp=0.7, top_p=0.9, n=1):
+        request = build_chat_request(self.model, system_prompt, user_prompt, functions, function_call, temp, top_p, n)
+        cache_key, sample, response = self.cache_lookup(request, json_mode, functions, temp)
+        if response is not None:
+            record_metric("llm_cache_hit")
+            return response
+        start = time.perf_counter()
+        response = self.create_completion(request, functions)
+        record_metric("llm_call", seconds=time.perf_counter() - start, ok=response is not None)
+        if cache_key is not None and response is not None:
+            self.cache.put(cache_key, response, sample)
+        return response
+
+    @retry(max_attempts=3, delay=5)
+    def create_completion(self, request, functions=None):
+        completion = self.client.chat.completions.create(**request)
         self.log_usage(completion)
-        
-        if functions == None:
-            openai_response = completion.choices[0].message.content
-        else:
-            openai_response = completion.choices[0].message
-        return openai_response
\ No newline at end of file
+        return parse_chat_completion(completion, functions)
+
+    async def acomplete(self, request, functions=None):
+        # the synchronous client blocks, so it is run in a worker thread
+        return await asyncio.to_thread(self.create_completion, request, functions)
+
+
+class AsyncBaseAgent(ChatAgent):
+    """Agent on the asyncio clients, serving only `aquery_openai`."""
+    def client_class(self, openai):
+        return AsyncOpenAI if openai else AsyncAzureOpenAI
+
+    async def acomplete(self, request, functions=None):
+        return await self.acreate_completion(request, functions)
+
+    @async_retry(max_attempts=3, delay=5)
+    async def acreate_completion(self, request, functions=None):
+        completion = await self.client.chat.completions.create(**request)
+        self.log_usage(completion)
+        return parse_chat_completion(completion, functions)
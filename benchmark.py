@@ -0,0 +1,336 @@
+"""
+End-to-end throughput benchmark of the MIRROR loop against a mock OpenAI-compatible
+backend and the offline virtual tool service (virtual_server.py).
+
+The mock backend answers planner, executor and answer prompts with valid JSON at a
+configurable rate, with self-reflection scores drawn from a configurable distribution
+(which drives the number of retries), after a log-normal latency. The benchmark
+generates a synthetic tool tree and test set, runs process_task in a process pool for
+every --num_process setting and reports tasks/sec, per-query latency percentiles,
+LLM calls per query and CPU/RSS per worker.
+
+    python benchmark.py --num_queries 50 --num_process 1 4 8 --llm_latency_ms 800
+"""
+import os
+import re
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing as mp
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler
+import MIRROR
+from metrics import percentile
+from tool_registry import ToolRegistry
+from utils import fetch_api_json, standardize
+from virtual_server import VirtualToolService, LoadTestHTTPServer, start_virtual_server
+
+
+def parse_distribution(spec):
+    """Parse "9:0.6,7:0.4" into ([9, 7], [0.6, 0.4])."""
+    values, weights = [], []
+    for item in spec.split(","):
+        value, _, weight = item.partition(":")
+        values.append(int(value))
+        weights.append(float(weight or 1))
+    return values, weights
+
+
+class MockLLMBackend:
+    """
+    Produces chat completions for the three MIRROR agents, recognised by their system
+    prompts. Each request gets a random generator seeded by its content and the number
+    of times it was seen, so a benchmark run is reproducible.
+
+    The functions a prompt offers are found by looking up `function_names` (see
+    `dataset_function_names`) in it, which works for every --function_format; without
+    them only the "repr" format is recognized.
+    """
+    def __init__(self, latency_ms=500, latency_sigma=0.5, json_valid_rate=1.0, score_dist="9:1",
+                 dependency_rate=0.0, seed=0, function_names=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.json_valid_rate = json_valid_rate
+        self.scores, self.score_weights = parse_distribution(score_dist)
+        self.dependency_rate = dependency_rate
+        self.seed = seed
+        self.function_pattern = None
+        if function_names:
+            # longest first, so lookup_for_tool_12 is not found as lookup_for_tool_1
+            alternatives = "|".join(re.escape(name) for name in sorted(function_names, key=len, reverse=True))
+            self.function_pattern = re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)")
+        self.seen = defaultdict(int)
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def complete(self, request):
+        """Return (content, delay in seconds, usage) for a chat completion request."""
+        messages = request.get("messages", [])
+        system_prompt = messages[0]["content"] if len(messages) > 1 else ""
+        user_prompt = messages[-1]["content"] if messages else ""
+        key = hashlib.sha256(json.dumps(messages).encode("utf-8")).hexdigest()
+        with self.lock:
+            occurrence = self.seen[key]
+            self.seen[key] += 1
+        rng = random.Random(f"{self.seed}:{key}:{occurrence}")
+        delay = self.latency_ms / 1000 * rng.lognormvariate(0, self.latency_sigma) if self.latency_ms else 0
+        score = rng.choices(self.scores, self.score_weights)[0]
+        if self.function_pattern is not None:
+            function_names = list(dict.fromkeys(self.function_pattern.findall(user_prompt)))
+        else:
+            function_names = re.findall(r"'name': '([^']+)'", user_prompt)
+        function_names = function_names or ["unknown_function"]
+
+        if "planning agent" in system_prompt:
+            stage = "planner"
+            nodes = []
+            for idx, name in enumerate(dict.fromkeys(function_names)):
+                dependencies = [f"node{idx}"] if idx and rng.random() < self.dependency_rate else []
+                nodes.append({"id": f"node{idx + 1}", "status": 0, "subtask": f"Call {name} for the task", "function": name, "dependencies": dependencies})
+            content = {"nodes": nodes, "self_reflection": {"evaluation": "mock plan", "score": score}}
+        elif "task-execution agent" in system_prompt:
+            stage = "executor"
+            subtask = re.search(r"Call (\S+) for the task", user_prompt)
+            name = subtask.group(1) if subtask else rng.choice(function_names)
+            content = {"function": name, "parameters": {"q": "benchmark"}, "self_reflection": {"evaluation": "mock execution", "score": score}}
+        else:
+            stage = "answer"
+            content = {"answer": "Mock final answer.", "self_reflection": {"evaluation": "mock answer", "score": score}}
+
+        content = json.dumps(content)
+        invalid = rng.random() >= self.json_valid_rate
+        if invalid:
+            content = content[:len(content) // 2]
+        with self.lock:
+            if invalid:
+                self.stats[f"{stage}_invalid_json"] += 1
+            self.stats[stage] += 1
+        usage = {"prompt_tokens": len(system_prompt + user_prompt) // 4, "completion_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return content, delay, usage
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if "chat/completions" not in self.path:
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        with self.server.backend.lock:
+            # one per llm call, whatever its number of choices
+            self.server.backend.stats["requests"] += 1
+        # every choice of an n>1 request is sampled like a separate request
+        samples = [self.server.backend.complete(request) for _ in range(request.get("n", 1))]
+        usage = dict(samples[0][2], completion_tokens=sum(sample[2]["completion_tokens"] for sample in samples))
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        time.sleep(max(sample[1] for sample in samples))
+        body = json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [
+                {"index": idx, "message": {"role": "assistant", "content": sample[0]}, "finish_reason": "stop"}
+                for idx, sample in enumerate(samples)
+            ],
+            "usage": usage,
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock_llm(backend, host="127.0.0.1", port=0):
+    httpd = LoadTestHTTPServer((host, port), MockLLMHandler)
+    httpd.backend = backend
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def make_dataset(root, num_queries, tools_per_query, num_tools, seed=0):
+    """Write a synthetic tool tree, response schemas and test set under `root`."""
+    rng = random.Random(seed)
+    for sub in ("tools/Bench", "response_examples/Bench", "queries"):
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+    for idx in range(num_tools):
+        tool_name = f"tool_{idx}"
+        with open(os.path.join(root, "tools/Bench", f"{tool_name}.json"), "w") as writer:
+            json.dump({"tool_name": tool_name, "tool_description": f"Benchmark tool {idx}", "api_list": [{
+                "name": "Lookup",
+                "description": f"Look something up with benchmark tool {idx}.",
+                "required_parameters": [{"name": "q", "type": "STRING", "description": "What to look up.", "default": ""}],
+                "optional_parameters": [{"name": "limit", "type": "NUMBER", "description": "Maximum number of results.", "default": 10}],
+            }]}, writer)
+        with open(os.path.join(root, "response_examples/Bench", f"{tool_name}.json"), "w") as writer:
+            json.dump({"api_list": [{"name": "Lookup", "schema": {"result": "str", "count": "int", "items": [{"title": "str"}]}}]}, writer)
+    queries = []
+    for query_id in range(num_queries):
+        tools = rng.sample(range(num_tools), min(tools_per_query, num_tools))
+        queries.append({
+            "query_id": query_id,
+            "query": f"Benchmark query {query_id} using tools {tools}.",
+            "api_list": [{"category_name": "Bench", "tool_name": f"tool_{idx}", "api_name": "Lookup"} for idx in tools],
+        })
+    with open(os.path.join(root, "queries", "G_bench.json"), "w") as writer:
+        json.dump(queries, writer)
+
+
+def dataset_function_names(root):
+    """The names MIRROR gives the functions of the synthetic tools of `make_dataset`."""
+    tool_dir = os.path.join(root, "tools", "Bench")
+    names = []
+    for file_name in sorted(os.listdir(tool_dir)):
+        tool_name = os.path.splitext(file_name)[0]
+        data_dict = fetch_api_json(
+            {"api_list": [{"category_name": "Bench", "tool_name": tool_name, "api_name": "Lookup"}]},
+            os.path.join(root, "tools")
+        )
+        registry = ToolRegistry.from_api_list(data_dict["api_list"], [[standardize(tool_name), ""]])
+        names.extend(function_json["name"] for function_json in registry.functions)
+    return names
+
+
+def timed_process_task(task_ref):
+    start = time.time()
+    MIRROR.process_task(task_ref)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "latency": time.time() - start,
+        "pid": os.getpid(),
+        "cpu": usage.ru_utime + usage.ru_stime,
+        "rss_mb": usage.ru_maxrss / 1024,
+    }
+
+
+def run_benchmark(args, num_process, backend, tool_url):
+    answer_dir = tempfile.mkdtemp(prefix="mirror_bench_answer_")
+    state_dir = tempfile.mkdtemp(prefix="mirror_bench_state_")
+    mirror_args = MIRROR.parse_arg([
+        "--query_dir", os.path.join(args.work_dir, "queries"),
+        "--test_set", "G_bench",
+        "--tool_root_dir", os.path.join(args.work_dir, "tools"),
+        "--answer_dir", answer_dir,
+        "--model_name", "gpt-mock",
+        "--service_url", tool_url,
+        "--num_process", str(num_process),
+        "--max_round", str(args.max_round),
+        "--max_step", str(args.max_step),
+        "--rate_limit_per_minute", "0",
+        "--rate_limit_db", os.path.join(state_dir, "rate_limit.db"),
+        "--tool_health_db", os.path.join(state_dir, "tool_health.db"),
+    ] + args.mirror_args)
+    tasks = list(MIRROR.pending_tasks(MIRROR.collect_tasks(mirror_args), mirror_args))
+
+    llm_calls = backend.stats["requests"]
+    start = time.time()
+    with mp.Pool(num_process, initializer=MIRROR.init_process, initargs=(mirror_args,)) as pool:
+        results = list(pool.imap_unordered(timed_process_task, tasks))
+    wall = time.time() - start
+    llm_calls = backend.stats["requests"] - llm_calls
+    shutil.rmtree(answer_dir, ignore_errors=True)
+    shutil.rmtree(state_dir, ignore_errors=True)
+
+    workers = {}
+    for result in results:
+        workers[result["pid"]] = result
+    latencies = [result["latency"] for result in results]
+    return {
+        "num_process": num_process,
+        "tasks": len(results),
+        "wall_s": wall,
+        "tasks_per_s": len(results) / wall if wall else 0,
+        "latency_p50_s": percentile(latencies, 50),
+        "latency_p95_s": percentile(latencies, 95),
+        "latency_p99_s": percentile(latencies, 99),
+        "llm_calls_per_query": llm_calls / max(1, len(results)),
+        "cpu_s_per_worker": sum(worker["cpu"] for worker in workers.values()) / max(1, len(workers)),
+        "max_rss_mb_per_worker": max((worker["rss_mb"] for worker in workers.values()), default=0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput benchmark of the MIRROR loop with mock backends.")
+    parser.add_argument('--num_process', type=int, nargs='+', default=[1, 4], help='--num_process settings to benchmark')
+    parser.add_argument('--num_queries', type=int, default=20, required=False, help='number of synthetic queries')
+    parser.add_argument('--tools_per_query', type=int, default=4, required=False, help='apis available to each query')
+    parser.add_argument('--num_tools', type=int, default=50, required=False, help='size of the synthetic tool tree')
+    parser.add_argument('--max_round', type=int, default=5, required=False, help='passed to MIRROR')
+    parser.add_argument('--max_step', type=int, default=3, required=False, help='passed to MIRROR')
+    parser.add_argument('--llm_latency_ms', type=float, default=500, required=False, help='median latency of the mock llm')
+    parser.add_argument('--llm_latency_sigma', type=float, default=0.5, required=False, help='sigma of the log-normal llm latency')
+    parser.add_argument('--json_valid_rate', type=float, default=1.0, required=False, help='fraction of mock llm responses that are valid JSON')
+    parser.add_argument('--score_dist', type=str, default="9:0.7,7:0.3", required=False, help='self-reflection score distribution, as score:weight,...')
+    parser.add_argument('--dependency_rate', type=float, default=0.0, required=False, help='probability that a planned subtask depends on the previous one')
+    parser.add_argument('--tool_latency_ms', type=float, default=200, required=False, help='mean latency of the mock tool service')
+    parser.add_argument('--tool_latency_jitter_ms', type=float, default=100, required=False, help='jitter of the mock tool service latency')
+    parser.add_argument('--tool_error_rate', type=float, default=0.05, required=False, help='error rate of the mock tool service')
+    parser.add_argument('--seed', type=int, default=0, required=False, help='seed of the dataset and the mocks')
+    parser.add_argument('--work_dir', type=str, default=None, required=False, help='where to write the synthetic dataset, a temp directory by default')
+    parser.add_argument('--output', type=str, default=None, required=False, help='write the report as JSON to this file')
+    parser.add_argument('--mirror_args', nargs=argparse.REMAINDER, default=[], help='extra MIRROR.py arguments, e.g. --mirror_args --llm_cache ./cache.db')
+    args = parser.parse_args()
+
+    cleanup = args.work_dir is None
+    args.work_dir = args.work_dir or tempfile.mkdtemp(prefix="mirror_bench_")
+    make_dataset(args.work_dir, args.num_queries, args.tools_per_query, args.num_tools, seed=args.seed)
+
+    backend = MockLLMBackend(
+        latency_ms=args.llm_latency_ms,
+        latency_sigma=args.llm_latency_sigma,
+        json_valid_rate=args.json_valid_rate,
+        score_dist=args.score_dist,
+        dependency_rate=args.dependency_rate,
+        seed=args.seed,
+        function_names=dataset_function_names(args.work_dir)
+    )
+    llm_server = start_mock_llm(backend)
+    llm_url = f"http://127.0.0.1:{llm_server.server_address[1]}"
+    tool_service = VirtualToolService(
+        schema_root=os.path.join(args.work_dir, "response_examples"),
+        latency_ms=args.tool_latency_ms,
+        latency_jitter_ms=args.tool_latency_jitter_ms,
+        error_rate=args.tool_error_rate,
+        seed=args.seed
+    )
+    tool_server = start_virtual_server(tool_service, port=0)
+    tool_url = f"http://127.0.0.1:{tool_server.server_address[1]}/virtual"
+    # BaseAgent reads the endpoint from the environment, which the pool workers inherit
+    os.environ["AZURE_OPENAI_ENDPOINT"] = llm_url
+    os.environ["AZURE_OPENAI_API_KEY"] = "mock"
+    os.environ["OPENAI_API_VERSION"] = "2024-06-01"
+
+    reports = []
+    try:
+        for num_process in args.num_process:
+            reports.append(run_benchmark(args, num_process, backend, tool_url))
+    finally:
+        llm_server.shutdown()
+        tool_server.shutdown()
+        if cleanup:
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    columns = ["num_process", "tasks", "tasks_per_s", "latency_p50_s", "latency_p95_s", "latency_p99_s",
+               "llm_calls_per_query", "cpu_s_per_worker", "max_rss_mb_per_worker"]
+    print("\t".join(columns))
+    for report in reports:
+        print("\t".join(f"{report[column]:.3f}" if isinstance(report[column], float) else str(report[column]) for column in columns))
+    print(f"mock llm requests: {dict(backend.stats)}")
+    print(f"mock tool responses: {dict(tool_service.stats)}")
+    if args.output:
+        with open(args.output, "w") as writer:
+            json.dump({"config": {k: v for k, v in vars(args).items()}, "reports": reports}, writer, indent=2)
+
+
+if __name__ == "__main__":
+    main()
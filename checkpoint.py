@@ -0,0 +1,44 @@
+import os
+import json
+from utils import standardize
+
+
+class QueryCheckpoint:
+    """
+    State of a query saved by `solve_query` after every stage, so a query interrupted
+    by a dead or preempted worker resumes from its last finished stage instead of
+    starting over. The file is replaced atomically and removed once the answer of the
+    query is written.
+
+    :param path: The JSON file of the checkpoint.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_args(cls, args, output_file_path):
+        # a replayed query must make the recorded calls from the start
+        if not args.checkpoint_dir or args.replay:
+            return None
+        # sweeps of different models may share the directory, as they share a work queue root
+        group = os.path.basename(os.path.dirname(output_file_path))
+        return cls(os.path.join(args.checkpoint_dir, standardize(args.model_name), group, os.path.basename(output_file_path)))
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r", encoding="utf-8") as reader:
+            return json.load(reader)
+
+    def save(self, state):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as writer:
+            json.dump(state, writer, ensure_ascii=False, separators=(",", ":"))
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
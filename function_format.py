@@ -0,0 +1,131 @@
+import re
+import json
+import argparse
+import tempfile
+from collections import defaultdict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+FUNCTION_FORMATS = ["repr", "json", "signature"]
+
+# the description `api_json_to_openai_json` gives every function
+DESCRIPTION_PATTERN = re.compile(
+    r'^This is the subfunction for tool "(?P<tool>.*?)", you can use this tool\.'
+    r'(?:The description of this function is: "(?P<description>.*)")?$',
+    re.DOTALL
+)
+
+SIGNATURE_HEADER = (
+    "Every function below is a subfunction of the tool in the heading above it; call it by its full name. "
+    "Parameters marked with ? are optional, = gives an example value.\n"
+)
+
+
+def prune_optional_descriptions(function_json):
+    """A copy of an OpenAI function JSON without the descriptions of its optional parameters."""
+    parameters = function_json.get("parameters", {})
+    optional = set(parameters.get("optional", []))
+    if not optional:
+        return function_json
+    properties = {
+        name: {key: value for key, value in prop.items() if key != "description"} if name in optional else prop
+        for name, prop in parameters.get("properties", {}).items()
+    }
+    return dict(function_json, parameters=dict(parameters, properties=properties))
+
+
+def split_description(description):
+    """Return (tool, description) of a function description, tool is None if it has no boilerplate."""
+    match = DESCRIPTION_PATTERN.match(description or "")
+    if match is None:
+        return None, description or ""
+    return match.group("tool"), match.group("description") or ""
+
+
+def render_signature(function_json):
+    parameters = function_json.get("parameters", {})
+    required = set(parameters.get("required", []))
+    arguments, details = [], []
+    for name, prop in parameters.get("properties", {}).items():
+        argument = f"{name}{'' if name in required else '?'}: {prop.get('type', 'string')}"
+        if "example_value" in prop:
+            argument += f"={json.dumps(prop['example_value'], ensure_ascii=False)}"
+        arguments.append(argument)
+        if prop.get("description"):
+            details.append(f"    {name}: {prop['description']}")
+    _, description = split_description(function_json.get("description"))
+    line = f"- {function_json['name']}({', '.join(arguments)})"
+    if description:
+        line += f": {description}"
+    return "\n".join([line] + details)
+
+
+def render_functions(functions, function_format="repr", prune_optional=False):
+    """
+    Render the function list of a prompt.
+
+    "repr" is the Python repr of the OpenAI function JSONs, as the prompts always used;
+    "json" is the same list as minified JSON; "signature" groups the functions by tool,
+    so the "This is the subfunction for tool ..." boilerplate is written once per tool,
+    and writes each function as a one-line signature followed by its parameter
+    descriptions. With `prune_optional` the descriptions of optional parameters are dropped.
+    """
+    if prune_optional:
+        functions = [prune_optional_descriptions(function_json) for function_json in functions]
+    if function_format == "repr":
+        return str(functions)
+    if function_format == "json":
+        return json.dumps(functions, ensure_ascii=False, separators=(",", ":"))
+    if function_format == "signature":
+        by_tool = defaultdict(list)
+        for function_json in functions:
+            tool, _ = split_description(function_json.get("description"))
+            by_tool[tool].append(render_signature(function_json))
+        sections = [SIGNATURE_HEADER]
+        for tool, signatures in by_tool.items():
+            sections.append(f"## {tool if tool is not None else 'Other functions'}\n" + "\n".join(signatures))
+        return "\n".join(sections)
+    raise ValueError(f"Unknown function format: {function_format}")
+
+
+def count_tokens(text, model="gpt-4o"):
+    """Number of tokens of `text` with the tokenizer of `model`, or about 4 characters per token without tiktoken."""
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return len(encoding.encode(text))
+
+
+if __name__ == "__main__":
+    from utils import generate_task_list, fetch_api_json
+    from tool_registry import ToolRegistry
+
+    parser = argparse.ArgumentParser(description="Compare the prompt tokens of the function formats on a test set.")
+    parser.add_argument('--query_dir', type=str, default="./solvable_queries/test_instruction", required=False, help='the directory that contains test sets')
+    parser.add_argument('--test_set', type=str, default="G2_category", required=False, help='test set name')
+    parser.add_argument('--tool_root_dir', type=str, default="./server/tools", required=False, help='tool environment for the toolbench')
+    parser.add_argument('--model_name', type=str, default="gpt-4o-2024-05-13", required=False, help='model whose tokenizer is used')
+    parser.add_argument('--max_queries', type=int, default=200, required=False, help='number of queries to measure')
+    args = parser.parse_args()
+
+    tasks = generate_task_list(f"{args.query_dir}/{args.test_set}.json", tempfile.mkdtemp(), args.tool_root_dir, "", args.model_name)
+    totals = defaultdict(int)
+    for task in tasks[:args.max_queries]:
+        data_dict = fetch_api_json(task[3], tool_root_dir=args.tool_root_dir)
+        registry = ToolRegistry.from_api_list(data_dict["api_list"], task[-1])
+        for function_format in FUNCTION_FORMATS:
+            for prune_optional in (False, True):
+                totals[function_format, prune_optional] += count_tokens(registry.render(function_format, prune_optional), args.model_name)
+
+    count = max(1, min(len(tasks), args.max_queries))
+    if tiktoken is None:
+        print("tiktoken is not installed, token counts are estimated from the length")
+    print(f"{'format':<12}{'pruned':>8}{'tokens/query':>14}{'vs repr':>9}")
+    for (function_format, prune_optional), total in totals.items():
+        print(f"{function_format:<12}{str(prune_optional):>8}{total / count:>14.1f}{total / max(1, totals['repr', False]):>9.2f}")
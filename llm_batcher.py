@@ -0,0 +1,108 @@
+import json
+import asyncio
+from collections import defaultdict
+
+
+class MicroBatcher:
+    """
+    Client-side micro-batching of the chat completion requests of one event loop.
+
+    The chat completions API has no multi-prompt batch request, and OpenAI-compatible
+    servers such as vLLM and TGI already batch concurrent requests on the GPU
+    (continuous batching). What the client can do is collect the requests issued
+    within `window_ms` and release them together: identical requests are merged into
+    one request with `n` choices, so their prompt is only prefilled once, and distinct
+    requests are sent concurrently, at most `max_concurrency` at a time, so the server
+    sees them in the same scheduling step.
+
+    :param window_ms: How long the first request of a batch waits for others. Default is 10.
+    :param max_batch_size: A batch is released as soon as it holds this many requests. Default is 32.
+    :param max_concurrency: Maximum number of requests in flight. Default is no limit.
+    """
+    def __init__(self, window_ms=10, max_batch_size=32, max_concurrency=None):
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.loop = None
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.llm_batch_window_ms and not args.llm_max_concurrency:
+            return None
+        return cls(
+            window_ms=args.llm_batch_window_ms,
+            max_batch_size=args.llm_max_batch_size,
+            max_concurrency=args.llm_max_concurrency
+        )
+
+    def bind_loop(self):
+        # the pool runner starts a new event loop per query, asyncio primitives belong to one loop
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.queue = []
+            self.flush_handle = None
+            self.semaphore = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
+        return loop
+
+    async def submit(self, complete, request, functions=None):
+        """Send `request` with the coroutine function `complete(request, functions)` as part of the next batch."""
+        loop = self.bind_loop()
+        future = loop.create_future()
+        self.queue.append((complete, request, functions, future))
+        if len(self.queue) >= self.max_batch_size or not self.window_ms:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window_ms / 1000, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.queue = self.queue, []
+        groups = defaultdict(list)
+        for item in batch:
+            _, request, functions, _ = item
+            if functions is None:
+                key = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+            else:
+                # function calling responses are messages, not merged
+                key = id(item)
+            groups[key].append(item)
+        for items in groups.values():
+            self.loop.create_task(self.dispatch(items))
+
+    async def dispatch(self, items):
+        # waiters cancelled before the batch was sent, e.g. candidates that are no longer needed
+        items = [item for item in items if not item[3].done()]
+        if not items:
+            return
+        complete, request, functions, _ = items[0]
+        counts = [item[1].get("n", 1) for item in items]
+        merged = request if len(items) == 1 else dict(request, n=sum(counts))
+        try:
+            if self.semaphore is not None:
+                async with self.semaphore:
+                    response = await complete(merged, functions)
+            else:
+                response = await complete(merged, functions)
+        except Exception as e:
+            for item in items:
+                if not item[3].done():
+                    item[3].set_exception(e)
+            return
+
+        if len(items) == 1:
+            results = [response]
+        elif isinstance(response, list) and len(response) == sum(counts):
+            results, offset = [], 0
+            for count in counts:
+                results.append(response[offset] if count == 1 else response[offset:offset + count])
+                offset += count
+        else:
+            # the backend ignored n or failed, every request gets the same result
+            results = [response] * len(items)
+        for item, result in zip(items, results):
+            if not item[3].done():
+                item[3].set_result(result)
@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import heapq
+import random
+import asyncio
+import argparse
+import threading
+import itertools
+import contextvars
+import concurrent.futures
+from collections import defaultdict
+from multiprocessing.managers import BaseManager
+from openai import RateLimitError
+from base_agent import BaseAgent, AsyncBaseAgent, parse_chat_completion, retry
+from metrics import record_metric, current_labels
+
+# lower is served first: answers finish queries that are in flight, planner calls start new rounds
+STAGE_PRIORITY = {"answer": 0, "executor": 1, "planner": 2}
+
+# token usage of the completion made by the current broker task
+_usage = contextvars.ContextVar("broker_usage", default=None)
+
+
+def estimate_tokens(request):
+    """Rough prompt token count of a request, about 4 characters per token."""
+    text = "".join(message.get("content") or "" for message in request.get("messages", []))
+    return len(text) // 4 + 1
+
+
+class TokenBucket:
+    """Per-minute budget refilled continuously, which may be borrowed from the future."""
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until the bucket is no longer in debt."""
+        self.refill()
+        return 0 if self.tokens > 0 else (1 - self.tokens) * 60 / self.per_minute
+
+    def take(self, amount):
+        self.refill()
+        self.tokens -= amount
+
+    def drain(self):
+        """Drop the saved up budget, so requests resume at the sustained rate."""
+        self.refill()
+        self.tokens = min(self.tokens, 0)
+
+
+class BrokerBackend(AsyncBaseAgent):
+    """The agent of the broker, keeping the token usage of each completion for the worker that asked for it."""
+    async def acreate_completion(self, request, functions=None):
+        # not retried here: the broker backs off without holding an in-flight slot
+        completion = await self.client.chat.completions.create(**request)
+        self.log_usage(completion)
+        return parse_chat_completion(completion, functions)
+
+    def log_usage(self, completion):
+        usage = getattr(completion, "usage", None)
+        holder = _usage.get()
+        if usage is None or holder is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        holder.update(
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            cached_tokens=getattr(details, "cached_tokens", None) or 0
+        )
+
+
+class LLMBroker:
+    """
+    Single point through which all the pool workers of a run reach the LLM endpoint.
+
+    Requests are queued by stage priority (answer, then executor, then planner, in
+    arrival order within a stage) and dispatched from one event loop while the global
+    requests-per-minute and tokens-per-minute budgets and the in-flight limit allow.
+    Identical requests that are queued or in flight at the same time are sent once and
+    all callers get the response; by default only deterministic (temperature 0)
+    requests are coalesced, since sampled ones are expected to differ.
+
+    A failed request is put back in the queue after an exponential backoff with
+    jitter, releasing its in-flight slot meanwhile. A rate-limit error (429) also
+    pauses all dispatching for the backoff, or the Retry-After of the response, and
+    drains the requests-per-minute budget.
+
+    :param agent: The BrokerBackend making the completions.
+    :param rpm: Requests per minute allowed to the endpoint. Default is no limit.
+    :param tpm: Tokens per minute allowed to the endpoint. Default is no limit.
+    :param max_inflight: Maximum number of requests in flight. Default is 64.
+    :param coalesce: "deterministic", "always" or "never". Default is "deterministic".
+    :param max_attempts: Attempts of a request before its callers get None. Default is 5.
+    :param max_backoff: Upper bound of the backoff in seconds. Default is 60.
+    """
+    def __init__(self, agent, rpm=None, tpm=None, max_inflight=64, coalesce="deterministic", max_attempts=5, max_backoff=60):
+        self.agent = agent
+        self.rpm = TokenBucket(rpm) if rpm else None
+        self.tpm = TokenBucket(tpm) if tpm else None
+        self.max_inflight = max_inflight
+        self.coalesce = coalesce
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.queue = []
+        self.seq = itertools.count()
+        self.counters = defaultdict(int)
+        self.depth = defaultdict(int)
+        self.running = 0
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.wakeup = None
+        asyncio.run_coroutine_threadsafe(self.dispatch_loop(), self.loop)
+
+    def coalesce_key(self, request, functions):
+        if self.coalesce == "never" or functions is not None:
+            return None
+        if self.coalesce == "deterministic" and request.get("temperature", 1) != 0:
+            return None
+        return json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+
+    def complete(self, request, functions=None, stage=None):
+        """Return (response, usage) of a chat completion request; blocks the calling connection thread."""
+        key = self.coalesce_key(request, functions)
+        with self.lock:
+            self.counters["requests"] += 1
+            if key is not None and key in self.inflight:
+                self.counters["coalesced"] += 1
+                future = self.inflight[key]
+            else:
+                future = concurrent.futures.Future()
+                if key is not None:
+                    self.inflight[key] = future
+                priority = STAGE_PRIORITY.get(stage, len(STAGE_PRIORITY))
+                self.depth[stage] += 1
+                item = (priority, next(self.seq), stage, request, functions, key, future, 0)
+                self.loop.call_soon_threadsafe(self.enqueue, item)
+        return future.result()
+
+    def enqueue(self, item):
+        heapq.heappush(self.queue, item)
+        # the dispatch loop may not have started yet, it checks the queue before waiting
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def dispatch_loop(self):
+        self.wakeup = asyncio.Event()
+        slots = asyncio.Semaphore(self.max_inflight)
+        while True:
+            await slots.acquire()
+            while not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            # wait for the budgets before choosing, so a request arriving meanwhile with a higher priority goes first
+            while time.monotonic() < self.paused_until:
+                wait = self.paused_until - time.monotonic()
+                self.counters["budget_wait_seconds"] += wait
+                await asyncio.sleep(wait)
+            for bucket in (self.rpm, self.tpm):
+                while bucket is not None and bucket.wait_time() > 0:
+                    wait = bucket.wait_time()
+                    self.counters["budget_wait_seconds"] += wait
+                    await asyncio.sleep(wait)
+            item = heapq.heappop(self.queue)
+            estimate = estimate_tokens(item[3])
+            if self.rpm is not None:
+                self.rpm.take(1)
+            if self.tpm is not None:
+                self.tpm.take(estimate)
+            self.loop.create_task(self.run(item, estimate, slots))
+
+    def backoff(self, attempt, error):
+        """Seconds before retrying a request that failed `attempt` times with `error`."""
+        delay = min(self.max_backoff, 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+    async def run(self, item, estimate, slots):
+        priority, seq, stage, request, functions, key, future, attempt = item
+        with self.lock:
+            self.depth[stage] -= 1
+            self.running += 1
+        usage = {}
+        _usage.set(usage)
+        result = None
+        try:
+            response = await self.agent.acomplete(request, functions)
+            result = (response, usage or None)
+            if self.tpm is not None and usage:
+                # replace the estimate by the actual usage
+                self.tpm.take(usage["prompt_tokens"] + usage["completion_tokens"] - estimate)
+        except Exception as e:
+            attempt += 1
+            print(f"LLM broker request failed ({attempt}/{self.max_attempts}): {e}")
+            if attempt >= self.max_attempts:
+                result = (None, None)
+            else:
+                delay = self.backoff(attempt, e)
+                if isinstance(e, RateLimitError):
+                    with self.lock:
+                        self.counters["rate_limited"] += 1
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                    if self.rpm is not None:
+                        self.rpm.drain()
+                with self.lock:
+                    self.counters["retries"] += 1
+                    self.depth[stage] += 1
+                # keeps its place in the queue, coalesced callers keep waiting on the same future
+                self.loop.call_later(delay, self.enqueue, (priority, seq, stage, request, functions, key, future, attempt))
+        finally:
+            slots.release()
+            with self.lock:
+                self.running -= 1
+                if result is not None:
+                    self.counters["completed"] += 1
+                    if key is not None:
+                        self.inflight.pop(key, None)
+        if result is not None:
+            future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "queue_depth": {stage or "none": depth for stage, depth in self.depth.items() if depth},
+                "in_flight": self.running
+            }
+
+
+class BrokerManager(BaseManager):
+    pass
+
+
+broker = None
+
+
+def init_broker(model, base_url, api_key, rpm, tpm, max_inflight, coalesce):
+    global broker
+    agent = BrokerBackend(model=model, base_url=base_url, api_key=api_key)
+    broker = LLMBroker(agent, rpm=rpm, tpm=tpm, max_inflight=max_inflight, coalesce=coalesce)
+
+
+def get_broker():
+    return broker
+
+
+BrokerManager.register("broker", callable=get_broker, exposed=["complete", "stats"])
+
+
+def start_broker(args, address=("127.0.0.1", 0)):
+    """Start the broker in its own process and return its manager; `manager.address` is where workers connect."""
+    manager = BrokerManager(address=address, authkey=args.llm_broker_authkey.encode("utf-8"))
+    manager.start(
+        initializer=init_broker,
+        initargs=(args.model_name, args.base_url, args.llm_api_key, args.llm_rpm, args.llm_tpm, args.llm_broker_max_inflight, args.llm_broker_coalesce)
+    )
+    return manager
+
+
+def connect_broker(address, authkey):
+    host, _, port = address.rpartition(":")
+    manager = BrokerManager(address=(host, int(port)), authkey=authkey.encode("utf-8"))
+    manager.connect()
+    return manager.broker()
+
+
+class BrokerAgent(BaseAgent):
+    """Agent of a pool worker, sending its completions through the shared LLMBroker."""
+    def __init__(self, model, broker, cache=None, batcher=None):
+        self.model = model
+        self.cache = cache
+        self.batcher = batcher
+        self.broker = broker
+
+    @classmethod
+    def from_args(cls, args, cache=None):
+        return cls(
+            model=args.model_name,
+            broker=connect_broker(args.llm_broker_address, args.llm_broker_authkey),
+            cache=cache
+        )
+
+    @retry(max_attempts=3, delay=5)
+    def create_completion(self, request, functions=None):
+        # retried like the base method, so a lost broker connection fails this call and not the pool run;
+        # proxies open one connection per thread, so the concurrent subtasks of a query do not wait for each other
+        response, usage = self.broker.complete(request, functions, current_labels().get("stage"))
+        if usage:
+            record_metric("llm_usage", model=self.model, **usage)
+        return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an LLM broker that MIRROR workers reach with --llm_broker_address.")
+    parser.add_argument('--host', type=str, default="127.0.0.1", required=False, help='host to listen on')
+    parser.add_argument('--port', type=int, default=5055, required=False, help='port to listen on')
+    parser.add_argument('--model_name', type=str, default="gpt-4o-2024-05-13", required=False, help='the model name for the vllm model')
+    parser.add_argument('--base_url', type=str, default=None, required=False, help='base url of an OpenAI-compatible server, Azure OpenAI is used if not set')
+    parser.add_argument('--llm_api_key', type=str, default=None, required=False, help='api key of the llm endpoint, read from the environment if not set')
+    parser.add_argument('--llm_rpm', type=float, default=None, required=False, help='requests per minute allowed to the llm endpoint')
+    parser.add_argument('--llm_tpm', type=float, default=None, required=False, help='tokens per minute allowed to the llm endpoint')
+    parser.add_argument('--llm_broker_max_inflight', type=int, default=64, required=False, help='maximum number of llm requests in flight')
+    parser.add_argument('--llm_broker_coalesce', type=str, default="deterministic", choices=["deterministic", "always", "never"], required=False, help='which identical concurrent requests are sent once')
+    parser.add_argument('--llm_broker_authkey', type=str, default=os.environ.get("MIRROR_BROKER_AUTHKEY"), required=False, help='shared secret of the broker connections, required; the broker unpickles what it receives, so anyone knowing the key can run code in it')
+    args = parser.parse_args()
+    if not args.llm_broker_authkey:
+        parser.error("--llm_broker_authkey or MIRROR_BROKER_AUTHKEY is required")
+
+    manager = start_broker(args, address=(args.host, args.port))
+    print(f"LLM broker listening on {args.host}:{args.port}")
+    stats = manager.broker()
+    try:
+        while True:
+            time.sleep(60)
+            print(stats.stats())
+    except KeyboardInterrupt:
+        manager.shutdown()
@@ -0,0 +1,174 @@
+import json
+import time
+import hashlib
+import contextvars
+from contextlib import contextmanager
+from multiprocessing import util
+from sqlite_db import open_db, transaction
+
+# how often each request was made in the current query, see `sample_scope`
+_samples = contextvars.ContextVar("llm_cache_samples", default=None)
+
+
+@contextmanager
+def sample_scope():
+    """Count the repeated requests made in this context, e.g. one query, on their own and forget them on exit."""
+    token = _samples.set({})
+    try:
+        yield
+    finally:
+        _samples.reset(token)
+
+
+class LLMCache:
+    """
+    Persistent, content-addressed cache for chat completions, shared by all the pool
+    workers through a SQLite database in WAL mode.
+
+    Calls with temperature > 0 are replayed according to `sample_policy`:
+        - "nth": the Nth repeated call of the same request in a `sample_scope` (in
+          this process outside of one) returns the Nth cached sample, so reruns see
+          the same sequence of samples and the self-reflection retries of a round
+          still get fresh samples.
+        - "first": every repeated call returns the first cached sample, so a retry
+          with an unchanged prompt gets back the response it is retrying.
+
+    :param path: The SQLite database file.
+    :param max_size_mb: Evict least recently used entries above this size. Default is no limit.
+    :param max_age_days: Evict entries created before this age. Default is no limit.
+    :param sample_policy: "nth" or "first". Default is "nth".
+
+    The hit/miss counters and the access times of the hits are kept in memory and
+    written every `FLUSH_EVERY` lookups or `FLUSH_SECONDS`, at eviction and when the
+    process exits, instead of two write transactions per lookup.
+    """
+    EVICT_EVERY = 1000
+    FLUSH_EVERY = 100
+    FLUSH_SECONDS = 10
+
+    def __init__(self, path, max_size_mb=None, max_age_days=None, sample_policy="nth"):
+        if sample_policy not in ("first", "nth"):
+            raise ValueError(f"Unknown sample policy: {sample_policy}")
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.sample_policy = sample_policy
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.seen = {}
+        self.pending = {"hits": 0, "misses": 0}
+        self.accessed = {}
+        self.flushed = time.monotonic()
+        self.conn, self.lock = open_db(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT, sample INTEGER, response TEXT, size INTEGER, created REAL, accessed REAL, "
+            "PRIMARY KEY (key, sample))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+        self.conn.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0)")
+        self.evict()
+        # also run at the exit of the pool workers, unlike atexit
+        util.Finalize(self, self.flush, exitpriority=10)
+
+    @staticmethod
+    def make_key(request, json_mode=False):
+        """Hash of the full chat request (model, messages and sampling parameters) and json_mode."""
+        content = json.dumps({"request": request, "json_mode": json_mode}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def sample_index(self, key, temperature):
+        if not temperature or self.sample_policy == "first":
+            return 0
+        seen = _samples.get()
+        if seen is None:
+            seen = self.seen
+        with self.lock:
+            index = seen.get(key, 0)
+            seen[key] = index + 1
+        return index
+
+    def get(self, key, sample=0):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM completions WHERE key = ? AND sample = ?", (key, sample)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                self.pending["misses"] += 1
+            else:
+                self.hits += 1
+                self.pending["hits"] += 1
+                self.accessed[(key, sample)] = time.time()
+            flush = sum(self.pending.values()) >= self.FLUSH_EVERY or time.monotonic() - self.flushed >= self.FLUSH_SECONDS
+        if flush:
+            self.flush()
+        return None if row is None else json.loads(row[0])
+
+    def flush(self):
+        """Write the counters and access times collected since the last flush in one transaction."""
+        with self.lock:
+            if not any(self.pending.values()) and not self.accessed:
+                self.flushed = time.monotonic()
+                return
+        with transaction(self.conn, self.lock):
+            self.conn.executemany(
+                "UPDATE stats SET value = value + ? WHERE name = ?", [(count, name) for name, count in self.pending.items() if count]
+            )
+            self.conn.executemany(
+                "UPDATE completions SET accessed = ? WHERE key = ? AND sample = ?",
+                [(accessed, key, sample) for (key, sample), accessed in self.accessed.items()]
+            )
+            self.pending = {"hits": 0, "misses": 0}
+            self.accessed = {}
+            self.flushed = time.monotonic()
+
+    def put(self, key, response, sample=0):
+        content = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?)",
+                (key, sample, content, len(content), now, now)
+            )
+            self.puts += 1
+            evict = self.puts % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        # the least recently used entries are found with the access times of this process too
+        self.flush()
+        with self.lock:
+            if self.max_age is not None:
+                self.conn.execute("DELETE FROM completions WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_bytes is not None:
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+                if total > self.max_bytes:
+                    # drop least recently used entries until the cache fits again
+                    freed = 0
+                    victims = []
+                    for key, sample, size in self.conn.execute(
+                        "SELECT key, sample, size FROM completions ORDER BY accessed"
+                    ):
+                        if total - freed <= self.max_bytes:
+                            break
+                        victims.append((key, sample))
+                        freed += size
+                    self.conn.executemany("DELETE FROM completions WHERE key = ? AND sample = ?", victims)
+
+    def stats(self):
+        """Hit/miss counters of this process and of all processes sharing the database."""
+        self.flush()
+        with self.lock:
+            shared = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            entries = self.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": shared.get("hits", 0),
+            "total_misses": shared.get("misses", 0),
+            "entries": entries,
+        }
@@ -0,0 +1,128 @@
+import re
+import json
+from prompt import MEMORY_LESSONS_TEMPLATE
+from function_format import count_tokens
+
+LESSON_LENGTH = 160
+
+
+def shorten(value, length=LESSON_LENGTH):
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    text = " ".join(text.split())
+    return text if len(text) <= length else text[:length - 3] + "..."
+
+
+# lessons are (head, detail) pairs: the head (call, input, subtask, score) is what happened, the
+# detail the free text explaining it; the lesson is shown as head + detail
+
+
+def trajectory_lessons(round_index, trajectory, reflection):
+    """Lessons of a long memory entry: what every executed subtask did, and how the answer was judged."""
+    lessons = []
+    for record in trajectory or []:
+        call = f"{record.get('action')}({shorten(record.get('action_input'), 80)})"
+        if record.get("status") == 1:
+            lessons.append((f"{call} worked for \"{shorten(record.get('subtask'), 80)}\"", ""))
+        else:
+            lessons.append((f"{call} failed for \"{shorten(record.get('subtask'), 80)}\": ", shorten(record.get('observation'))))
+    if isinstance(reflection, dict) and reflection.get("evaluation"):
+        lessons.append((f"An answer scored {reflection.get('score')}: ", shorten(reflection['evaluation'])))
+    return lessons
+
+
+def step_lessons(step, subtask, action, action_input, observation, reflection):
+    """Lessons of a short memory entry: the result of a tool call, or why no call was made."""
+    if action and observation:
+        return [(f"{action}({shorten(action_input, 80)}) returned: ", shorten(observation))]
+    if isinstance(reflection, dict) and reflection.get("evaluation"):
+        return [(f"Choosing {action or 'no function'} was judged: ", shorten(reflection['evaluation']))]
+    return []
+
+
+def lesson_key(head, detail=""):
+    # numbers in the detail differ between otherwise identical errors, e.g. ids in error messages;
+    # the ones of the head (scores, call inputs) tell different lessons apart
+    return " ".join(head.lower().split()) + re.sub(r"\d+", "#", " ".join(detail.lower().split()))
+
+
+class Memory:
+    """
+    The reflection memory of an agent, rendered into its prompt within a token budget.
+
+    Every entry is kept as the text of `template` and as a list of one-line lessons.
+    Without a budget the memory renders all the entries verbatim, exactly as the
+    prompts always did. With a budget the most recent `keep_recent` entries stay
+    verbatim and the older ones are replaced by their lessons, deduplicated across
+    entries; if that is still too long the newest entries are condensed too and the
+    oldest lessons dropped. No LLM call is involved.
+
+    :param template: The template of an entry, filled with the fields passed to `add`.
+    :param lessons_fn: Function of the entry fields returning its lessons.
+    :param separator: Appended to every verbatim entry. Default is "\\n".
+    :param budget: Maximum number of tokens of the rendered memory. Default is no limit.
+    :param keep_recent: Number of the most recent entries kept verbatim. Default is 2.
+    """
+    def __init__(self, template, lessons_fn, separator="\n", budget=None, keep_recent=2):
+        self.template = template
+        self.lessons_fn = lessons_fn
+        self.separator = separator
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.entries = []
+        self.rendered = None
+
+    def add(self, **fields):
+        text = self.template.format(**fields) + self.separator
+        lessons = self.lessons_fn(**fields) if self.budget else []
+        self.entries.append({
+            "text": text,
+            "tokens": count_tokens(text) if self.budget else 0,
+            "lessons": [(head + detail, count_tokens(head + detail) + 2, lesson_key(head, detail)) for head, detail in lessons]
+        })
+        self.rendered = None
+
+    def restore(self, entries):
+        """Replace the entries, e.g. with the `entries` of a checkpointed memory."""
+        self.entries = [dict(entry, lessons=[tuple(lesson) for lesson in entry["lessons"]]) for entry in entries]
+        self.rendered = None
+
+    def condensed(self, entries):
+        """The deduplicated lessons of `entries`, oldest first, with how often each was seen."""
+        lessons = {}
+        for entry in entries:
+            for lesson, tokens, key in entry["lessons"]:
+                if key in lessons:
+                    lessons[key][2] += 1
+                else:
+                    lessons[key] = [lesson, tokens, 1]
+        return list(lessons.values())
+
+    def render(self):
+        if self.rendered is not None:
+            return self.rendered
+        if not self.budget:
+            self.rendered = "".join(entry["text"] for entry in self.entries)
+            return self.rendered
+
+        split = max(0, len(self.entries) - self.keep_recent)
+        while True:
+            recent = self.entries[split:]
+            lessons = self.condensed(self.entries[:split])
+            used = sum(entry["tokens"] for entry in recent) + sum(tokens for _, tokens, _ in lessons)
+            if used <= self.budget or split == len(self.entries):
+                break
+            split += 1
+        # drop the oldest lessons until the memory fits
+        while lessons and used > self.budget:
+            used -= lessons.pop(0)[1]
+
+        lesson_text = ""
+        if lessons:
+            lesson_text = MEMORY_LESSONS_TEMPLATE.format(
+                lessons="\n".join(f"- {lesson}" + (f" (x{count})" if count > 1 else "") for lesson, _, count in lessons)
+            ) + self.separator
+        self.rendered = lesson_text + "".join(entry["text"] for entry in recent)
+        return self.rendered
+
+    def __str__(self):
+        return self.render()
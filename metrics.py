@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+
+# (sink, labels) of the current query/round/stage; copied into asyncio tasks and to_thread workers
+_scope = contextvars.ContextVar("metrics_scope", default=None)
+
+
+class Metrics:
+    """
+    JSONL log of metric events. Every line is one event (an llm call, its token usage,
+    a retry, a JSON parse failure, a tool call, a stage or a query) carrying the labels
+    of the scope it was recorded in and the id of its run. All the processes of a run,
+    and possibly other runs, append to the same file; each event is written with a
+    single flush so lines do not interleave.
+
+    :param path: The JSONL file the events are appended to.
+    :param run_id: Written in every event, see `summarize_metrics`. Default is none.
+    """
+    def __init__(self, path, run_id=None):
+        self.path = path
+        self.run_id = run_id
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.writer = open(path, "a", encoding="utf-8")
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.metrics_file:
+            return None
+        return cls(args.metrics_file, run_id=args.run_id)
+
+    def write(self, event):
+        if self.run_id is not None:
+            event["run"] = self.run_id
+        line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        with self.lock:
+            self.writer.write(line)
+            self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+@contextmanager
+def metrics_scope(sink=None, **labels):
+    """Attach `labels` to the events recorded in this context; the outermost scope sets the sink."""
+    parent = _scope.get()
+    if parent is not None:
+        sink = sink or parent[0]
+        labels = {**parent[1], **labels}
+    token = _scope.set((sink, labels))
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def record_metric(event, **fields):
+    """Record an event in the current scope; a no-op outside of a scope with a sink."""
+    current = _scope.get()
+    if current is None or current[0] is None:
+        return
+    sink, labels = current
+    sink.write({"event": event, "time": time.time(), "pid": os.getpid(), **labels, **fields})
+
+
+def current_labels():
+    """The labels of the current scope, e.g. the stage of the llm call being made."""
+    current = _scope.get()
+    return dict(current[1]) if current is not None else {}
+
+
+@contextmanager
+def timed_metric(event, **fields):
+    """Record `event` with the wall time of the block in seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_metric(event, seconds=time.perf_counter() - start, **fields)
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def summarize_metrics(path, run_id=None):
+    """Aggregate the events of a metrics file, or only those of one run, per stage, tool status and query."""
+    stages = defaultdict(lambda: defaultdict(float))
+    stage_seconds = defaultdict(list)
+    llm_seconds = defaultdict(list)
+    scores = defaultdict(list)
+    tool_status = defaultdict(int)
+    tool_seconds = []
+    query_seconds = []
+    rounds = []
+    completed = 0
+    with open(path, "r", encoding="utf-8") as reader:
+        for line in reader:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if run_id is not None and event.get("run") != run_id:
+                continue
+            stage = event.get("stage", "none")
+            kind = event["event"]
+            if kind == "llm_call":
+                stages[stage]["llm_calls"] += 1
+                llm_seconds[stage].append(event["seconds"])
+                if not event.get("ok", True):
+                    stages[stage]["llm_failures"] += 1
+            elif kind == "llm_cache_hit":
+                stages[stage]["llm_cache_hits"] += 1
+            elif kind == "llm_usage":
+                for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                    stages[stage][key] += event.get(key) or 0
+            elif kind == "llm_retry":
+                stages[stage]["retries"] += 1
+            elif kind == "json_parse_failure":
+                stages[stage]["json_parse_failures"] += 1
+            elif kind == "score":
+                scores[stage].append(event["score"])
+            elif kind == "stage":
+                stage_seconds[stage].append(event["seconds"])
+            elif kind == "tool_call":
+                tool_status[event["status"]] += 1
+                tool_seconds.append(event["seconds"])
+            elif kind == "query":
+                query_seconds.append(event["seconds"])
+                rounds.append(event["rounds"])
+                completed += bool(event["completed"])
+
+    summary = {"stages": {}, "tools": {}, "queries": {}}
+    for stage in sorted(set(stages) | set(stage_seconds) | set(scores)):
+        values = dict(stages[stage])
+        values["seconds"] = sum(stage_seconds[stage])
+        values["llm_p50"] = percentile(llm_seconds[stage], 50)
+        values["llm_p95"] = percentile(llm_seconds[stage], 95)
+        values["mean_score"] = sum(scores[stage]) / len(scores[stage]) if scores[stage] else None
+        # share of the prompt tokens served from the prefix cache, for backends that report it
+        values["prefix_cache_hit_rate"] = values.get("cached_tokens", 0) / values["prompt_tokens"] if values.get("prompt_tokens") else 0
+        summary["stages"][stage] = values
+    summary["tools"] = {
+        "calls": len(tool_seconds),
+        "status": dict(tool_status),
+        "seconds": sum(tool_seconds),
+        "p50": percentile(tool_seconds, 50),
+        "p95": percentile(tool_seconds, 95)
+    }
+    summary["queries"] = {
+        "count": len(query_seconds),
+        "completed": completed,
+        "mean_rounds": sum(rounds) / len(rounds) if rounds else 0,
+        "p50": percentile(query_seconds, 50),
+        "p95": percentile(query_seconds, 95)
+    }
+    return summary
+
+
+def print_metrics_summary(summary):
+    print(f"{'stage':<10}{'calls':>8}{'seconds':>10}{'llm p50':>9}{'llm p95':>9}{'prompt':>10}{'cached':>10}{'hit rate':>9}{'compl.':>9}{'retries':>8}{'json err':>9}{'score':>7}")
+    for stage, values in summary["stages"].items():
+        score = values["mean_score"]
+        print(
+            f"{stage:<10}{int(values.get('llm_calls', 0)):>8}{values['seconds']:>10.1f}{values['llm_p50']:>9.2f}{values['llm_p95']:>9.2f}"
+            f"{int(values.get('prompt_tokens', 0)):>10}{int(values.get('cached_tokens', 0)):>10}{values['prefix_cache_hit_rate']:>9.1%}{int(values.get('completion_tokens', 0)):>9}"
+            f"{int(values.get('retries', 0)):>8}{int(values.get('json_parse_failures', 0)):>9}{score if score is not None else float('nan'):>7.2f}"
+        )
+    tools = summary["tools"]
+    print(f"tool calls: {tools['calls']}, {tools['seconds']:.1f}s, p50 {tools['p50']:.2f}s, p95 {tools['p95']:.2f}s, status codes {tools['status']}")
+    queries = summary["queries"]
+    print(f"queries: {queries['count']}, completed {queries['completed']}, mean rounds {queries['mean_rounds']:.2f}, p50 {queries['p50']:.1f}s, p95 {queries['p95']:.1f}s")
+
+
+def write_prometheus(summary, path):
+    """Write the summary in the Prometheus text exposition format, e.g. for the node exporter textfile collector."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_str = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+    stages = summary["stages"]
+    metric("mirror_llm_calls_total", "counter", "LLM calls per stage.",
+           [({"stage": s}, v.get("llm_calls", 0)) for s, v in stages.items()])
+    metric("mirror_llm_cache_hits_total", "counter", "LLM responses served from the cache per stage.",
+           [({"stage": s}, v.get("llm_cache_hits", 0)) for s, v in stages.items()])
+    metric("mirror_llm_tokens_total", "counter", "LLM tokens per stage and kind.",
+           [({"stage": s, "kind": k}, v.get(f"{k}_tokens", 0)) for s, v in stages.items() for k in ("prompt", "cached", "completion")])
+    metric("mirror_llm_prefix_cache_hit_ratio", "gauge", "Share of the prompt tokens served from the prefix cache of the backend, per stage.",
+           [({"stage": s}, v["prefix_cache_hit_rate"]) for s, v in stages.items()])
+    metric("mirror_llm_retries_total", "counter", "Failed LLM attempts that were retried, per stage.",
+           [({"stage": s}, v.get("retries", 0)) for s, v in stages.items()])
+    metric("mirror_json_parse_failures_total", "counter", "LLM responses that were not valid JSON, per stage.",
+           [({"stage": s}, v.get("json_parse_failures", 0)) for s, v in stages.items()])
+    metric("mirror_llm_call_seconds", "summary", "LLM call latency per stage.",
+           [({"stage": s, "quantile": q}, v[f"llm_p{int(q * 100)}"]) for s, v in stages.items() for q in (0.5, 0.95)])
+    metric("mirror_stage_seconds_total", "counter", "Wall time spent in each stage.",
+           [({"stage": s}, v["seconds"]) for s, v in stages.items()])
+    tools = summary["tools"]
+    metric("mirror_tool_calls_total", "counter", "Tool calls per status code.",
+           [({"status": status}, count) for status, count in tools["status"].items()])
+    metric("mirror_tool_call_seconds", "summary", "Tool call latency.",
+           [({"quantile": 0.5}, tools["p50"]), ({"quantile": 0.95}, tools["p95"])])
+    queries = summary["queries"]
+    metric("mirror_queries_total", "counter", "Solved queries.", [({}, queries["count"])])
+    metric("mirror_queries_completed_total", "counter", "Queries whose answer reached the score threshold.", [({}, queries["completed"])])
+    metric("mirror_query_seconds", "summary", "Query latency.",
+           [({"quantile": 0.5}, queries["p50"]), ({"quantile": 0.95}, queries["p95"])])
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as writer:
+        writer.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
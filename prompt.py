@@ -16,6 +16,7 @@ Decompose a complex task into manageable subtasks. Learn from previous failed tr
     - Ensure each subtask is feasible, clearly defined, and focused on a single aspect of the task.
     - Ensure that the collection of subtasks covers the entirety of the original task scope without redundancy or overlap.
     - Consider dependencies and constraints among subtasks.
+    - For each subtask, list in "dependencies" the ids of the subtasks whose outputs it needs. Leave it empty for subtasks that can run independently.
     - Assign each subtask to a function from the provided function list, allowing for multiple calls to the same function if necessary.
 
 3. **Self-Reflection**:
@@ -44,13 +45,15 @@ Decompose a complex task into manageable subtasks. Learn from previous failed tr
       "id": "node1",
       "status": 0,
       "subtask": "description of subtask",
-      "function": "corresponding function name"
+      "function": "corresponding function name",
+      "dependencies": []
     },
     {
       "id": "node2",
       "status": 0,
       "subtask": "description of another subtask",
-      "function": "corresponding function name"
+      "function": "corresponding function name",
+      "dependencies": ["node1"]
     }
   ],
   "self_reflection": {
@@ -190,6 +193,50 @@ ANSWER_AGENT_USER_PROMPT = """### Given Task:
 """
 
 
+# The same user prompts ordered from the most to the least stable content: the function
+# catalog, which is identical for every call of a query, comes first so consecutive
+# calls share a long prefix for the prompt caching of the provider or of vLLM.
+PLAN_AGENT_USER_PROMPT_PREFIX_STABLE = """### Available Functions:
+{functions}
+
+### Given Task:
+{task_description}
+
+### Previous Failed Trajectories:
+{long_memory}
+"""
+
+TOOL_AGENT_USER_PROMPT_PREFIX_STABLE = """### Available Functions:
+{functions}
+
+### Given Subtask:
+{subtask}
+
+### Results of Previous Subtasks:
+{related_outputs}
+
+### Previous Failed Trajectories:
+{short_memory}
+"""
+
+USER_PROMPTS = {
+    "default": {
+        "planner": PLAN_AGENT_USER_PROMPT,
+        "executor": TOOL_AGENT_USER_PROMPT,
+        "answer": ANSWER_AGENT_USER_PROMPT
+    },
+    "prefix_stable": {
+        "planner": PLAN_AGENT_USER_PROMPT_PREFIX_STABLE,
+        "executor": TOOL_AGENT_USER_PROMPT_PREFIX_STABLE,
+        "answer": ANSWER_AGENT_USER_PROMPT
+    }
+}
+
+
+def build_user_prompt(stage, layout="default", **parts):
+    return USER_PROMPTS[layout][stage].format(**parts)
+
+
 LONG_MEMORY_REFLECTION_TEMPLATE = """#### Memory {round_index}
 **Trajectory**:
 {trajectory}
@@ -209,4 +256,8 @@ SHORT_MEMORY_REFLECTION_TEMPLATE = """#### Memory {step}
 {observation}
 **Self Reflection**:
 {reflection}
-"""
\ No newline at end of file
+"""
+
+MEMORY_LESSONS_TEMPLATE = """#### Lessons from Earlier Memories
+{lessons}
+"""
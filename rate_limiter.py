@@ -0,0 +1,92 @@
+import time
+import asyncio
+import hashlib
+from sqlite_db import open_db, transaction
+
+
+def parse_tool_rate_limits(specs):
+    """Parse ["tool_name=per_minute[:burst]", ...] into {tool_name: (per_minute, burst)}."""
+    limits = {}
+    for spec in specs or []:
+        tool_name, _, value = spec.partition("=")
+        per_minute, _, burst = value.partition(":")
+        limits[tool_name] = (float(per_minute), float(burst) if burst else None)
+    return limits
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter shared by all the processes of a run, or of several runs
+    given the same file, through a SQLite database. Every call reserves one token from
+    the bucket of the toolbench key and, if configured, from the bucket of the tool; it
+    only has to wait when a bucket is empty, for as long as it takes to refill the
+    reserved token.
+
+    :param path: The SQLite database holding the buckets.
+    :param service: The tool service, tools of different services have separate buckets. Default is none.
+    :param per_minute: Calls per minute allowed for each toolbench key.
+    :param burst: Bucket size of each toolbench key. Default is 1.
+    :param tool_per_minute: Calls per minute allowed for each tool. Default is no per-tool limit.
+    :param tool_burst: Bucket size of each tool. Default is 1.
+    :param tool_limits: {tool_name: (per_minute, burst)} overriding the per-tool limit of some tools.
+    """
+    def __init__(self, path, service=None, per_minute=30, burst=1, tool_per_minute=None, tool_burst=1, tool_limits=None):
+        self.path = path
+        self.service = service
+        self.per_minute = per_minute
+        self.burst = burst
+        self.tool_per_minute = tool_per_minute
+        self.tool_burst = tool_burst
+        self.tool_limits = tool_limits or {}
+        self.conn, self.lock = open_db(self.path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            path=args.rate_limit_db,
+            service=args.service_url,
+            per_minute=args.rate_limit_per_minute,
+            burst=args.rate_limit_burst,
+            tool_per_minute=args.tool_rate_limit_per_minute,
+            tool_burst=args.tool_rate_limit_burst,
+            tool_limits=parse_tool_rate_limits(args.tool_rate_limits)
+        )
+
+    def buckets(self, api_key, tool_name):
+        buckets = []
+        if self.per_minute and self.per_minute > 0:
+            key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+            buckets.append((f"key:{key_hash}", self.per_minute, self.burst))
+        per_minute, burst = self.tool_limits.get(tool_name, (self.tool_per_minute, None))
+        if per_minute and per_minute > 0:
+            buckets.append((f"tool:{self.service}|{tool_name}" if self.service else f"tool:{tool_name}", per_minute, burst or self.tool_burst))
+        return buckets
+
+    def reserve(self, api_key, tool_name):
+        """Take one token from every bucket of the call and return how long to wait before calling."""
+        wait = 0
+        now = time.time()
+        with transaction(self.conn, self.lock):
+            for key, per_minute, burst in self.buckets(api_key, tool_name):
+                rate = per_minute / 60
+                row = self.conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                # the token may be borrowed from the future, the caller then waits for it
+                tokens -= 1
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+                self.conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key, tokens, now))
+        return wait
+
+    def acquire(self, api_key, tool_name):
+        wait = self.reserve(api_key, tool_name)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, api_key, tool_name):
+        wait = self.reserve(api_key, tool_name)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+from sqlite_db import open_db, transaction
+
+
+def spec_hash(function_json):
+    content = json.dumps(function_json, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ResultsStore:
+    """
+    SQLite store of the answers of a sweep, shared by all the pool workers, replacing
+    the one JSON file per query of the answer directory.
+
+    Answers are keyed by (group, method, model, query_id), so the queries already done
+    for a test set are found with one indexed query. The function specs of
+    `available_tools`, which are mostly the same across the queries of a test set, are
+    stored once by content hash and referenced from the answers. `export` writes the
+    per-file layout the StableToolBench evaluators read.
+
+    :param path: The SQLite database file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn, self.lock = open_db(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS specs (hash TEXT PRIMARY KEY, spec TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "grp TEXT, method TEXT, model TEXT, query_id TEXT, result TEXT, created REAL, "
+            "PRIMARY KEY (grp, method, model, query_id))"
+        )
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.results_db:
+            return None
+        return cls(args.results_db)
+
+    def put(self, group, method, model, out_line):
+        """Store the answer of a query; `available_tools` is replaced by the hashes of its specs."""
+        specs = {spec_hash(function_json): function_json for function_json in out_line.get("available_tools") or []}
+        result = dict(out_line, available_tools=[spec_hash(function_json) for function_json in out_line.get("available_tools") or []])
+        with transaction(self.conn, self.lock):
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO specs VALUES (?, ?)",
+                [(key, json.dumps(spec, ensure_ascii=False)) for key, spec in specs.items()]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (group, method, model, str(out_line["query_id"]), json.dumps(result, ensure_ascii=False), time.time())
+            )
+
+    def done(self, group, method, model):
+        """The ids (as strings) of the queries of a test set already answered by a method and model."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT query_id FROM results WHERE grp = ? AND method = ? AND model = ?", (group, method, model)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def results(self, group=None, method=None, model=None):
+        """Yield (group, method, model, out_line) with the specs of `available_tools` restored."""
+        conditions, params = [], []
+        for column, value in (("grp", group), ("method", method), ("model", model)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.conn.execute(f"SELECT grp, method, model, result FROM results{where} ORDER BY grp, query_id", params).fetchall()
+        specs = {}
+        for grp, row_method, row_model, result in rows:
+            out_line = json.loads(result)
+            missing = [key for key in out_line.get("available_tools") or [] if key not in specs]
+            if missing:
+                with self.lock:
+                    for key, spec in self.conn.execute(
+                        f"SELECT hash, spec FROM specs WHERE hash IN ({','.join('?' * len(missing))})", missing
+                    ):
+                        specs[key] = json.loads(spec)
+            out_line["available_tools"] = [specs[key] for key in out_line.get("available_tools") or []]
+            yield grp, row_method, row_model, out_line
+
+    def export(self, answer_dir, group=None, method=None, model=None):
+        """Write every answer to <answer_dir>/<group>/<query_id>_<method>.json, as the pool runner used to; return how many."""
+        count = 0
+        for grp, row_method, _, out_line in self.results(group, method, model):
+            os.makedirs(os.path.join(answer_dir, grp), exist_ok=True)
+            with open(os.path.join(answer_dir, grp, f"{out_line['query_id']}_{row_method}.json"), "w", encoding="utf-8") as fp:
+                json.dump(out_line, fp, ensure_ascii=False, indent=2)
+            count += 1
+        return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a results database to the per-file answer layout of the StableToolBench evaluators.")
+    parser.add_argument('--results_db', type=str, required=True, help='results database written with --results_db')
+    parser.add_argument('--answer_dir', type=str, required=True, help='directory to write <group>/<query_id>_<method>.json files to')
+    parser.add_argument('--group', type=str, default=None, required=False, help='only export this test set')
+    parser.add_argument('--method', type=str, default=None, required=False, help='only export this method')
+    parser.add_argument('--model_name', type=str, default=None, required=False, help='only export this model')
+    args = parser.parse_args()
+
+    count = ResultsStore(args.results_db).export(args.answer_dir, args.group, args.method, args.model_name)
+    print(f"Exported {count} answers to {args.answer_dir}")
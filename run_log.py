@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import threading
+from collections import defaultdict, deque
+
+
+class ReplayMissError(Exception):
+    pass
+
+
+def request_key(kind, request):
+    content = json.dumps([kind, request], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class RunLog:
+    """
+    Append-only JSONL log of the LLM and tool I/O of one query.
+
+    In "record" mode every response is appended with the hash of its request; tool
+    lines also keep the tool service payload, so the log can be fed to
+    virtual_server.py. In "replay" mode responses are served from the log: the Nth
+    call of a request gets the Nth recorded response, which makes replay
+    independent of the order in which concurrent subtasks issue their calls.
+    """
+    def __init__(self, path, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown run log mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.responses = defaultdict(deque)
+        if mode == "record":
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # a query is always recorded from scratch, a partial log of an interrupted run is dropped
+            self.writer = open(path, "w", encoding="utf-8")
+        else:
+            with open(path, "r", encoding="utf-8") as reader:
+                for line in reader:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.responses[entry["key"]].append(entry)
+
+    def record(self, kind, request, response, payload=None, status=None):
+        entry = {"kind": kind, "key": request_key(kind, request), "response": response}
+        if payload is not None:
+            entry["request"] = payload
+        if status is not None:
+            entry["status"] = status
+        with self.lock:
+            self.writer.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.writer.flush()
+
+    def replay(self, kind, request):
+        key = request_key(kind, request)
+        with self.lock:
+            if not self.responses[key]:
+                raise ReplayMissError(f"{self.path}: no recorded {kind} response left for request {key}")
+            return self.responses[key].popleft()
+
+    def close(self):
+        if self.mode == "record":
+            self.writer.close()
+
+
+class LoggedAgent:
+    """Agent wrapper recording or replaying `aquery_openai` through a RunLog."""
+    def __init__(self, agent, run_log):
+        self.agent = agent
+        self.run_log = run_log
+
+    async def aquery_openai(self, **kwargs):
+        if self.run_log.mode == "replay":
+            return self.run_log.replay("llm", kwargs)["response"]
+        response = await self.agent.aquery_openai(**kwargs)
+        self.run_log.record("llm", kwargs, response)
+        return response
+
+
+def logged_tool_caller(call_tool, run_log):
+    """Wrap a `call_rapidapi` coroutine function to record or replay its results through a RunLog."""
+    async def call(action_name, action_input, registry, args):
+        request = {"action_name": action_name, "action_input": action_input}
+        if run_log.mode == "replay":
+            entry = run_log.replay("tool", request)
+            return json.dumps(entry["response"]), entry["status"]
+        observation, status = await call_tool(action_name=action_name, action_input=action_input, registry=registry, args=args)
+        entry = registry.resolve(action_name)
+        payload = None
+        if entry is not None:
+            payload = registry.payload(entry, action_input, args.observ_compress_method, "")
+            payload.pop("toolbench_key")
+        run_log.record("tool", request, json.loads(observation), payload=payload, status=status)
+        return observation, status
+    return call
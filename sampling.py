@@ -0,0 +1,80 @@
+import asyncio
+from metrics import record_metric
+
+
+class CandidateSampler:
+    """
+    Source of the responses of a self-reflection retry loop, sampled `num_candidates`
+    at a time.
+
+    `next(**kwargs)` returns one response for the prompt in `kwargs`. When no sampled
+    candidate is left it starts a batch of up to `num_candidates` requests, either as
+    concurrent calls ("concurrent") or as one call with the `n` parameter ("n"), and
+    returns the candidates as they complete. The loop stops consuming as soon as a
+    candidate clears its score threshold and calls `cancel()`, which cancels the
+    requests still in flight. Only the asyncio clients (`AsyncBaseAgent`) stop on
+    cancel; the requests of a blocking client run in threads (`BaseAgent`, used by the
+    pool workers) still complete and are billed. With one candidate this is exactly
+    one call per `next`.
+
+    :param agent: Agent providing `aquery_openai`.
+    :param num_candidates: Number of candidates sampled at a time. Default is 1.
+    :param mode: "concurrent" or "n". Default is "concurrent".
+    :param max_calls: Total number of candidates the loop may consume, a batch never exceeds what is left.
+    """
+    def __init__(self, agent, num_candidates=1, mode="concurrent", max_calls=None):
+        self.agent = agent
+        self.num_candidates = max(1, num_candidates)
+        self.mode = mode
+        self.remaining = max_calls
+        self.pending = []
+        self.ready = []
+
+    def batch_size(self):
+        if self.remaining is None:
+            return self.num_candidates
+        return max(1, min(self.num_candidates, self.remaining))
+
+    async def start_batch(self, kwargs):
+        size = self.batch_size()
+        if self.remaining is not None:
+            self.remaining -= size
+        if size == 1:
+            self.ready.append(await self.agent.aquery_openai(**kwargs))
+        elif self.mode == "n":
+            responses = await self.agent.aquery_openai(n=size, **kwargs)
+            self.ready.extend(responses if isinstance(responses, list) else [responses])
+        else:
+            self.pending = [asyncio.create_task(self.agent.aquery_openai(**kwargs)) for _ in range(size)]
+
+    async def next(self, **kwargs):
+        if not self.ready and not self.pending:
+            await self.start_batch(kwargs)
+        if self.ready:
+            return self.ready.pop(0)
+        done, _ = await asyncio.wait(self.pending, return_when=asyncio.FIRST_COMPLETED)
+        # of the candidates completed together, the first one started is returned first
+        task = next(task for task in self.pending if task in done)
+        self.pending.remove(task)
+        return task.result()
+
+    def discard(self):
+        """Drop the candidates sampled for an outdated prompt, e.g. after the memory of the loop changed."""
+        self.cancel()
+        self.ready = []
+
+    def cancel(self):
+        """Cancel the requests still in flight, see the class docstring for which ones stop."""
+        if not self.pending:
+            return
+        cancelled = 0
+        for task in self.pending:
+            if task.done():
+                if not task.cancelled():
+                    # retrieve it so an unused failure is not reported as never retrieved
+                    task.exception()
+            else:
+                task.cancel()
+                cancelled += 1
+        record_metric("candidates_cancelled", count=cancelled)
+        self.pending = []
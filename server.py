@@ -1,6 +1,8 @@
 from pydantic import BaseModel
 import json
 import os
+import importlib
+from functools import lru_cache
 from typing import Union
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -27,12 +29,17 @@ def prepare_tool_name_and_url(tools_root, info):
     api_name = change_name(standardize(info.api_name)).split(f"_for_{tool_name}")[0]
     if not tool_name.endswith(f"_for_{standard_category}"):
         tool_name = standardize(info.tool_name)
-        code_string = f"""from {tools_root}.{standard_category}.{tool_name}.api import {api_name}"""
+        module_path = f"{tools_root}.{standard_category}.{tool_name}.api"
         tool_name += f"_for_{standard_category}"
     else:
         tmp_tool_name = standardize(tool_name.replace(f"_for_{standard_category}", ""))
-        code_string = f"""from {tools_root}.{standard_category}.{tmp_tool_name}.api import {api_name}"""
-    return tool_name, standard_category, api_name, code_string
+        module_path = f"{tools_root}.{standard_category}.{tmp_tool_name}.api"
+    return tool_name, standard_category, api_name, module_path
+
+@lru_cache(maxsize=4096)
+def load_api_function(module_path, api_name):
+    """Import the api module once and keep the api function, instead of exec-ing an import on every call."""
+    return getattr(importlib.import_module(module_path), api_name)
 
 def process_error(response):
     save_cache_flag = False
@@ -79,19 +86,18 @@ def process_error(response):
         return_dict = {"error": "", "response": response}
     return return_dict, save_cache_flag, switch_flag
 
-def run(toolbench_code_string, toolbench_api_name, toolbench_input_params_str):
+def run(module_path, api_name, input_params):
     # get observation
     success_flag = False
     switch_flag = False
     save_cache = False
-    exec(toolbench_code_string)
     try:
-        eval_func_str = f"{toolbench_api_name}({toolbench_input_params_str})"
-        new_func = eval(eval_func_str)
+        api_function = load_api_function(module_path, api_name)
+        new_func = api_function(**input_params)
         response, save_cache, switch_flag = process_error(new_func)
         success_flag = True
     except Exception as e:
-        response = {"error": f"Function executing {toolbench_code_string} error...\n{e}", "response": ""}
+        response = {"error": f"Function executing from {module_path} import {api_name} error...\n{e}", "response": ""}
         save_cache = False
     return success_flag, switch_flag, response, save_cache
 
@@ -110,62 +116,103 @@ def dict_shorten(origin: dict, schema: dict):
                             dict_shorten(item, schema[key][0]) # schema[key] should be a list with only one dict element
     return origin
 
+def dict_filter(origin: dict, schema: dict):
+    """
+    Non-mutating, iterative variant of `dict_shorten`. Builds a filtered copy of `origin`
+    with an explicit stack, and stops scanning a dict as soon as every key of its
+    schema has been found.
+    """
+    result = {}
+    stack = [(origin, schema, result)]
+    while stack:
+        source, source_schema, target = stack.pop()
+        remaining = len(source_schema)
+        for key, value in source.items():
+            if remaining == 0:
+                break
+            if key not in source_schema:
+                continue
+            remaining -= 1
+            sub_schema = source_schema[key]
+            if isinstance(value, dict) and isinstance(sub_schema, dict):
+                target[key] = {}
+                stack.append((value, sub_schema, target[key]))
+            elif isinstance(value, list) and value and isinstance(value[0], dict) \
+                    and isinstance(sub_schema, list) and sub_schema and isinstance(sub_schema[0], dict):
+                # schema[key] should be a list with only one dict element
+                target[key] = []
+                for item in value:
+                    if isinstance(item, dict):
+                        target[key].append({})
+                        stack.append((item, sub_schema[0], target[key][-1]))
+                    else:
+                        target[key].append(item)
+            else:
+                target[key] = value
+    return result
+
+@lru_cache(maxsize=1024)
+def load_tool_schemas(schema_root, category, tool_name):
+    """Response schemas of a tool by standardized api name, read once per tool and process."""
+    schema_path = os.path.join(schema_root, category, tool_name + ".json")
+    if not os.path.exists(schema_path):
+        return {}
+    with open(schema_path, "r") as reader:
+        schema_dicts = json.load(reader)
+    schemas = {}
+    for schema_dict in schema_dicts["api_list"]:
+        schema_api_name = change_name(standardize(schema_dict["name"]))
+        if schema_api_name not in schemas and len(schema_dict["schema"]) > 0:
+            schemas[schema_api_name] = schema_dict["schema"]
+    return schemas
+
 def observation_shorten(schema_root, response_dict, category, tool_name, api_name, strip_method):
-    print(random.random())
     if strip_method == "filter" or (strip_method == "random" and random.random() > 0.5):
         if isinstance(response_dict["response"], dict):
-            if os.path.exists(os.path.join(schema_root, category)):
-                if os.path.exists(os.path.join(schema_root, category, tool_name+".json")):
-                    schema_dicts = json.load(open(os.path.join(schema_root, category, tool_name+".json"), "r"))
-                    api_list = schema_dicts["api_list"]
-                    schema = None
-                    for schema_dict in api_list:
-                        schema_api_name = change_name(standardize(schema_dict["name"]))
-                        if schema_api_name == api_name and len(schema_dict["schema"]) > 0:
-                            schema = schema_dict["schema"]
-                            break
-                    if schema is not None:
-                        response_dict["response"] = dict_shorten(response_dict["response"], schema)
+            schema = load_tool_schemas(schema_root, category, tool_name).get(api_name)
+            if isinstance(schema, dict):
+                response_dict["response"] = dict_filter(response_dict["response"], schema)
     return str(response_dict["response"])
 
 
 def get_rapidapi_response(input_dict: dict, api_customization: bool=False, tools_root: str="data.toolenv.tools", schema_root: str="data/toolenv/response_examples"):
-    info = Info
-    info.category = input_dict['category']
-    info.tool_name = input_dict['tool_name']
-    info.api_name = input_dict['api_name']
-    info.tool_input = input_dict['tool_input']
-    info.strip = input_dict['strip']
+    # one instance per call, the local tool calls of concurrent subtasks run in threads
+    tool_input = input_dict['tool_input']
+    info = Info(
+        category=input_dict['category'],
+        tool_name=input_dict['tool_name'],
+        api_name=input_dict['api_name'],
+        # other JSON values are not a valid tool input, they fail to parse below
+        tool_input=tool_input if isinstance(tool_input, (str, dict)) else json.dumps(tool_input),
+        strip=input_dict['strip']
+    )
     rapidapi_key = input_dict['rapidapi_key']
 
-    tool_name, standard_category, api_name, code_string = prepare_tool_name_and_url(tools_root, info)
+    tool_name, standard_category, api_name, module_path = prepare_tool_name_and_url(tools_root, info)
     tool_input = info.tool_input
     
     strip_method = info.strip
     
-    try:
-        tool_input = json.loads(tool_input)
-    except Exception as e:
-        if tool_input == "":
-            tool_input = {}
-        else:
-            print(f"Can not parse tool input into json: {tool_input}")
-            response_dict = {"error": f"Tool input parse error...\n", "response": ""}
-            return response_dict
-    
-    input_params_str = ""
-    if len(tool_input) > 0:
-        for key, value in tool_input.items():
-            if isinstance(value, str):
-                input_params_str += f'{key}="{value}", '
+    if not isinstance(tool_input, dict):
+        try:
+            tool_input = json.loads(tool_input)
+        except Exception as e:
+            if tool_input == "":
+                tool_input = {}
             else:
-                input_params_str += f'{key}={value}, '
+                tool_input = None
+    if not isinstance(tool_input, dict):
+        print(f"Can not parse tool input into json: {info.tool_input}")
+        response_dict = {"error": f"Tool input parse error...\n", "response": "", "save_cache": False}
+        return response_dict
+    
+    input_params = dict(tool_input)
     if not api_customization:
-        input_params_str += f"toolbench_rapidapi_key='{rapidapi_key}'"
-    success_flag, switch_flag, response_dict, save_cache = run(code_string, api_name, input_params_str)
+        input_params["toolbench_rapidapi_key"] = rapidapi_key
+    success_flag, switch_flag, response_dict, save_cache = run(module_path, api_name, input_params)
     observation = observation_shorten(schema_root, response_dict, standard_category, tool_name.replace(f"_for_{standard_category}", ""), api_name, strip_method)
     result = str(observation)[:2048]
-    return {"error": response_dict['error'], "response": result}
+    return {"error": response_dict['error'], "response": result, "save_cache": save_cache}
 
 
 if __name__ == "__main__":
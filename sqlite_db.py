@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+def open_db(path):
+    """
+    Open the SQLite database shared by the pool workers at `path`; return (conn, lock).
+
+    The connection is in autocommit mode and WAL journal mode, so readers do not block
+    the writer of another process. It is used from the worker threads of
+    asyncio.to_thread too, always while holding `lock`.
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn, threading.Lock()
+
+
+@contextmanager
+def transaction(conn, lock):
+    """Run the block in a write transaction taken at once, so read-modify-write updates of other processes do not interleave."""
+    with lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
@@ -0,0 +1,74 @@
+import os
+import json
+import asyncio
+import pytest
+import benchmark
+import MIRROR
+from metrics import current_labels
+from utils import load_task
+
+
+class Crash(Exception):
+    pass
+
+
+class ScriptedAgent:
+    """Plans one subtask and fails the answer of the first round; raises Crash at call `crash_at`."""
+    def __init__(self, crash_at=None):
+        self.calls = []
+        self.crash_at = crash_at
+
+    async def aquery_openai(self, **kwargs):
+        labels = current_labels()
+        self.calls.append((labels["stage"], labels["round"]))
+        if len(self.calls) == self.crash_at:
+            raise Crash()
+        if labels["stage"] == "planner":
+            content = {"nodes": [{"id": 1, "subtask": "look it up", "function": "lookup", "dependencies": []}], "self_reflection": {"score": 9}}
+        elif labels["stage"] == "executor":
+            content = {"function": "lookup", "parameters": {"q": "x"}, "self_reflection": {"score": 9}}
+        else:
+            content = {"answer": f"answer {labels['round']}", "self_reflection": {"evaluation": "ok", "score": 9 if labels["round"] else 5}}
+        return json.dumps(content)
+
+
+async def call_tool(action_name, action_input, registry, args):
+    return json.dumps({"error": "", "response": "found it"}), 0
+
+
+@pytest.fixture
+def make_run(tmp_path):
+    benchmark.make_dataset(str(tmp_path), 1, 2, 4)
+    os.makedirs(tmp_path / "answers" / "G_bench")
+
+    def run(agent, checkpoint_dir=None):
+        argv = [
+            "--query_dir", str(tmp_path / "queries"), "--test_set", "G_bench", "--tool_root_dir", str(tmp_path / "tools"),
+            "--answer_dir", str(tmp_path / "answers"), "--max_round", "3", "--max_step", "1"
+        ]
+        if checkpoint_dir:
+            argv += ["--checkpoint_dir", checkpoint_dir]
+        args = MIRROR.parse_arg(argv)
+        task = load_task(MIRROR.collect_tasks(args)[0], args.method, args.model_name)
+        return asyncio.run(MIRROR.solve_task(task, args, agent, call_tool))
+
+    return run
+
+
+# the calls of an uninterrupted run: (stage, round)
+CALLS = [("planner", 0), ("executor", 0), ("answer", 0), ("planner", 1), ("executor", 1), ("answer", 1)]
+
+
+@pytest.mark.parametrize("crash_at", [1, 2, 3, 4, 5, 6])
+def test_resume_from_the_last_finished_stage(make_run, tmp_path, crash_at):
+    full = make_run(ScriptedAgent())
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    with pytest.raises(Crash):
+        make_run(ScriptedAgent(crash_at=crash_at), checkpoint_dir)
+
+    agent = ScriptedAgent()
+    resumed = make_run(agent, checkpoint_dir)
+    # the stage that crashed is run again, the ones finished before it are not
+    assert agent.calls == CALLS[crash_at - 1:]
+    assert resumed["answer"] == full["answer"]
+    assert not any(files for _, _, files in os.walk(checkpoint_dir))
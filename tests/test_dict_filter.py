@@ -0,0 +1,41 @@
+import copy
+from server import dict_filter, dict_shorten
+
+SCHEMA = {
+    "name": "",
+    "stats": {"followers": 0},
+    "items": [{"id": 0, "tags": [{"label": ""}]}],
+}
+
+RESPONSE = {
+    "name": "x",
+    "extra": 1,
+    "stats": {"followers": 3, "following": 4},
+    "items": [
+        {"id": 1, "price": 2, "tags": [{"label": "a", "color": "red"}]},
+        {"id": 2, "tags": []},
+    ],
+}
+
+
+def test_dict_filter_matches_dict_shorten():
+    expected = dict_shorten(copy.deepcopy(RESPONSE), SCHEMA)
+    assert dict_filter(RESPONSE, SCHEMA) == expected
+    assert expected == {
+        "name": "x",
+        "stats": {"followers": 3},
+        "items": [{"id": 1, "tags": [{"label": "a"}]}, {"id": 2, "tags": []}],
+    }
+
+
+def test_dict_filter_does_not_modify_its_input():
+    response = copy.deepcopy(RESPONSE)
+    dict_filter(response, SCHEMA)
+    assert response == RESPONSE
+
+
+def test_dict_filter_keeps_values_not_matching_the_schema_shape():
+    # dict_shorten would fail on these, the schema does not describe the nested values
+    assert dict_filter({"stats": {"a": 1}, "items": [{"id": 1}]}, {"stats": "", "items": ""}) == {
+        "stats": {"a": 1}, "items": [{"id": 1}]
+    }
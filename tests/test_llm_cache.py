@@ -0,0 +1,80 @@
+from llm_cache import LLMCache, sample_scope
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+def test_nth_policy_replays_the_samples_in_order(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.db"))
+    key = cache.make_key({"messages": ["hi"], "temperature": 0.7})
+    cache.put(key, "first", 0)
+    cache.put(key, "second", 1)
+    with sample_scope():
+        assert [cache.get(key, cache.sample_index(key, 0.7)) for _ in range(3)] == ["first", "second", None]
+    # a new query starts over with the first sample
+    with sample_scope():
+        assert cache.get(key, cache.sample_index(key, 0.7)) == "first"
+
+
+def test_scopes_count_apart_from_each_other(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.db"))
+    with sample_scope():
+        assert cache.sample_index("k", 0.7) == 0
+        with sample_scope():
+            assert cache.sample_index("k", 0.7) == 0
+        assert cache.sample_index("k", 0.7) == 1
+    assert cache.seen == {}
+
+
+def test_deterministic_calls_and_first_policy_use_the_first_sample(tmp_path):
+    cache = LLMCache(str(tmp_path / "llm.db"))
+    first = LLMCache(str(tmp_path / "llm.db"), sample_policy="first")
+    with sample_scope():
+        assert [cache.sample_index("k", 0) for _ in range(3)] == [0, 0, 0]
+        assert [first.sample_index("k", 0.7) for _ in range(3)] == [0, 0, 0]
+
+
+def test_stats_are_shared_between_instances(tmp_path):
+    path = str(tmp_path / "llm.db")
+    worker = LLMCache(path)
+    worker.put("a", {"content": "x"})
+    assert worker.get("a") == {"content": "x"}
+    assert worker.get("b") is None
+    worker.flush()
+    assert LLMCache(path).stats() == {"hits": 0, "misses": 0, "total_hits": 1, "total_misses": 1, "entries": 1}
+    assert worker.stats()["hits"] == 1
+
+
+def test_eviction_drops_the_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("llm_cache.time", clock)
+    # room for two of the 22 byte responses
+    cache = LLMCache(str(tmp_path / "llm.db"), max_size_mb=50 / 1024 / 1024)
+    for key in ("a", "b", "c"):
+        clock.now += 1
+        cache.put(key, f"response of key {key}")
+    clock.now += 1
+    assert cache.get("a") == "response of key a"
+    cache.evict()
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_eviction_by_age(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("llm_cache.time", clock)
+    cache = LLMCache(str(tmp_path / "llm.db"), max_age_days=1)
+    cache.put("old", "x")
+    clock.now += 86400 / 2
+    cache.put("new", "y")
+    clock.now += 86400 / 2 + 1
+    cache.evict()
+    assert cache.get("old") is None and cache.get("new") == "y"
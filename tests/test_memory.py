@@ -0,0 +1,69 @@
+from memory import Memory, step_lessons
+from function_format import count_tokens
+
+TEMPLATE = "step {step}: {action}({action_input}) -> {observation}; {reflection}"
+
+
+def add_steps(memory, count, observation="error 500 for id 123"):
+    for step in range(count):
+        memory.add(
+            step=step, subtask="find it", action="search", action_input={"q": "x"},
+            observation=observation, reflection={"evaluation": "failed", "score": 2}
+        )
+
+
+def test_render_without_budget_is_verbatim():
+    memory = Memory(TEMPLATE, step_lessons, separator="\n\n")
+    add_steps(memory, 3)
+    assert memory.render() == "".join(
+        TEMPLATE.format(step=step, action="search", action_input={"q": "x"}, observation="error 500 for id 123",
+                        reflection={"evaluation": "failed", "score": 2}) + "\n\n"
+        for step in range(3)
+    )
+
+
+def test_render_with_budget_condenses_older_entries():
+    memory = Memory(TEMPLATE, step_lessons, separator="\n\n", budget=10000, keep_recent=1)
+    for step in range(3):
+        memory.add(
+            step=step, subtask="find it", action="search", action_input={"q": "x"},
+            observation=f"error 500 for id {step}", reflection={"evaluation": "failed", "score": 2}
+        )
+    rendered = memory.render()
+    # the two older entries differ only in a number of their observation and become one lesson
+    assert "- search({\"q\": \"x\"}) returned: error 500 for id 0 (x2)" in rendered
+    assert rendered.endswith("step 2: search({'q': 'x'}) -> error 500 for id 2; {'evaluation': 'failed', 'score': 2}\n\n")
+    assert "step 0:" not in rendered and "step 1:" not in rendered
+
+
+def test_render_condenses_recent_entries_over_budget():
+    entry = TEMPLATE.format(
+        step=4, action="search", action_input={"q": "x"}, observation="error 500 for id 123",
+        reflection={"evaluation": "failed", "score": 2}
+    ) + "\n"
+    lesson = 'search({"q": "x"}) returned: error 500 for id 123'
+
+    # room for one verbatim entry besides the lessons, not for two
+    memory = Memory(TEMPLATE, step_lessons, budget=count_tokens(entry) + count_tokens(lesson) + 8, keep_recent=2)
+    add_steps(memory, 5)
+    rendered = memory.render()
+    assert f"- {lesson} (x4)" in rendered
+    assert rendered.endswith(entry) and "step 3:" not in rendered
+
+    memory = Memory(TEMPLATE, step_lessons, budget=count_tokens(lesson) + 8, keep_recent=2)
+    add_steps(memory, 5)
+    assert f"- {lesson} (x5)" in memory.render() and "step 4:" not in memory.render()
+
+    # the oldest lessons are dropped when even they do not fit
+    memory = Memory(TEMPLATE, step_lessons, budget=1, keep_recent=2)
+    add_steps(memory, 5)
+    assert memory.render() == ""
+
+
+def test_render_is_cached_until_the_next_add():
+    memory = Memory(TEMPLATE, step_lessons)
+    add_steps(memory, 1)
+    first = memory.render()
+    assert memory.render() is first
+    add_steps(memory, 1)
+    assert memory.render() != first
@@ -0,0 +1,96 @@
+import asyncio
+from MIRROR import plan_dependencies, run_subtasks, valid_plan_nodes
+
+
+def test_nodes_without_dependencies_run_sequentially():
+    nodes = [{"subtask": "a"}, {"subtask": "b"}, {"subtask": "c"}]
+    assert plan_dependencies(nodes) == [[], [0], [0, 1]]
+
+
+def test_dependencies_by_id():
+    nodes = [
+        {"id": 1, "subtask": "a", "dependencies": []},
+        {"id": 2, "subtask": "b", "dependencies": []},
+        {"id": 3, "subtask": "c", "dependencies": [2, 1]},
+    ]
+    assert plan_dependencies(nodes) == [[], [], [0, 1]]
+
+
+def test_unknown_and_self_dependencies_are_ignored():
+    nodes = [
+        {"id": "a", "subtask": "a", "dependencies": ["a", "missing"]},
+        {"id": "b", "subtask": "b", "dependencies": ["a", ["a"], {"id": "a"}]},
+    ]
+    assert plan_dependencies(nodes) == [[], [0]]
+
+
+def test_cycle_falls_back_to_sequential():
+    nodes = [
+        {"id": 1, "subtask": "a", "dependencies": [2]},
+        {"id": 2, "subtask": "b", "dependencies": [1]},
+    ]
+    assert plan_dependencies(nodes) == [[], [0]]
+
+
+def test_unhashable_ids_and_non_dict_nodes():
+    nodes = [
+        {"id": [1], "subtask": "a", "dependencies": []},
+        {"id": {"x": 1}, "subtask": "b", "dependencies": [[1]]},
+        "c",
+        {"id": 4, "subtask": "d", "dependencies": []},
+    ]
+    assert plan_dependencies(nodes) == [[], [], [0, 1], []]
+
+
+def test_valid_plan_nodes():
+    assert valid_plan_nodes([{"subtask": "a"}])
+    assert valid_plan_nodes([])
+    assert not valid_plan_nodes({"subtask": "a"})
+    assert not valid_plan_nodes([{"subtask": "a"}, "b"])
+    assert not valid_plan_nodes([{"id": 1}])
+
+
+def record(subtask):
+    return {"subtask": subtask, "observation": f"{subtask} done"}
+
+
+def test_run_subtasks_passes_upstream_outputs_in_plan_order():
+    nodes = [
+        {"id": 1, "subtask": "a", "dependencies": []},
+        {"id": 2, "subtask": "b", "dependencies": []},
+        {"id": 3, "subtask": "c", "dependencies": [2]},
+        {"id": 4, "subtask": "d", "dependencies": [3, 1]},
+    ]
+    seen = {}
+
+    async def run_subtask(idx, related_outputs):
+        seen[idx] = [output["subtask"] for output in related_outputs]
+        # the first node finishes last, results must still come back in plan order
+        await asyncio.sleep(0.05 if idx == 0 else 0)
+        return (idx, record(nodes[idx]["subtask"]))
+
+    results = asyncio.run(run_subtasks(nodes, run_subtask, max_workers=4))
+    assert [result[0] for result in results] == [0, 1, 2, 3]
+    assert seen == {0: [], 1: [], 2: ["b"], 3: ["a", "b", "c"]}
+
+
+def test_run_subtasks_skips_nodes_without_output_and_limits_workers():
+    nodes = [{"id": idx, "subtask": str(idx), "dependencies": []} for idx in range(4)]
+    nodes.append({"id": 4, "subtask": "4", "dependencies": [0, 1, 2, 3]})
+    running = 0
+    peak = 0
+    related = []
+
+    async def run_subtask(idx, related_outputs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if idx == 4:
+            related.extend(output["subtask"] for output in related_outputs)
+        return (idx, None if idx == 1 else record(str(idx)))
+
+    asyncio.run(run_subtasks(nodes, run_subtask, max_workers=2))
+    assert peak == 2
+    assert related == ["0", "2", "3"]
@@ -0,0 +1,70 @@
+import pytest
+from rate_limiter import RateLimiter, parse_tool_rate_limits
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("rate_limiter.time", clock)
+    return clock
+
+
+def test_waits_only_once_the_burst_is_used(tmp_path, clock):
+    limiter = RateLimiter(str(tmp_path / "rl.db"), per_minute=60, burst=2)
+    assert [limiter.reserve("key", "tool") for _ in range(4)] == [0, 0, 1, 2]
+
+
+def test_bucket_refills_up_to_the_burst(tmp_path, clock):
+    limiter = RateLimiter(str(tmp_path / "rl.db"), per_minute=30, burst=2)
+    limiter.reserve("key", "tool")
+    limiter.reserve("key", "tool")
+    clock.now += 2
+    # one token refilled at 0.5 per second
+    assert limiter.reserve("key", "tool") == 0
+    assert limiter.reserve("key", "tool") == pytest.approx(2)
+    clock.now += 60
+    assert [limiter.reserve("key", "tool") for _ in range(3)] == [0, 0, pytest.approx(2)]
+
+
+def test_the_slowest_bucket_decides(tmp_path, clock):
+    limiter = RateLimiter(
+        str(tmp_path / "rl.db"), service="http://svc", per_minute=60, burst=1,
+        tool_per_minute=6, tool_limits=parse_tool_rate_limits(["slow=1:2"])
+    )
+    assert limiter.reserve("key", "fast") == 0
+    clock.now += 1
+    assert limiter.reserve("key", "fast") == pytest.approx(9)
+    clock.now += 1
+    assert limiter.reserve("key", "slow") == 0
+    clock.now += 1
+    assert limiter.reserve("key", "slow") == 0
+    clock.now += 1
+    assert limiter.reserve("key", "slow") == pytest.approx(58)
+
+
+def test_buckets_are_shared_by_key_and_kept_apart_by_service(tmp_path, clock):
+    path = str(tmp_path / "rl.db")
+    first = RateLimiter(path, service="http://a", per_minute=None, tool_per_minute=60)
+    other_process = RateLimiter(path, service="http://a", per_minute=None, tool_per_minute=60)
+    other_service = RateLimiter(path, service="http://b", per_minute=None, tool_per_minute=60)
+    assert first.reserve("key", "tool") == 0
+    assert other_process.reserve("key", "tool") == 1
+    assert other_service.reserve("key", "tool") == 0
+
+
+def test_no_limit(tmp_path, clock):
+    limiter = RateLimiter(str(tmp_path / "rl.db"), per_minute=0)
+    assert [limiter.reserve("key", "tool") for _ in range(3)] == [0, 0, 0]
+
+
+def test_parse_tool_rate_limits():
+    assert parse_tool_rate_limits(["a=10", "b=1.5:3"]) == {"a": (10.0, None), "b": (1.5, 3.0)}
+    assert parse_tool_rate_limits(None) == {}
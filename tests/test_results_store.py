@@ -0,0 +1,27 @@
+from results_store import ResultsStore
+
+SPEC = {"name": "lookup_for_tool", "parameters": {}}
+
+
+def answer(query_id, text="answer"):
+    return {"query_id": query_id, "query": "q", "available_tools": [SPEC], "answer": {"final_answer": text}}
+
+
+def test_done_lists_the_answered_queries_of_a_sweep(tmp_path):
+    store = ResultsStore(str(tmp_path / "results.db"))
+    store.put("G1", "mirror", "gpt", answer(1))
+    store.put("G1", "mirror", "gpt", answer("2"))
+    store.put("G2", "mirror", "gpt", answer(3))
+    store.put("G1", "mirror", "other-model", answer(4))
+    store.put("G1", "other-method", "gpt", answer(5))
+    assert store.done("G1", "mirror", "gpt") == {"1", "2"}
+    assert store.done("G3", "mirror", "gpt") == set()
+
+
+def test_answers_are_shared_and_replaced(tmp_path):
+    path = str(tmp_path / "results.db")
+    ResultsStore(path).put("G1", "mirror", "gpt", answer(1, "first"))
+    store = ResultsStore(path)
+    store.put("G1", "mirror", "gpt", answer(1, "second"))
+    assert store.done("G1", "mirror", "gpt") == {"1"}
+    assert list(store.results()) == [("G1", "mirror", "gpt", answer(1, "second"))]
@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+from server import get_rapidapi_response
+
+API = '''
+def {api}(value, toolbench_rapidapi_key=None):
+    return {{"tool": "{tool}", "value": value}}
+'''
+
+
+def write_tool(root, category, tool, api):
+    tool_dir = root / "fake_tools" / category / tool
+    tool_dir.mkdir(parents=True)
+    (tool_dir / "api.py").write_text(API.format(api=api, tool=tool))
+
+
+def test_concurrent_calls_do_not_mix_their_inputs(tmp_path, monkeypatch):
+    write_tool(tmp_path, "Data", "weather", "forecast")
+    write_tool(tmp_path, "News", "headlines", "latest")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    calls = [
+        ({"category": category, "tool_name": tool, "api_name": api, "tool_input": {"value": idx}, "strip": "", "rapidapi_key": ""}, tool, idx)
+        for idx in range(2000)
+        for category, tool, api in [("Data", "weather", "forecast"), ("News", "headlines", "latest")]
+    ]
+
+    def call(item):
+        payload, tool, idx = item
+        return get_rapidapi_response(payload, tools_root="fake_tools", schema_root=str(tmp_path))["response"], tool, idx
+
+    with ThreadPoolExecutor(8) as pool:
+        for response, tool, idx in pool.map(call, calls):
+            assert response == str({"tool": tool, "value": idx})
+
+
+def test_tool_input_that_is_not_an_object(tmp_path, monkeypatch):
+    write_tool(tmp_path, "Data", "weather", "forecast")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for tool_input in (["value"], 3, None, "not json"):
+        response = get_rapidapi_response(
+            {"category": "Data", "tool_name": "weather", "api_name": "forecast", "tool_input": tool_input, "strip": "", "rapidapi_key": ""},
+            tools_root="fake_tools", schema_root=str(tmp_path)
+        )
+        assert response["error"].startswith("Tool input parse error")
+    response = get_rapidapi_response(
+        {"category": "Data", "tool_name": "weather", "api_name": "forecast", "tool_input": "", "strip": "", "rapidapi_key": ""},
+        tools_root="fake_tools", schema_root=str(tmp_path)
+    )
+    assert "missing 1 required positional argument" in response["error"]
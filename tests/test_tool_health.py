@@ -0,0 +1,95 @@
+import pytest
+from tool_health import ToolHealth
+
+FAILURE, RATE_LIMITED, OK = 5, 9, 0
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class NoJitter:
+    @staticmethod
+    def random():
+        return 0.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("tool_health.time", clock)
+    monkeypatch.setattr("tool_health.random", NoJitter)
+    return clock
+
+
+def test_circuit_opens_after_consecutive_failures(tmp_path, clock):
+    health = ToolHealth(str(tmp_path / "health.db"), failure_threshold=2, cooldown=10)
+    health.record("tool", FAILURE)
+    health.record("tool", OK)
+    health.record("tool", FAILURE)
+    assert health.before_call("tool") == (True, 0)
+    health.record("tool", FAILURE)
+    assert health.before_call("tool") == (False, 0)
+    assert health.before_call("other") == (True, 0)
+
+
+def test_half_open_probe_closes_the_circuit(tmp_path, clock):
+    health = ToolHealth(str(tmp_path / "health.db"), failure_threshold=1, cooldown=10)
+    health.record("tool", FAILURE)
+    clock.now += 9
+    assert health.before_call("tool") == (False, 0)
+    clock.now += 1
+    # one probe, the concurrent callers are rejected until it reports back
+    assert health.before_call("tool") == (True, 0)
+    assert health.before_call("tool") == (False, 0)
+    health.record("tool", OK)
+    assert health.before_call("tool") == (True, 0)
+    assert health.before_call("tool") == (True, 0)
+
+
+def test_failed_probe_reopens_with_a_doubled_cooldown(tmp_path, clock):
+    health = ToolHealth(str(tmp_path / "health.db"), failure_threshold=1, cooldown=10, max_cooldown=15)
+    health.record("tool", FAILURE)
+    clock.now += 10
+    assert health.before_call("tool") == (True, 0)
+    health.record("tool", FAILURE)
+    clock.now += 14
+    assert health.before_call("tool") == (False, 0)
+    clock.now += 1
+    assert health.before_call("tool") == (True, 0)
+    # a success resets the cooldown
+    health.record("tool", OK)
+    health.record("tool", FAILURE)
+    clock.now += 10
+    assert health.before_call("tool") == (True, 0)
+
+
+def test_rate_limits_back_off_without_opening_the_circuit(tmp_path, clock):
+    health = ToolHealth(str(tmp_path / "health.db"), failure_threshold=1, max_backoff=3)
+    waits = []
+    for _ in range(4):
+        health.record("tool", RATE_LIMITED)
+        waits.append(health.before_call("tool"))
+    assert waits == [(True, 1), (True, 2), (True, 3), (True, 3)]
+    health.record("tool", OK)
+    assert health.before_call("tool") == (True, 0)
+
+
+def test_disabled_breaker_still_backs_off(tmp_path, clock):
+    health = ToolHealth(str(tmp_path / "health.db"), failure_threshold=0)
+    for _ in range(5):
+        health.record("tool", FAILURE)
+    assert health.before_call("tool") == (True, 0)
+    health.record("tool", RATE_LIMITED)
+    assert health.before_call("tool") == (True, 1)
+
+
+def test_states_are_shared_per_service(tmp_path, clock):
+    path = str(tmp_path / "health.db")
+    ToolHealth(path, service="http://a", failure_threshold=1).record("tool", FAILURE)
+    assert ToolHealth(path, service="http://a", failure_threshold=1).before_call("tool") == (False, 0)
+    assert ToolHealth(path, service="http://b", failure_threshold=1).before_call("tool") == (True, 0)
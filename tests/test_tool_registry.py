@@ -0,0 +1,47 @@
+from tool_registry import ToolRegistry
+
+
+def make_registry():
+    registry = ToolRegistry()
+    registry.add({"name": "get_weather_for_weather_tool"}, "Data", "weather_tool", "get_weather")
+    registry.add({"name": "search_for_news_tool"}, "News", "news_tool", "search")
+    registry.add({"name": "search_for_web_tool"}, "Search", "web_tool", "search")
+    return registry
+
+
+def test_resolve_exact_name():
+    entry = make_registry().resolve("get_weather_for_weather_tool")
+    assert (entry.category, entry.tool_name, entry.api_name) == ("Data", "weather_tool", "get_weather")
+
+
+def test_resolve_aliases():
+    registry = make_registry()
+    assert registry.resolve("get_weather").name == "get_weather_for_weather_tool"
+    assert registry.resolve("GET_WEATHER_FOR_WEATHER_TOOL".lower()).name == "get_weather_for_weather_tool"
+
+
+def test_shared_alias_is_not_resolved():
+    # "search" is the api name of two tools
+    assert make_registry().resolve("search") is None
+
+
+def test_resolve_unique_suffix():
+    registry = make_registry()
+    assert registry.resolve("for_news_tool").name == "search_for_news_tool"
+    assert registry.resolve("_tool") is None
+
+
+def test_resolve_invalid_names():
+    registry = make_registry()
+    assert registry.resolve("") is None
+    assert registry.resolve(None) is None
+    assert registry.resolve(["search"]) is None
+    assert registry.resolve("unknown") is None
+
+
+def test_first_function_with_a_name_wins():
+    registry = ToolRegistry()
+    registry.add({"name": "f"}, "A", "tool_a", "f")
+    registry.add({"name": "f"}, "B", "tool_b", "f")
+    assert registry.resolve("f").category == "A"
+    assert len(registry.functions) == 2
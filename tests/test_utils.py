@@ -0,0 +1,29 @@
+import json
+import pytest
+from utils import iter_json_array, read_json_at
+
+ITEMS = [{"query_id": 1, "query": "héllo"}, {"query_id": 2, "query": "wörld ✓"}, 12345, "end"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1 << 20])
+def test_iter_json_array_yields_items_and_their_position(tmp_path, chunk_size):
+    path = tmp_path / "queries.json"
+    path.write_text(json.dumps(ITEMS, ensure_ascii=False, indent=2), encoding="utf-8")
+    items = list(iter_json_array(str(path), chunk_size=chunk_size))
+    assert [item for _, _, item in items] == ITEMS
+    for offset, length, item in items:
+        assert read_json_at(str(path), offset, length) == item
+
+
+def test_iter_json_array_empty(tmp_path):
+    path = tmp_path / "queries.json"
+    path.write_text(" [ ] ", encoding="utf-8")
+    assert list(iter_json_array(str(path))) == []
+
+
+@pytest.mark.parametrize("text", ['[{"a": 1}, {"b": ', '{"a": 1}', ""])
+def test_iter_json_array_rejects_incomplete_arrays(tmp_path, text):
+    path = tmp_path / "queries.json"
+    path.write_text(text, encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path), chunk_size=4))
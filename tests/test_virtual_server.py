@@ -0,0 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+from tool_cache import ToolCache
+from virtual_server import VirtualToolService
+
+
+def payload(idx):
+    return {"category": "Data", "tool_name": "weather", "api_name": "forecast", "tool_input": {"day": idx}, "strip": "truncate"}
+
+
+def test_concurrent_requests_are_counted_and_served_from_the_cache(tmp_path):
+    cache = ToolCache(str(tmp_path / "tools.db"))
+    for idx in range(0, 400, 2):
+        cache.put(payload(idx), {"error": "", "response": f"day {idx}"})
+    service = VirtualToolService(cache_db=str(tmp_path / "tools.db"), schema_root=str(tmp_path))
+
+    with ThreadPoolExecutor(16) as pool:
+        responses = list(pool.map(lambda idx: service.respond(payload(idx))[0], range(400)))
+    service.close()
+
+    assert [response["response"] for response in responses[::2]] == [f"day {idx}" for idx in range(0, 400, 2)]
+    # the other days have no recording and no schema
+    assert dict(service.stats) == {"recorded": 200, "missing": 200}
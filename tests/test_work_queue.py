@@ -0,0 +1,61 @@
+import os
+import time
+from utils import TaskRef
+from work_queue import WorkQueue
+
+
+def make_refs(tmp_path, count):
+    return [TaskRef("queries.json", idx * 10, 10, idx, str(tmp_path / "answer" / "G1"), None) for idx in range(count)]
+
+
+def test_populate_is_idempotent_and_skips(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"), worker_id="a")
+    refs = make_refs(tmp_path, 3)
+    assert queue.populate(refs, skip=lambda ref: ref.query_id == 1) == 2
+    assert queue.populate(refs, skip=lambda ref: ref.query_id == 1) == 0
+    assert queue.stats() == {"todo": 2, "leased": 0, "done": 0, "failed": 0}
+
+
+def test_claims_are_exclusive_and_in_order(tmp_path):
+    root = str(tmp_path / "queue")
+    first, second = WorkQueue(root, worker_id="a"), WorkQueue(root, worker_id="b")
+    first.populate(make_refs(tmp_path, 2))
+    name_a, ref_a = first.claim()
+    name_b, ref_b = second.claim()
+    assert (ref_a.query_id, ref_b.query_id) == (0, 1)
+    assert os.path.isabs(ref_a.query_path)
+    assert first.claim() is None and second.claim() is None
+    first.finish(name_a)
+    second.finish(name_b, state="failed")
+    assert first.stats() == {"todo": 0, "leased": 0, "done": 1, "failed": 1}
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    root = str(tmp_path / "queue")
+    dead = WorkQueue(root, lease_seconds=60, worker_id="dead")
+    alive = WorkQueue(root, lease_seconds=60, worker_id="alive")
+    dead.populate(make_refs(tmp_path, 1))
+    name, _ = dead.claim()
+    assert alive.requeue_expired() == 0
+
+    # no heartbeat for longer than the lease
+    lease_path = os.path.join(root, "leased", "dead", name)
+    old = time.time() - 120
+    os.utime(lease_path, (old, old))
+    assert alive.requeue_expired() == 1
+    assert alive.claim()[0] == name
+
+    # the dead worker finishing late moves the task out of the new lease, it must not run twice
+    dead.finish(name)
+    assert alive.stats() == {"todo": 0, "leased": 0, "done": 1, "failed": 0}
+
+
+def test_leases_returns_when_every_task_is_done(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"), poll_seconds=0.01, worker_id="a")
+    queue.populate(make_refs(tmp_path, 3))
+    names = []
+    for name, _ in queue.leases():
+        names.append(name)
+        queue.finish(name)
+    assert len(names) == 3
+    assert queue.stats()["done"] == 3
@@ -0,0 +1,102 @@
+import json
+import time
+import hashlib
+from sqlite_db import open_db
+
+
+def normalize_tool_input(tool_input):
+    """Canonical string form of a tool input, so equivalent inputs share a cache entry."""
+    if isinstance(tool_input, str):
+        if tool_input.strip() == "":
+            return "{}"
+        try:
+            tool_input = json.loads(tool_input)
+        except json.JSONDecodeError:
+            return tool_input.strip()
+    return json.dumps(tool_input, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def is_cacheable(response):
+    """
+    Whether a tool response may be cached. The local server marks responses with the
+    `save_cache` flag of `server.process_error`; responses from a service that does
+    not send the flag are cached only if they carry no error.
+    """
+    return bool(response.get("save_cache", response.get("error") == ""))
+
+
+class ToolCache:
+    """
+    Persistent cache of tool responses shared by all the pool workers, with a TTL and
+    least-recently-used eviction above `max_entries`.
+
+    :param path: The SQLite database file.
+    :param ttl_hours: Entries older than this are treated as missing. Default is no expiry.
+    :param max_entries: Maximum number of cached responses. Default is no limit.
+    """
+    EVICT_EVERY = 100
+
+    def __init__(self, path, ttl_hours=None, max_entries=None):
+        self.path = path
+        self.ttl = ttl_hours * 3600 if ttl_hours else None
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.conn, self.lock = open_db(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, created REAL, accessed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def make_key(payload):
+        content = json.dumps([
+            payload["category"],
+            payload["tool_name"],
+            payload["api_name"],
+            normalize_tool_input(payload["tool_input"]),
+            payload.get("strip", ""),
+        ], ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, payload):
+        key = self.make_key(payload)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] < now - self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, payload, response):
+        if not is_cacheable(response):
+            return
+        response = {k: v for k, v in response.items() if k != "save_cache"}
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (self.make_key(payload), json.dumps(response, ensure_ascii=False), now, now)
+            )
+            self.puts += 1
+            if self.puts % self.EVICT_EVERY == 0:
+                self.evict()
+
+    def evict(self):
+        # called with the lock held
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            self.conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
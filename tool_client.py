@@ -0,0 +1,101 @@
+import json
+import httpx
+
+
+def service_timeout(service_url):
+    # the virtual StableToolBench service may take a long time to simulate a response
+    return 120 if service_url.endswith("virtual") else 15
+
+
+def parse_service_response(response):
+    """
+    Return (response, None) on success, or (None, (observation, status_code)) if the
+    request failed, with the same observations and status codes as `call_rapidapi`.
+    """
+    if response.status_code != 200:
+        return None, (json.dumps({"error": f"request invalid, data error. status_code={response.status_code}", "response": ""}), 12)
+    try:
+        return response.json(), None
+    except json.JSONDecodeError:
+        return None, (json.dumps({"error": "JSON decoding error from the response."}), 12)
+    except Exception as e:
+        return None, (json.dumps({"error": f"Unexpected error: {str(e)}"}), 12)
+
+
+def timeout_error():
+    return None, (json.dumps({"error": f"Timeout error...", "response": ""}), 5)
+
+
+class ToolClient:
+    """
+    Client for the StableToolBench tool service, keeping a pool of keep-alive
+    connections that is shared by all the threads of a worker.
+
+    :param service_url: The tool service endpoint.
+    :param toolbench_key: The toolbench key sent with every request.
+    :param pool_size: Maximum number of open connections. Default is 10.
+    :param connect_timeout: Connect timeout in seconds. Default is 5.
+    :param read_timeout: Read timeout in seconds. Default depends on the service, see `service_timeout`.
+    :param keepalive_expiry: Seconds an idle connection is kept open. Default is 60.
+    :param http2: Multiplex concurrent requests over one HTTP/2 connection when the server supports it.
+    """
+    def __init__(self, service_url, toolbench_key="", pool_size=10, connect_timeout=5, read_timeout=None, keepalive_expiry=60, http2=False):
+        self.service_url = service_url
+        self.headers = {"toolbench_key": toolbench_key}
+        self.client = self.client_class()(**self.client_kwargs(pool_size, connect_timeout, read_timeout, keepalive_expiry, http2))
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            args.service_url,
+            args.toolbench_key,
+            pool_size=args.tool_pool_size,
+            connect_timeout=args.tool_connect_timeout,
+            read_timeout=args.tool_read_timeout,
+            http2=args.tool_http2
+        )
+
+    def client_class(self):
+        return httpx.Client
+
+    def client_kwargs(self, pool_size, connect_timeout, read_timeout, keepalive_expiry, http2):
+        if read_timeout is None:
+            read_timeout = service_timeout(self.service_url)
+        return dict(
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            http2=http2
+        )
+
+    def post(self, payload):
+        try:
+            response = self.client.post(self.service_url, json=payload, headers=self.headers)
+        except httpx.TimeoutException:
+            return timeout_error()
+        return parse_service_response(response)
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncToolClient(ToolClient):
+    """
+    asyncio variant of `ToolClient`, sharing one connection pool between all the
+    queries running in the event loop.
+    """
+    def client_class(self):
+        return httpx.AsyncClient
+
+    async def post(self, payload):
+        try:
+            response = await self.client.post(self.service_url, json=payload, headers=self.headers)
+        except httpx.TimeoutException:
+            return timeout_error()
+        return parse_service_response(response)
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,118 @@
+import json
+import time
+import random
+from sqlite_db import open_db, transaction
+
+# status code of the synthetic observation returned while a tool's circuit is open
+CIRCUIT_OPEN_STATUS = 13
+# API not working, unauthorized, unsubscribed, timeout and invalid service responses
+FAILURE_STATUSES = {5, 6, 7, 8, 12}
+# too many requests and rate limit errors
+RATE_LIMIT_STATUSES = {9, 10}
+
+
+def circuit_open_observation(tool):
+    return json.dumps({
+        "error": "Circuit open error...",
+        "response": f"The tool {tool} failed repeatedly and is temporarily disabled. Use another function or answer with the information you have."
+    })
+
+
+class ToolHealth:
+    """
+    Per-tool circuit breaker and rate-limit backoff, shared by all the processes of a
+    run through a SQLite database. Tools are keyed by the tool service too, so states
+    learned against one service (e.g. an error-injecting virtual server) do not apply
+    to another.
+
+    A tool's circuit opens after `failure_threshold` consecutive failures. Calls are
+    rejected while it is open; after the cooldown a single probe call is let through
+    (half-open) and closes the circuit on success, or reopens it with a doubled
+    cooldown. Rate-limit errors do not open the circuit but make the following calls
+    to the tool wait for an exponential backoff with jitter, also when the breaker is
+    disabled.
+
+    :param path: The SQLite database holding the tool states.
+    :param service: The tool service the states are learned against. Default is none.
+    :param failure_threshold: Consecutive failures that open the circuit. Default is 3, 0 disables the breaker.
+    :param cooldown: Seconds before an open circuit lets a probe through. Default is 60.
+    :param max_cooldown: Upper bound of the doubled cooldown. Default is 900.
+    :param max_backoff: Upper bound of the rate-limit backoff. Default is 64.
+    """
+    def __init__(self, path, service=None, failure_threshold=3, cooldown=60, max_cooldown=900, max_backoff=64):
+        self.path = path
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_backoff = max_backoff
+        self.conn, self.lock = open_db(self.path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tools (tool TEXT PRIMARY KEY, state TEXT, failures INTEGER, "
+            "cooldown REAL, opened_until REAL, backoff REAL, retry_after REAL)"
+        )
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            path=args.tool_health_db,
+            service=args.service_url,
+            failure_threshold=args.circuit_failure_threshold,
+            cooldown=args.circuit_cooldown
+        )
+
+    def transaction(self, tool, update):
+        """Run `update(state) -> (new_state, result)` atomically on the state of a tool."""
+        if self.service:
+            tool = f"{self.service}|{tool}"
+        with transaction(self.conn, self.lock):
+            row = self.conn.execute(
+                "SELECT state, failures, cooldown, opened_until, backoff, retry_after FROM tools WHERE tool = ?", (tool,)
+            ).fetchone()
+            state = dict(zip(["state", "failures", "cooldown", "opened_until", "backoff", "retry_after"], row)) if row else {
+                "state": "closed", "failures": 0, "cooldown": self.cooldown, "opened_until": 0, "backoff": 0, "retry_after": 0
+            }
+            state, result = update(state)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tools VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (tool, state["state"], state["failures"], state["cooldown"], state["opened_until"], state["backoff"], state["retry_after"])
+            )
+        return result
+
+    def before_call(self, tool):
+        """Return (allowed, wait): whether the tool may be called, and how long to back off first."""
+        now = time.time()
+
+        def update(state):
+            if state["state"] != "closed" and self.failure_threshold > 0:
+                if now < state["opened_until"]:
+                    return state, (False, 0)
+                # let one probe through; concurrent callers are rejected until it reports back
+                state["state"] = "half_open"
+                state["opened_until"] = now + state["cooldown"]
+            return state, (True, max(0, state["retry_after"] - now))
+
+        return self.transaction(tool, update)
+
+    def record(self, tool, status_code):
+        now = time.time()
+
+        def update(state):
+            if status_code in RATE_LIMIT_STATUSES:
+                state["backoff"] = min(self.max_backoff, state["backoff"] * 2 or 1)
+                state["retry_after"] = now + state["backoff"] * (1 + random.random())
+                if state["state"] == "half_open":
+                    state["opened_until"] = now
+            elif status_code in FAILURE_STATUSES and self.failure_threshold > 0:
+                state["failures"] += 1
+                if state["state"] == "half_open":
+                    state["cooldown"] = min(self.max_cooldown, state["cooldown"] * 2)
+                if state["state"] == "half_open" or state["failures"] >= self.failure_threshold:
+                    state["state"] = "open"
+                    state["opened_until"] = now + state["cooldown"] * (1 + 0.2 * random.random())
+                    print(f"Circuit of {tool} opened for {state['opened_until'] - now:.0f} seconds.")
+            elif status_code not in FAILURE_STATUSES:
+                state.update(state="closed", failures=0, cooldown=self.cooldown, backoff=0, retry_after=0)
+            return state, None
+
+        self.transaction(tool, update)
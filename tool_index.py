@@ -0,0 +1,130 @@
+import os
+import json
+import sqlite3
+import argparse
+import threading
+from tqdm import tqdm
+from utils import standardize, change_name, api_json_to_openai_json
+
+
+def build_tool_index(tool_root_dir, index_path):
+    """
+    Compile every tool file under `tool_root_dir` into a single SQLite index holding
+    the white list entries, the API specs in the `fetch_api_json` format and their
+    precomputed OpenAI function JSON.
+    """
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute(
+        "CREATE TABLE tools (key TEXT PRIMARY KEY, category TEXT, standard_tool_name TEXT, description TEXT)"
+    )
+    conn.execute(
+        "CREATE TABLE apis (category TEXT, tool TEXT, api TEXT, api_json TEXT, function_json TEXT, "
+        "PRIMARY KEY (category, tool, api))"
+    )
+    for cate in tqdm(os.listdir(tool_root_dir)):
+        if not os.path.isdir(os.path.join(tool_root_dir, cate)):
+            continue
+        for file in os.listdir(os.path.join(tool_root_dir, cate)):
+            if not file.endswith(".json"):
+                continue
+            standard_tool_name = file.split(".")[0]
+            with open(os.path.join(tool_root_dir, cate, file)) as reader:
+                js_data = json.load(reader)
+            # same semantics as get_white_list: a later file overrides an earlier one
+            conn.execute(
+                "INSERT OR REPLACE INTO tools VALUES (?, ?, ?, ?)",
+                (standardize(js_data["tool_name"]), cate, standard_tool_name, js_data["tool_description"])
+            )
+            if file[:-len(".json")] != standard_tool_name:
+                # fetch_api_json only opens <standardized tool name>.json files
+                continue
+            for api_dict in js_data.get("api_list", []):
+                api_json = {
+                    "category_name": cate,
+                    "api_name": api_dict["name"],
+                    "api_description": api_dict["description"],
+                    "required_parameters": api_dict["required_parameters"],
+                    "optional_parameters": api_dict["optional_parameters"],
+                    "tool_name": js_data["tool_name"],
+                }
+                function_json, _, _ = api_json_to_openai_json(api_json, standard_tool_name)
+                # same semantics as fetch_api_json: the first api with a given name wins
+                conn.execute(
+                    "INSERT OR IGNORE INTO apis VALUES (?, ?, ?, ?, ?)",
+                    (cate, standard_tool_name, change_name(standardize(api_dict["name"])),
+                     json.dumps(api_json, ensure_ascii=False), json.dumps(function_json, ensure_ascii=False))
+                )
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, index_path)
+
+
+class ToolIndex:
+    """
+    Read-only view of an index built by `build_tool_index`. The database is opened
+    lazily, memory-mapped, and can be shared by any number of pool workers.
+    """
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True, check_same_thread=False)
+                self.conn.execute("PRAGMA mmap_size=1073741824")
+            return self.conn.execute(sql, params).fetchall()
+
+    def white_list(self):
+        return {
+            key: {"description": description, "standard_tool_name": standard_tool_name}
+            for key, standard_tool_name, description in self.query(
+                "SELECT key, standard_tool_name, description FROM tools"
+            )
+        }
+
+    def fetch_api_json(self, query_json):
+        """Same as `utils.fetch_api_json`, without opening the tool files."""
+        data_dict = {"api_list": []}
+        for item in query_json["api_list"]:
+            cate_name = item["category_name"]
+            tool_name = standardize(item["tool_name"])
+            api_name = change_name(standardize(item["api_name"]))
+            rows = self.query(
+                "SELECT api_json FROM apis WHERE category = ? AND tool = ? AND api = ?",
+                (cate_name, tool_name, api_name)
+            )
+            if rows:
+                data_dict["api_list"].append(json.loads(rows[0][0]))
+            else:
+                print(api_name, [row[0] for row in self.query(
+                    "SELECT api FROM apis WHERE category = ? AND tool = ?", (cate_name, tool_name)
+                )])
+
+        if data_dict["api_list"] == []:
+            data_dict["api_list"] = query_json["api_list"]
+        return data_dict
+
+    def openai_function(self, api_json, standard_tool_name):
+        """Same as `utils.api_json_to_openai_json`, using the precomputed function JSON when available."""
+        pure_api_name = change_name(standardize(api_json["api_name"]))
+        rows = self.query(
+            "SELECT function_json FROM apis WHERE category = ? AND tool = ? AND api = ?",
+            (api_json.get("category_name"), standard_tool_name, pure_api_name)
+        )
+        if not rows:
+            return api_json_to_openai_json(api_json, standard_tool_name)
+        return json.loads(rows[0][0]), api_json["category_name"], pure_api_name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tool_root_dir', type=str, default="./server/tools", required=False, help='tool environment for the toolbench')
+    parser.add_argument('--index_path', type=str, default="./server/tool_index.db", required=False, help='output path of the compiled tool index')
+    args = parser.parse_args()
+    build_tool_index(args.tool_root_dir, args.index_path)
+    print(f"Tool index written to {args.index_path}")
@@ -0,0 +1,91 @@
+import json
+from functools import lru_cache
+from collections import namedtuple
+from utils import api_json_to_openai_json
+from function_format import render_functions
+
+ToolEntry = namedtuple("ToolEntry", ["name", "category", "tool_name", "api_name"])
+
+
+@lru_cache(maxsize=65536)
+def cached_openai_json(api_json_str, standard_tool_name):
+    return api_json_to_openai_json(json.loads(api_json_str), standard_tool_name)
+
+
+def openai_function_spec(api_json, standard_tool_name):
+    """
+    Memoized `api_json_to_openai_json`, shared by all the tasks of a process.
+    The returned function JSON is shared between callers and must not be modified.
+    """
+    return cached_openai_json(json.dumps(api_json, sort_keys=True, ensure_ascii=False), standard_tool_name)
+
+
+class ToolRegistry:
+    """
+    The functions available to one task, with O(1) resolution of the function name
+    chosen by the executor to the tool it calls.
+
+    Besides the exact function name, a function can be found by its untruncated name
+    (function names are cut to 64 characters), by its pure API name, or by a unique
+    suffix of its name. Aliases shared by several functions are not resolved.
+    """
+    def __init__(self):
+        self.functions = []
+        self.entries = {}
+        self.aliases = {}
+        self.ambiguous = set()
+        self.rendered = {}
+
+    @classmethod
+    def from_api_list(cls, api_list, tool_descriptions, spec_fn=openai_function_spec):
+        registry = cls()
+        for idx_tool, api_json in enumerate(api_list):
+            standard_tool_name = tool_descriptions[idx_tool][0]
+            openai_function_json, cate_name, pure_api_name = spec_fn(api_json, standard_tool_name)
+            registry.add(openai_function_json, cate_name, standard_tool_name, pure_api_name)
+        return registry
+
+    def add(self, function_json, category, tool_name, api_name):
+        self.functions.append(function_json)
+        self.rendered.clear()
+        name = function_json["name"]
+        if name in self.entries:
+            # the first function with a given name wins, as in the original linear scan
+            return
+        entry = ToolEntry(name, category, tool_name, api_name)
+        self.entries[name] = entry
+        for alias in {f"{api_name}_for_{tool_name}", api_name, name.lower()}:
+            if alias == name or alias in self.ambiguous:
+                continue
+            if alias in self.aliases and self.aliases[alias] != entry:
+                del self.aliases[alias]
+                self.ambiguous.add(alias)
+            else:
+                self.aliases[alias] = entry
+
+    def render(self, function_format="repr", prune_optional=False):
+        """The functions as written in the prompts, rendered once per format (see `render_functions`)."""
+        key = (function_format, prune_optional)
+        if key not in self.rendered:
+            self.rendered[key] = render_functions(self.functions, function_format, prune_optional)
+        return self.rendered[key]
+
+    def resolve(self, action_name):
+        if not isinstance(action_name, str) or not action_name:
+            return None
+        if action_name in self.entries:
+            return self.entries[action_name]
+        if action_name in self.aliases:
+            return self.aliases[action_name]
+        matches = [entry for name, entry in self.entries.items() if name.endswith(action_name)]
+        return matches[0] if len(matches) == 1 else None
+
+    def payload(self, entry, action_input, strip, toolbench_key):
+        return {
+            "category": entry.category,
+            "tool_name": entry.tool_name,
+            "api_name": entry.api_name,
+            "tool_input": action_input,
+            "strip": strip,
+            "toolbench_key": toolbench_key
+        }
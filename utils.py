@@ -1,6 +1,8 @@
 import os
 import re
 import json
+import codecs
+from collections import namedtuple
 from tqdm import tqdm
 
 def standardize_category(category):
@@ -65,12 +67,14 @@ def contain(candidate_list, white_list):
         output.append(white_list[cand])
     return output
 
-def generate_task_list(query_dir, answer_dir, tool_root_dir, method, model_name):
+def generate_task_list(query_dir, answer_dir, tool_root_dir, method, model_name, white_list=None):
     if not os.path.exists(answer_dir):
         os.mkdir(answer_dir)
-    white_list = get_white_list(tool_root_dir)
+    if white_list is None:
+        white_list = get_white_list(tool_root_dir)
     task_list = []
-    querys = json.load(open(query_dir, "r"))
+    with open(query_dir, "r") as reader:
+        querys = json.load(reader)
     for query_id, data_dict in enumerate(querys):
         if "query_id" in data_dict:
             query_id = data_dict["query_id"]
@@ -85,13 +89,88 @@ def generate_task_list(query_dir, answer_dir, tool_root_dir, method, model_name)
         task_list.append((method, model_name, query_id, data_dict, answer_dir, tool_des))
     return task_list
 
+# where a query lives in its test-set file, with what a worker needs besides the query itself
+TaskRef = namedtuple("TaskRef", ["query_path", "offset", "length", "query_id", "answer_dir", "tool_des"])
+
+def iter_json_array(path, chunk_size=1 << 20):
+    """
+    Yield (offset, length, item) for every element of the top-level JSON array in
+    `path`, reading it incrementally; offset and length are in bytes, see `read_json_at`.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer, offset, started, eof = "", 0, False, False
+    with open(path, "rb") as reader:
+        while True:
+            # whitespace, the opening bracket and the separators are all one-byte characters
+            idx = 0
+            while idx < len(buffer) and (buffer[idx] in " \t\r\n," or (buffer[idx] == "[" and not started)):
+                started = started or buffer[idx] == "["
+                idx += 1
+            buffer, offset = buffer[idx:], offset + idx
+            if started and buffer.startswith("]"):
+                return
+            item = None
+            if buffer and started:
+                try:
+                    item, end = decoder.raw_decode(buffer)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # a number or literal at the end of the buffer may continue in the next chunk
+                if item is not None and (end < len(buffer) or eof):
+                    length = len(buffer[:end].encode("utf-8"))
+                    yield offset, length, item
+                    buffer, offset = buffer[end:], offset + length
+                    continue
+            if eof:
+                if buffer.strip() or not started:
+                    raise ValueError(f"{path} is not a complete JSON array")
+                return
+            chunk = reader.read(chunk_size)
+            eof = not chunk
+            buffer += text_decoder.decode(chunk, final=eof)
+
+def read_json_at(path, offset, length):
+    with open(path, "rb") as reader:
+        reader.seek(offset)
+        return json.loads(reader.read(length).decode("utf-8"))
+
+def generate_task_refs(query_path, answer_dir, white_list):
+    """
+    The tasks of `generate_task_list` as TaskRefs, parsing the test set incrementally
+    so that only the position of each query is kept in memory.
+    """
+    if not os.path.exists(answer_dir):
+        os.mkdir(answer_dir)
+    task_refs = []
+    for query_id, (offset, length, data_dict) in enumerate(iter_json_array(query_path)):
+        if "query_id" in data_dict:
+            query_id = data_dict["query_id"]
+        if "api_list" in data_dict:
+            origin_tool_names = [standardize(cont["tool_name"]) for cont in data_dict["api_list"]]
+            tool_des = contain(origin_tool_names, white_list)
+            if tool_des == False:
+                continue
+            tool_des = [[cont["standard_tool_name"], cont["description"]] for cont in tool_des]
+        else:
+            tool_des = None
+        task_refs.append(TaskRef(query_path, offset, length, query_id, answer_dir, tool_des))
+    return task_refs
+
+def load_task(task_ref, method, model_name):
+    """The task tuple of `generate_task_list` for a TaskRef."""
+    data_dict = read_json_at(task_ref.query_path, task_ref.offset, task_ref.length)
+    return (method, model_name, task_ref.query_id, data_dict, task_ref.answer_dir, task_ref.tool_des)
+
 def fetch_api_json(query_json, tool_root_dir):
     data_dict = {"api_list":[]}
     for item in query_json["api_list"]:
         cate_name = item["category_name"]
         tool_name = standardize(item["tool_name"])
         api_name = change_name(standardize(item["api_name"]))
-        tool_json = json.load(open(os.path.join(tool_root_dir, cate_name, tool_name + ".json"), "r"))
+        with open(os.path.join(tool_root_dir, cate_name, tool_name + ".json"), "r") as reader:
+            tool_json = json.load(reader)
         append_flag = False
         api_dict_names = []
         for api_dict in tool_json["api_list"]:
@@ -0,0 +1,207 @@
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import argparse
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from utils import standardize, change_name, standardize_category
+from server import process_error, observation_shorten, load_tool_schemas
+from tool_cache import ToolCache
+
+# raw tool outputs that `process_error` maps to each of the error observations of the tool service
+ERROR_OUTPUTS = [
+    "Your Client (working) ---> Gateway (working) ---> API (not working)",
+    "{'message': 'You are not subscribed to this API.'}",
+    "{'message': 'Unauthorized'}",
+    "{'message': 'Too many requests'}",
+    "{'message': 'You have exceeded the rate limit per minute for your plan, BASIC, by the API provider'}",
+    "{'messages': 'Oops, an error in the gateway has occurred.'}",
+    "{'message': 'Blocked User. Please contact your API provider.'}",
+    "{'error': 'Invalid parameters'}",
+]
+
+TYPE_EXAMPLES = {"str": "string", "int": 0, "float": 0.0, "bool": True, "NoneType": None}
+
+
+def schema_example(schema):
+    """Build an example response from a response_examples schema, whose leaves are type names."""
+    if isinstance(schema, dict):
+        return {key: schema_example(value) for key, value in schema.items()}
+    if isinstance(schema, list):
+        return [schema_example(item) for item in schema[:1]]
+    return TYPE_EXAMPLES.get(schema, schema)
+
+
+class VirtualToolService:
+    """
+    Offline stand-in for the StableToolBench virtual service, speaking the same payload
+    contract (category, tool_name, api_name, tool_input, strip).
+
+    Responses come from recordings (JSONL files of {"request": payload, "response": ...}
+    lines, or a ToolCache database), else from the response_examples schema of the api.
+    Latency and errors are injected with a random generator seeded by the request and
+    the number of times it was seen, so a run is reproducible.
+
+    :param recordings: JSONL files with recorded responses.
+    :param cache_db: A ToolCache database with recorded responses.
+    :param schema_root: The response_examples directory.
+    :param latency_ms: Mean injected latency. Default is 0.
+    :param latency_jitter_ms: Half-width of the uniform jitter around the mean latency. Default is 0.
+    :param error_rate: Probability of answering with one of the tool service errors. Default is 0.
+    :param seed: Seed of the injected latency and errors. Default is 0.
+    """
+    def __init__(self, recordings=None, cache_db=None, schema_root="data/toolenv/response_examples",
+                 latency_ms=0, latency_jitter_ms=0, error_rate=0, seed=0):
+        self.schema_root = schema_root
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.seed = seed
+        self.recorded = {}
+        for path in recordings or []:
+            with open(path, "r", encoding="utf-8") as reader:
+                for line in reader:
+                    if line.strip():
+                        record = json.loads(line)
+                        # run logs of --record also hold llm lines, which have no tool request
+                        if "request" in record:
+                            self.recorded.setdefault(self.request_key(record["request"]), record["response"])
+        self.cache_db = cache_db
+        self.conn = None
+        if cache_db is not None:
+            # one read-only connection shared by the request threads, used while holding `db_lock`
+            self.conn = sqlite3.connect(f"file:{cache_db}?mode=ro", uri=True, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        self.seen = defaultdict(int)
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    @staticmethod
+    def request_key(payload):
+        # recordings are matched regardless of the strip method
+        return ToolCache.make_key(dict(payload, strip=""))
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def cached_response(self, payload):
+        if self.conn is None:
+            return None
+        with self.db_lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (ToolCache.make_key(payload),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+    def respond(self, payload):
+        """Return (response, delay in seconds) for a tool service payload."""
+        key = self.request_key(payload)
+        with self.lock:
+            occurrence = self.seen[key]
+            self.seen[key] += 1
+        digest = hashlib.sha256(f"{self.seed}:{key}:{occurrence}".encode("utf-8")).hexdigest()
+        rng = random.Random(int(digest[:16], 16))
+        delay = max(0, self.latency_ms + rng.uniform(-self.latency_jitter_ms, self.latency_jitter_ms)) / 1000
+
+        if rng.random() < self.error_rate:
+            response, save_cache, _ = process_error(rng.choice(ERROR_OUTPUTS))
+            self.count("injected_error")
+            return dict(response, save_cache=save_cache), delay
+
+        response = self.cached_response(payload)
+        if response is None:
+            response = self.recorded.get(key)
+        if response is not None:
+            self.count("recorded")
+            return response, delay
+
+        category = standardize_category(payload["category"])
+        tool_name = standardize(payload["tool_name"])
+        if tool_name.endswith(f"_for_{category}"):
+            tool_name = tool_name[:-len(f"_for_{category}")]
+        api_name = change_name(standardize(payload["api_name"]))
+        schema = load_tool_schemas(self.schema_root, category, tool_name).get(api_name)
+        if schema is None:
+            response, save_cache, _ = process_error(ERROR_OUTPUTS[0])
+            self.count("missing")
+            return dict(response, save_cache=save_cache), delay
+
+        response, save_cache, _ = process_error(schema_example(schema))
+        observation = observation_shorten(self.schema_root, response, category, tool_name, api_name, payload.get("strip", "truncate"))
+        self.count("schema")
+        return {"error": response["error"], "response": observation[:2048], "save_cache": save_cache}, delay
+
+
+class VirtualToolHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            response, delay = self.server.service.respond(payload)
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        time.sleep(delay)
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LoadTestHTTPServer(ThreadingHTTPServer):
+    """Threading HTTP server with a listen backlog deep enough for the connection bursts of many pool workers."""
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_virtual_server(service, host="127.0.0.1", port=8080):
+    """Serve `service` from a background thread and return the server; stop it with `shutdown()`."""
+    httpd = LoadTestHTTPServer((host, port), VirtualToolHandler)
+    httpd.service = service
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default="127.0.0.1", required=False, help='host to listen on')
+    parser.add_argument('--port', type=int, default=8080, required=False, help='port to listen on, use --service_url http://<host>:<port>/virtual')
+    parser.add_argument('--recordings', nargs='*', default=None, help='jsonl files with recorded {"request": ..., "response": ...} lines')
+    parser.add_argument('--cache_db', type=str, default=None, required=False, help='tool cache database (see --tool_cache) to answer from')
+    parser.add_argument('--schema_root', type=str, default="data/toolenv/response_examples", required=False, help='response_examples directory used when no recording matches')
+    parser.add_argument('--latency_ms', type=float, default=0, required=False, help='mean injected latency')
+    parser.add_argument('--latency_jitter_ms', type=float, default=0, required=False, help='uniform jitter around the mean latency')
+    parser.add_argument('--error_rate', type=float, default=0, required=False, help='probability of answering with a tool service error')
+    parser.add_argument('--seed', type=int, default=0, required=False, help='seed of the injected latency and errors')
+    args = parser.parse_args()
+
+    service = VirtualToolService(
+        recordings=args.recordings,
+        cache_db=args.cache_db,
+        schema_root=args.schema_root,
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    httpd = start_virtual_server(service, args.host, args.port)
+    print(f"Virtual tool service listening on http://{args.host}:{args.port}/virtual")
+    try:
+        while True:
+            time.sleep(60)
+            print(dict(service.stats))
+    except KeyboardInterrupt:
+        httpd.shutdown()
+        service.close()
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+from utils import TaskRef, standardize
+
+
+class WorkQueue:
+    """
+    Work queue shared by MIRROR runners on several hosts through a lease directory on a
+    shared filesystem.
+
+    Every task is one small file holding its TaskRef. Pending tasks are in `todo/`; a
+    worker claims one by renaming it into `leased/<worker_id>/`, which only one worker
+    can do, and renames it into `done/` once its answer is written. Workers refresh the
+    modification time of their leases every `lease_seconds / 3` (heartbeat); a lease
+    not refreshed for `lease_seconds`, because its worker died or its host went away,
+    is renamed back into `todo/` by the next worker that runs out of tasks. Tasks that
+    failed with an exception go to `failed/` and are not retried in the same sweep.
+
+    The queue of a sweep is `<root>/<method>_<model>`, so runners of different models
+    can share the root. The test sets and the answer directory are queued as absolute
+    paths, so they must be mounted at the same place on every host. The file names
+    start with the position of the task in the shuffled task list, so the queue is
+    served in the same order as a single runner. The answers are written as files to
+    the shared answer directory; a results database cannot be shared this way.
+
+    :param root: The lease directory of this method and model.
+    :param lease_seconds: Seconds without heartbeat after which a lease is requeued. Default is 600.
+    :param poll_seconds: How often a worker without task checks for requeued ones. Default is 10.
+    :param worker_id: Name of the lease directory of this worker. Default is <host>-<pid>.
+    """
+    def __init__(self, root, lease_seconds=600, poll_seconds=10, worker_id=None):
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        for name in ("todo", "leased", "done", "failed", "tmp"):
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+        self.lease_dir = os.path.join(root, "leased", self.worker_id)
+        self.held = set()
+        self.lock = threading.Lock()
+        self.listing = []
+        self.heartbeat = None
+
+    @classmethod
+    def from_args(cls, args):
+        if not args.work_queue:
+            return None
+        return cls(
+            os.path.join(args.work_queue, f"{args.method}_{standardize(args.model_name)}"),
+            lease_seconds=args.lease_seconds
+        )
+
+    def path(self, state, name):
+        return os.path.join(self.root, state, name)
+
+    def leased_names(self):
+        names = set()
+        for worker_id in os.listdir(os.path.join(self.root, "leased")):
+            names.update(os.listdir(os.path.join(self.root, "leased", worker_id)))
+        return names
+
+    def populate(self, task_refs, skip=None):
+        """
+        Add the tasks of `task_refs` that are not queued, leased or done yet; every runner
+        of a sweep can call it with the same tasks. Return how many were added.
+
+        :param task_refs: All the tasks of the sweep, in order.
+        :param skip: Predicate of the tasks not to queue, e.g. the ones already answered.
+        """
+        # listed in the order tasks move through, so a task moving meanwhile is still seen
+        existing = set(os.listdir(os.path.join(self.root, "todo")))
+        existing.update(self.leased_names())
+        existing.update(os.listdir(os.path.join(self.root, "done")))
+        existing.update(os.listdir(os.path.join(self.root, "failed")))
+        added = 0
+        for position, task_ref in enumerate(task_refs):
+            group = os.path.basename(task_ref.answer_dir)
+            name = f"{position:09d}_{group}_{task_ref.query_id}.json".replace(os.sep, "_")
+            if name in existing or (skip is not None and skip(task_ref)):
+                continue
+            # relative paths would be resolved against the working directory of the claiming runner
+            task_ref = task_ref._replace(query_path=os.path.abspath(task_ref.query_path), answer_dir=os.path.abspath(task_ref.answer_dir))
+            tmp_path = self.path("tmp", f"{self.worker_id}_{name}")
+            with open(tmp_path, "w", encoding="utf-8") as writer:
+                json.dump(list(task_ref), writer, ensure_ascii=False)
+            try:
+                # unlike a rename, a link fails if another runner queued the task meanwhile
+                os.link(tmp_path, self.path("todo", name))
+                added += 1
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        return added
+
+    def claim(self):
+        """Lease the next pending task; return (name, TaskRef), or None if there is none."""
+        os.makedirs(self.lease_dir, exist_ok=True)
+        while True:
+            if not self.listing:
+                # listed once and walked through, instead of listing the directory for every claim
+                self.listing = sorted(os.listdir(os.path.join(self.root, "todo")), reverse=True)
+                if not self.listing:
+                    return None
+            name = self.listing.pop()
+            lease_path = os.path.join(self.lease_dir, name)
+            try:
+                os.rename(self.path("todo", name), lease_path)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            # the rename keeps the modification time of the file, the lease starts now
+            os.utime(lease_path)
+            with self.lock:
+                self.held.add(name)
+            with open(lease_path, encoding="utf-8") as reader:
+                return name, TaskRef(*json.load(reader))
+
+    def finish(self, name, state="done"):
+        """Move a leased task to `done/` or `failed/`."""
+        with self.lock:
+            self.held.discard(name)
+        try:
+            os.rename(os.path.join(self.lease_dir, name), self.path(state, name))
+        except FileNotFoundError:
+            # the lease expired and the task was requeued, it must not run again
+            for lost_path in [self.path("todo", name)] + [
+                os.path.join(self.root, "leased", worker_id, name) for worker_id in os.listdir(os.path.join(self.root, "leased"))
+            ]:
+                try:
+                    os.rename(lost_path, self.path(state, name))
+                    break
+                except FileNotFoundError:
+                    continue
+
+    def requeue_expired(self):
+        """Move the leases without heartbeat for `lease_seconds` back to `todo/`; return how many."""
+        requeued = 0
+        now = time.time()
+        for worker_id in os.listdir(os.path.join(self.root, "leased")):
+            worker_dir = os.path.join(self.root, "leased", worker_id)
+            for name in os.listdir(worker_dir):
+                try:
+                    if now - os.path.getmtime(os.path.join(worker_dir, name)) < self.lease_seconds:
+                        continue
+                    os.rename(os.path.join(worker_dir, name), self.path("todo", name))
+                    requeued += 1
+                except FileNotFoundError:
+                    continue
+        if requeued:
+            print(f"Requeued {requeued} expired leases")
+        return requeued
+
+    def beat(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self.lock:
+                names = list(self.held)
+            for name in names:
+                try:
+                    os.utime(os.path.join(self.lease_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def start_heartbeat(self):
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self.beat, daemon=True)
+            self.heartbeat.start()
+
+    def leases(self):
+        """
+        Yield (name, TaskRef) until every task of the queue is done, waiting for the tasks
+        leased by other workers, which are requeued if their worker dies. Call `finish`
+        with the name once a task is answered.
+        """
+        self.start_heartbeat()
+        while True:
+            claimed = self.claim()
+            if claimed is not None:
+                yield claimed
+                continue
+            if self.requeue_expired():
+                continue
+            if not self.leased_names():
+                return
+            time.sleep(self.poll_seconds)
+
+    def stats(self):
+        return {
+            "todo": len(os.listdir(os.path.join(self.root, "todo"))),
+            "leased": len(self.leased_names()),
+            "done": len(os.listdir(os.path.join(self.root, "done"))),
+            "failed": len(os.listdir(os.path.join(self.root, "failed")))
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show or maintain the work queue of a distributed MIRROR run.")
+    parser.add_argument('--work_queue', type=str, required=True, help='lease directory given to the runners with --work_queue')
+    parser.add_argument('--method', type=str, default="mirror", required=False, help='method of the sweep')
+    parser.add_argument('--model_name', type=str, default="gpt-4o-2024-05-13", required=False, help='model of the sweep')
+    parser.add_argument('--lease_seconds', type=float, default=600, required=False, help='seconds without heartbeat after which a lease is requeued')
+    parser.add_argument('--requeue_expired', action="store_true", help='move the expired leases back to the queue')
+    parser.add_argument('--retry_failed', action="store_true", help='move the failed tasks back to the queue')
+    args = parser.parse_args()
+
+    queue = WorkQueue.from_args(args)
+    if args.requeue_expired:
+        queue.requeue_expired()
+    if args.retry_failed:
+        for name in os.listdir(os.path.join(queue.root, "failed")):
+            os.rename(queue.path("failed", name), queue.path("todo", name))
+    print(queue.stats())